@@ -0,0 +1,282 @@
+"""Benchmarks of the test nodes bring-up, run against the local stand-in test nodes.
+
+Stand-in test nodes are local popen gateways, each running in its own home directory: the ssh gateway specs made by
+pytest-cloud for the stand-in hostnames are replaced with the popen ones, so no network or ssh server is needed.
+"""
+
+import contextlib
+import json
+import os.path
+import platform
+import sys
+import time
+
+import execnet
+import pytest
+
+# pylint: disable=C0103
+pytest_plugins = "pytester"
+
+# modules per package of the synthetic project tree
+MODULES_PER_PACKAGE = 100
+# benchmarks which took less than that are not compared to the baseline, as they are mostly noise, in seconds
+MIN_DURATION = 0.05
+
+
+def pytest_addoption(parser):
+    """Pytest hook to add the benchmark options."""
+    group = parser.getgroup("benchmark", "pytest-cloud benchmarks")
+    group.addoption(
+        "--bench-nodes",
+        help="comma separated numbers of the stand-in test nodes to benchmark with. Default is 1,10",
+        default="1,10",
+    )
+    group.addoption(
+        "--bench-files",
+        help="comma separated numbers of the files in the synthetic project tree. Default is 1000,10000",
+        default="1000,10000",
+    )
+    group.addoption(
+        "--bench-connect-timeout",
+        help="time to wait for the stand-in test nodes to accept the connection, in seconds. Default is 60",
+        type=float,
+        default=60,
+    )
+    group.addoption(
+        "--bench-ssh-host",
+        help="ssh host to benchmark rsync with, for example localhost. Can be given multiple times, "
+        "the hosts have to be different machines. Rsync is not benchmarked if not given",
+        action="append",
+        default=[],
+    )
+    group.addoption(
+        "--bench-save",
+        help="path to save the benchmark results to, as JSON",
+        metavar="PATH",
+    )
+    group.addoption(
+        "--bench-compare",
+        help="path to the baseline benchmark results to compare to. The test run fails if any benchmark "
+        "is slower than the baseline by more than the tolerance",
+        metavar="PATH",
+    )
+    group.addoption(
+        "--bench-tolerance",
+        help="allowed slowdown compared to the baseline, as a fraction. Default is 0.5",
+        type=float,
+        default=0.5,
+    )
+
+
+def pytest_configure(config):
+    """Prepare the benchmark results."""
+    # results in form {<benchmark name>: <seconds>}
+    config._bench_results = {}
+    config._bench_regressions = []
+
+
+def pytest_generate_tests(metafunc):
+    """Parametrize the benchmarks with the numbers of the stand-in test nodes and the files."""
+    for name, option in (("nodes", "bench_nodes"), ("files", "bench_files")):
+        if name in metafunc.fixturenames:
+            values = [
+                int(value)
+                for value in getattr(metafunc.config.option, option).split(",")
+            ]
+            metafunc.parametrize(
+                name, values, ids=["{0}={1}".format(name, value) for value in values]
+            )
+
+
+# pylint: disable=R0205
+class Benchmark(object):
+    """Recorder of the benchmark durations."""
+
+    def __init__(self, results, name):
+        """Initialize new Benchmark instance.
+
+        :param results: `dict` to record the durations to
+        :type results: dict
+        :param name: benchmark name, the measured step names are prefixed with
+        :type name: str
+        """
+        self.results = results
+        self.name = name
+
+    @contextlib.contextmanager
+    def measure(self, step):
+        """Measure the duration of the step as the context.
+
+        :param step: name of the step
+        :type step: str
+        """
+        start = time.time()
+        yield
+        self.record(step, time.time() - start)
+
+    def record(self, step, seconds):
+        """Record the duration of the step.
+
+        :param step: name of the step
+        :type step: str
+        :param seconds: duration of the step, in seconds
+        :type seconds: float
+        """
+        self.results["{0}:{1}".format(self.name, step)] = seconds
+
+
+@pytest.fixture
+def bench(request):
+    """Benchmark durations recorder."""
+    return Benchmark(request.config._bench_results, request.node.name)
+
+
+def make_tree(path, files):
+    """Make the synthetic project tree.
+
+    :param path: directory to make the tree in
+    :type path: py.path.local
+    :param files: number of the files
+    :type files: int
+    """
+    for index in range(files):
+        package = path.join("package{0}".format(index // MODULES_PER_PACKAGE))
+        if not index % MODULES_PER_PACKAGE:
+            package.join("__init__.py").write("", ensure=True)
+        package.join("test_module{0}.py".format(index)).write(
+            "".join(
+                "def test_function{0}():\n    assert {0} + {0} == {1}\n\n\n".format(
+                    number, number * 2
+                )
+                for number in range(20)
+            ),
+            ensure=True,
+        )
+
+
+@pytest.fixture
+def project(testdir, files):
+    """Synthetic project tree of the given number of files, in the current directory."""
+    make_tree(testdir.tmpdir.join("project"), files)
+    testdir.tmpdir.join("project").chdir()
+    return testdir.tmpdir.join("project")
+
+
+# pylint: disable=R0205
+class StandInNodes(object):
+    """Local stand-in test nodes, the ssh gateways to which are made as the popen ones."""
+
+    def __init__(self, path, count):
+        """Initialize new StandInNodes instance.
+
+        :param path: directory to make the home directories of the test nodes in
+        :type path: py.path.local
+        :param count: number of the test nodes
+        :type count: int
+        """
+        self.path = path
+        self.hosts = ["node{0}.standin".format(index) for index in range(count)]
+        for host in self.hosts:
+            path.join(host).ensure(dir=True)
+
+    def get_spec(self, spec):
+        """Get the popen gateway spec for the ssh gateway spec to the stand-in test node.
+
+        :param spec: gateway spec
+        :type spec: execnet.XSpec
+
+        :return: popen gateway spec running in the home directory of the test node, or the spec itself if it's not
+            the ssh spec to the stand-in test node
+        :rtype: str
+        """
+        if spec.ssh not in self.hosts:
+            return spec
+        home = self.path.join(spec.ssh)
+        return "popen//id={id}//chdir={chdir}//python={python}".format(
+            id=spec.id,
+            chdir=home.join(spec.chdir) if spec.chdir else home,
+            python=sys.executable,
+        )
+
+
+@pytest.fixture
+def standin_nodes(tmpdir_factory, monkeypatch, nodes):
+    """Stand-in test nodes for the given number of the test nodes."""
+    standin = StandInNodes(tmpdir_factory.mktemp("nodes"), nodes)
+    makegateway = execnet.Group.makegateway
+
+    def standin_makegateway(group, spec=None):
+        if not isinstance(spec, execnet.XSpec):
+            spec = execnet.XSpec(spec)
+        return makegateway(group, standin.get_spec(spec))
+
+    monkeypatch.setattr(execnet.Group, "makegateway", standin_makegateway)
+    return standin
+
+
+def get_regressions(results, baseline, tolerance):
+    """Get the benchmarks which are slower than the baseline.
+
+    :param results: `dict` in form {<benchmark name>: <seconds>}
+    :type results: dict
+    :param baseline: baseline results in the same form
+    :type baseline: dict
+    :param tolerance: allowed slowdown, as a fraction
+    :type tolerance: float
+
+    :return: `list` in form [(<benchmark name>, <baseline seconds>, <seconds>), ...]
+    :rtype: list
+    """
+    return [
+        (name, baseline[name], seconds)
+        for name, seconds in sorted(results.items())
+        if name in baseline
+        and seconds >= MIN_DURATION
+        and seconds > baseline[name] * (1 + tolerance)
+    ]
+
+
+def pytest_sessionfinish(session):
+    """Save the benchmark results and compare them to the baseline."""
+    config = session.config
+    results = config._bench_results
+    if config.option.bench_save:
+        dirname = os.path.dirname(os.path.abspath(config.option.bench_save))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(config.option.bench_save, "w") as fd:
+            json.dump(
+                dict(
+                    python=platform.python_version(),
+                    platform=platform.platform(),
+                    results=results,
+                ),
+                fd,
+                indent=2,
+                sort_keys=True,
+            )
+    if config.option.bench_compare and os.path.exists(config.option.bench_compare):
+        with open(config.option.bench_compare) as fd:
+            baseline = json.load(fd)["results"]
+        config._bench_regressions = get_regressions(
+            results, baseline, config.option.bench_tolerance
+        )
+        if config._bench_regressions:
+            session.exitstatus = 1
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    """Report the benchmark results and the regressions."""
+    results = config._bench_results
+    if not results:
+        return
+    terminalreporter.section("benchmarks")
+    for name, seconds in sorted(results.items()):
+        terminalreporter.write_line("{0:.3f}s {1}".format(seconds, name))
+    for name, baseline, seconds in config._bench_regressions:
+        terminalreporter.write_line(
+            "REGRESSION {0}: {1:.3f}s, baseline {2:.3f}s".format(
+                name, seconds, baseline
+            ),
+            red=True,
+        )
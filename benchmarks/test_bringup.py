@@ -0,0 +1,176 @@
+"""Benchmarks of the test nodes bring-up: discovery, sync, environment activation and test process startup."""
+import os
+import sys
+
+from distutils.spawn import find_executable  # pylint: disable=E0611
+import execnet
+import pytest
+
+from pytest_cloud import patches, zygote
+from pytest_cloud.plugin import (
+    ZYGOTE_PRELOAD,
+    get_nodes_specs,
+    make_gateways,
+    receive_each,
+)
+from pytest_cloud.rsync import RSync
+from pytest_cloud.sync import ExecnetSync
+from pytest_cloud.timings import Timings
+
+# relative path to sync the project tree to on the test nodes
+CHDIR = "work"
+
+
+def connect(group, specs, timeout):
+    """Connect to all the test nodes.
+
+    :return: `list` of the gateways
+    :rtype: list
+    """
+    connected = make_gateways(group, specs, timeout=timeout)
+    assert len(connected) == len(specs), "not all the test nodes connected in time"
+    return [group[execnet.XSpec(spec).id] for spec in specs]
+
+
+def get_specs(hosts, chdir=CHDIR):
+    """Get the gateway specs of the test nodes, running in the given directory."""
+    return [
+        (
+            "ssh={0}//id={0}//chdir={1}".format(host, chdir)
+            if chdir
+            else "ssh={0}//id={0}".format(host)
+        )
+        for host in hosts
+    ]
+
+
+def test_get_nodes_specs(request, testdir, project, standin_nodes, bench):
+    """Benchmark the whole bring-up of the test nodes, cold and with the project tree already synced."""
+    # the virtualenv is activated on the test nodes, the test processes of the stand-in test nodes do not use it
+    project.join("env", "bin", "activate_this.py").write("", ensure=True)
+    config = testdir.parseconfigure()
+    for step in ("cold", "warm"):
+        config._cloud_timings = timings = Timings()
+        with bench.measure(step):
+            specs = get_nodes_specs(
+                standin_nodes.hosts,
+                python="python",
+                chdir=CHDIR,
+                virtualenv_path="env",
+                connect_timeout=request.config.option.bench_connect_timeout,
+                sync_backend="execnet",
+                config=config,
+            )
+        assert specs
+        assert not config._cloud_unreachable
+        for phase in timings.get_report()["phases"]:
+            bench.record("{0}:{1}".format(step, phase["name"]), phase["duration"])
+
+
+def test_sync(request, project, standin_nodes, bench):
+    """Benchmark the sync of the project tree over execnet, cold, warm and with a few files changed."""
+    group = execnet.Group()
+    try:
+        gateways = connect(
+            group,
+            get_specs(standin_nodes.hosts),
+            request.config.option.bench_connect_timeout,
+        )
+        sync = ExecnetSync(
+            project, CHDIR, gateways=dict(zip(standin_nodes.hosts, gateways))
+        )
+        for host in standin_nodes.hosts:
+            sync.add_target_host(host)
+        with bench.measure("cold"):
+            sync.send()
+        with bench.measure("warm"):
+            sync.send()
+        for path in sorted(project.visit("*.py"))[::100]:
+            path.write("\n", mode="a")
+        with bench.measure("changed"):
+            sync.send()
+    finally:
+        group.terminate()
+
+
+def test_rsync(request, project, bench):
+    """Benchmark the sync of the project tree with rsync to the given ssh hosts, cold and warm."""
+    hosts = request.config.option.bench_ssh_host
+    if not hosts:
+        pytest.skip("no ssh hosts given with --bench-ssh-host")
+    if not find_executable("rsync") or not find_executable("parallel"):
+        pytest.skip("rsync or parallel is not found")
+    rsync = RSync(
+        project, "pytest-cloud-benchmark", jobs=len(hosts), ssh_cipher="aes128-ctr"
+    )
+    for host in hosts:
+        rsync.add_target_host(host)
+    with bench.measure("cold"):
+        rsync.send()
+    with bench.measure("warm"):
+        rsync.send()
+    assert rsync.synced == set(hosts)
+
+
+@pytest.mark.parametrize("bytecode", ["purge", "compile"])
+def test_activate_env(request, project, standin_nodes, bench, bytecode):
+    """Benchmark the environment activation in the synced project tree."""
+    group = execnet.Group()
+    try:
+        gateways = connect(
+            group,
+            get_specs(standin_nodes.hosts),
+            request.config.option.bench_connect_timeout,
+        )
+        sync = ExecnetSync(
+            project, CHDIR, gateways=dict(zip(standin_nodes.hosts, gateways))
+        )
+        for host in standin_nodes.hosts:
+            sync.add_target_host(host)
+        sync.send()
+        for step in ("first", "second"):
+            with bench.measure(step):
+                receive_each(
+                    group, patches.activate_env, virtualenv_path=None, bytecode=bytecode
+                )
+    finally:
+        group.terminate()
+
+
+@pytest.mark.parametrize("use_zygote", [False, True], ids=["python", "zygote"])
+def test_worker_startup(request, standin_nodes, bench, use_zygote):
+    """Benchmark the startup of the test process on each test node, up to the point it can run the tests."""
+    group = execnet.Group()
+    try:
+        pythons = dict((host, sys.executable) for host in standin_nodes.hosts)
+        if use_zygote:
+            with open(os.path.splitext(zygote.__file__)[0] + ".py") as fd:
+                source = fd.read()
+            with bench.measure("zygote"):
+                gateways = connect(
+                    group,
+                    get_specs(standin_nodes.hosts, chdir=None),
+                    request.config.option.bench_connect_timeout,
+                )
+                channels = [
+                    gateway.remote_exec(
+                        patches.start_zygote,
+                        python=sys.executable,
+                        script=source,
+                        modules=ZYGOTE_PRELOAD,
+                    )
+                    for gateway in gateways
+                ]
+                for host, channel in zip(standin_nodes.hosts, channels):
+                    pythons[host] = channel.receive()
+        with bench.measure("startup"):
+            specs = [
+                "popen//id={0}_0//python={1}".format(host, python)
+                for host, python in pythons.items()
+            ]
+            gateways = connect(
+                group, specs, request.config.option.bench_connect_timeout
+            )
+            receive_each(gateways, "import pytest, xdist.remote; channel.send(None)")
+    finally:
+        group.terminate()
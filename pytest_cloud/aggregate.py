@@ -0,0 +1,195 @@
+"""Per test node aggregation of the test process events."""
+import socket
+import struct
+import zlib
+
+import execnet
+
+# time to collect the batch of the events for, in seconds
+DEFAULT_INTERVAL = 0.05
+# frame sent by the test process to the aggregator: length of the data, 1 if it waits for the data to be forwarded
+FRAME_HEADER = struct.Struct("!IB")
+# event in the batch forwarded to the master: length of the test process id, length of the data
+BATCH_HEADER = struct.Struct("!II")
+
+
+# pylint: disable=R0912,R0914,R0915
+def serve_aggregator(channel, interval):
+    """Forward the events of the test processes of the test node to the master in compressed batches.
+
+    Executed on the remote side, on the gateway the test processes of the test node are started via.
+    Sends the path to the unix socket the test processes connect to, then the batches.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    :param interval: time to collect the batch for, in seconds
+    :type interval: float
+    """
+    import os.path  # pylint: disable=W0404,C0415
+    import select  # pylint: disable=C0415
+    import shutil  # pylint: disable=C0415
+    import socket  # pylint: disable=W0404,W0621,C0415
+    import struct  # pylint: disable=W0404,W0621,C0415
+    import tempfile  # pylint: disable=C0415
+    import time  # pylint: disable=C0415
+    import zlib  # pylint: disable=W0404,W0621,C0415
+
+    frame_header = struct.Struct("!IB")
+    batch_header = struct.Struct("!II")
+    directory = tempfile.mkdtemp(prefix="pytest-cloud-aggregator-")
+    path = os.path.join(directory, "aggregator.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    channel.send(path)
+    # received data of each connection, which does not make the complete frame yet
+    buffers = {}
+    worker_ids = {}
+    batch = []
+    flushed = time.time()
+    try:
+        while not channel.isclosed():
+            readable, _, _ = select.select([server] + list(buffers), [], [], interval)
+            synced = []
+            for sock in readable:
+                if sock is server:
+                    conn, _ = server.accept()
+                    buffers[conn] = b""
+                    continue
+                chunk = sock.recv(65536)
+                if not chunk:
+                    del buffers[sock]
+                    worker_ids.pop(sock, None)
+                    sock.close()
+                    continue
+                data = buffers[sock] + chunk
+                while len(data) >= frame_header.size:
+                    size, sync = frame_header.unpack_from(data)
+                    if len(data) < frame_header.size + size:
+                        break
+                    frame = data[frame_header.size : frame_header.size + size]
+                    data = data[frame_header.size + size :]
+                    if sock not in worker_ids:
+                        # the first frame is the test process id
+                        worker_ids[sock] = frame
+                        continue
+                    worker_id = worker_ids[sock]
+                    batch.append(
+                        batch_header.pack(len(worker_id), size) + worker_id + frame
+                    )
+                    if sync:
+                        synced.append(sock)
+                buffers[sock] = data
+            if batch and (synced or time.time() - flushed >= interval):
+                try:
+                    channel.send(zlib.compress(b"".join(batch)))
+                except IOError:
+                    # the test run is over
+                    break
+                batch = []
+                flushed = time.time()
+            for sock in synced:
+                sock.sendall(b"1")
+    finally:
+        for sock in buffers:
+            sock.close()
+        server.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# pylint: disable=R0205
+class Aggregator(object):
+    """Aggregator of the test processes events of single test node, on the master side.
+
+    The test processes of the test node are started via the aggregator gateway, and send their events to
+    the aggregator instead of their own channels. The batches are dispatched to the test processes controllers in
+    the receiver thread of the aggregator gateway, the same thread which forwards the data of the test processes
+    channels, so the events are dispatched before the test process channel is closed.
+    """
+
+    def __init__(self, gateway, interval):
+        """Initialize new Aggregator instance and start the aggregator on the remote side.
+
+        :param gateway: gateway to the test node, the test processes are started via
+        :type gateway: execnet.gateway.Gateway
+        :param interval: time to collect the batch for on the remote side, in seconds
+        :type interval: float
+        """
+        self.gateway = gateway
+        self.nodes = {}
+        self.closed = False
+        self.channel = gateway.remote_exec(serve_aggregator, interval=interval)
+        self.path = self.channel.receive()
+        self.channel.setcallback(self.dispatch)
+
+    def add_node(self, node):
+        """Dispatch the events of the test process to its controller.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+        """
+        self.nodes[node.gateway.id] = node
+
+    def dispatch(self, payload):
+        """Dispatch the batch of the events to the test processes controllers.
+
+        :param payload: compressed batch of the events
+        :type payload: bytes
+        """
+        data = zlib.decompress(payload)
+        offset = 0
+        while offset < len(data):
+            id_size, size = BATCH_HEADER.unpack_from(data, offset)
+            offset += BATCH_HEADER.size
+            worker_id = data[offset : offset + id_size].decode("utf-8")
+            offset += id_size
+            event = execnet.loads(data[offset : offset + size])
+            offset += size
+            node = self.nodes.get(worker_id)
+            # events of the crashed test process which were on the way are dropped
+            if node is not None and not node._down:  # pylint: disable=W0212
+                node.process_from_remote(event)
+
+    def close(self):
+        """Stop the aggregator on the remote side, so its gateway can exit."""
+        self.closed = True
+        try:
+            self.channel.close()
+        except Exception:  # pylint: disable=W0703
+            pass
+
+
+class EventForwarder(object):
+    """Sender of the test process events to the aggregator of its test node.
+
+    Executed on the remote side, in the test process.
+    """
+
+    # events after which the test process channel is closed
+    sync_events = ("workerfinished",)
+
+    def __init__(self, path, worker_id):
+        """Initialize new EventForwarder instance and connect to the aggregator.
+
+        :param path: path to the unix socket of the aggregator
+        :type path: str
+        :param worker_id: test process id
+        :type worker_id: str
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.write(worker_id.encode("utf-8"))
+
+    def write(self, data, sync=False):
+        """Write the frame to the aggregator."""
+        self.sock.sendall(FRAME_HEADER.pack(len(data), sync) + data)
+
+    def sendevent(self, name, **kwargs):
+        """Send the event to the aggregator, in place of `WorkerInteractor.sendevent`.
+
+        The events after which the test process channel is closed wait for the aggregator to forward them.
+        """
+        sync = name in self.sync_events
+        self.write(execnet.dumps((name, kwargs)), sync=sync)
+        if sync:
+            self.sock.recv(1)
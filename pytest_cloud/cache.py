@@ -0,0 +1,203 @@
+"""Persistent state kept in the pytest cache between test runs."""
+
+import os
+import time
+
+
+def get_cache(config):
+    """Get pytest cache.
+
+    pytest-cloud plans the test nodes before the cache is configured, so the cache is created here if needed.
+
+    :return: pytest cache or None if the cache provider plugin is disabled
+    :rtype: _pytest.cacheprovider.Cache
+    """
+    cache = getattr(config, "cache", None)
+    if cache is None and config.pluginmanager.getplugin("cacheprovider"):
+        # pylint: disable=C0415
+        from _pytest.cacheprovider import Cache
+
+        try:
+            cache = Cache.for_config(config, _ispytest=True)
+        except TypeError:
+            cache = Cache.for_config(config)
+    return cache
+
+
+# pylint: disable=R0205
+class SyncCache(object):
+    """Manifests of the directory structures last synced to the test nodes.
+
+    Manifests are stored once per fingerprint, test nodes refer to the fingerprint of the directory structure they
+    were synced to.
+    """
+
+    def __init__(self, cache, chdir):
+        """Initialize new SyncCache instance.
+
+        :param cache: pytest cache
+        :type cache: _pytest.cacheprovider.Cache
+        :param chdir: relative path where tests are synced to on the remote side
+        :type chdir: str
+        """
+        self.cache = cache
+        self.key = "cloud/sync/{0}".format(chdir.replace(os.path.sep, "_"))
+        data = self.cache.get(self.key, {})
+        self.hosts = data.get("hosts", {})
+        self.manifests = dict(
+            (
+                fingerprint,
+                dict((path, tuple(entry)) for path, entry in manifest.items()),
+            )
+            for fingerprint, manifest in data.get("manifests", {}).items()
+        )
+
+    def get_manifest(self, host, fingerprint):
+        """Get the manifest of the directory structure synced to the host.
+
+        :param host: hostname of the test node
+        :type host: str
+        :param fingerprint: fingerprint reported by the test node
+        :type fingerprint: str
+
+        :return: `dict` manifest or None if the test node state is unknown
+        :rtype: dict
+        """
+        if fingerprint and self.hosts.get(host) == fingerprint:
+            return self.manifests.get(fingerprint)
+        return None
+
+    def update(self, hosts, fingerprint, manifest):
+        """Remember the directory structure synced to the hosts.
+
+        :param hosts: hostnames of the synced test nodes
+        :type hosts: iterable
+        :param fingerprint: fingerprint of the synced directory structure
+        :type fingerprint: str
+        :param manifest: manifest of the synced directory structure
+        :type manifest: dict
+        """
+        for host in hosts:
+            self.hosts[host] = fingerprint
+        self.manifests[fingerprint] = manifest
+        used = set(self.hosts.values())
+        self.cache.set(
+            self.key,
+            dict(
+                hosts=self.hosts,
+                manifests=dict(
+                    (key, value) for key, value in self.manifests.items() if key in used
+                ),
+            ),
+        )
+
+
+# pylint: disable=R0205
+class CapabilitiesCache(object):
+    """Capabilities of the test nodes detected by the previous test runs."""
+
+    key = "cloud/capabilities"
+
+    def __init__(self, cache, ttl):
+        """Initialize new CapabilitiesCache instance.
+
+        :param cache: pytest cache
+        :type cache: _pytest.cacheprovider.Cache
+        :param ttl: time the capabilities are considered up to date, in seconds
+        :type ttl: float
+        """
+        self.cache = cache
+        self.ttl = ttl
+        self.hosts = self.cache.get(self.key, {})
+
+    def get(self, host):
+        """Get the capabilities of the test node, if they are up to date.
+
+        :param host: hostname of the test node
+        :type host: str
+
+        :return: `dict` of the test node capabilities or None
+        :rtype: dict
+        """
+        entry = self.hosts.get(host)
+        if entry and time.time() - entry["time"] < self.ttl:
+            return entry["caps"]
+        return None
+
+    def update(self, node_caps):
+        """Remember the capabilities of the test nodes.
+
+        The calibration benchmark score is kept from the previous detection if it's missing.
+
+        :param node_caps: `dict` of the test nodes capabilities in form {<hostname>: <capabilities>}
+        :type node_caps: dict
+        """
+        for host, caps in node_caps.items():
+            previous = self.hosts.get(host, {}).get("caps", {})
+            if caps.get("speed") is None and previous.get("speed"):
+                caps = dict(caps, speed=previous["speed"])
+            self.hosts[host] = dict(time=time.time(), caps=caps)
+        self.cache.set(self.key, self.hosts)
+
+
+DURATIONS_KEY = "cloud/durations"
+
+
+def get_durations(cache):
+    """Get the test durations recorded by the previous test runs.
+
+    :param cache: pytest cache
+    :type cache: _pytest.cacheprovider.Cache
+
+    :return: `dict` in form {<node id>: <duration in seconds>}
+    :rtype: dict
+    """
+    return cache.get(DURATIONS_KEY, {})
+
+
+def update_durations(cache, durations, collection=None):
+    """Record the test durations, keeping the durations of the tests which were not run.
+
+    :param cache: pytest cache
+    :type cache: _pytest.cacheprovider.Cache
+    :param durations: `dict` of the test durations in form {<node id>: <duration in seconds>}
+    :type durations: dict
+    :param collection: optional `list` of all the collected test node ids, durations of the other tests are dropped
+    :type collection: list
+    """
+    recorded = get_durations(cache)
+    recorded.update(durations)
+    if collection is not None:
+        collected = set(collection)
+        recorded = dict(
+            (nodeid, duration)
+            for nodeid, duration in recorded.items()
+            if nodeid in collected
+        )
+    cache.set(DURATIONS_KEY, recorded)
+
+
+MEMORY_KEY = "cloud/mem_per_process"
+
+
+def get_mem_per_process(cache):
+    """Get the memory per test process measured by the previous test runs.
+
+    :param cache: pytest cache
+    :type cache: _pytest.cacheprovider.Cache
+
+    :return: 95th percentile of the peak memory usage of the test processes in bytes, or None if not measured
+    :rtype: int
+    """
+    return cache.get(MEMORY_KEY, None)
+
+
+def set_mem_per_process(cache, mem_per_process):
+    """Remember the memory per test process measured by the test run.
+
+    :param cache: pytest cache
+    :type cache: _pytest.cacheprovider.Cache
+    :param mem_per_process: 95th percentile of the peak memory usage of the test processes in bytes
+    :type mem_per_process: int
+    """
+    cache.set(MEMORY_KEY, mem_per_process)
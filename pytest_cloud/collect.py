@@ -0,0 +1,162 @@
+"""Collection of the tests once per test run."""
+import heapq
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# environment variable with the path to write the collected test node ids to
+COLLECT_IDS_ENV = "PYTEST_CLOUD_COLLECT_IDS"
+
+
+# pylint: disable=R0205,R0903
+class CollectPlaceholder(object):
+    """Test item which was not collected by the test process, as its test file is collected by another one."""
+
+    def __init__(self, nodeid):
+        """Initialize new CollectPlaceholder instance.
+
+        :param nodeid: test node id
+        :type nodeid: str
+        """
+        self.nodeid = nodeid
+
+    def __repr__(self):
+        """Represent the placeholder."""
+        return "<CollectPlaceholder {0}>".format(self.nodeid)
+
+
+def get_test_file(nodeid):
+    """Get the test file of the test.
+
+    :param nodeid: test node id
+    :type nodeid: str
+
+    :return: path to the test file, relative to the root dir
+    :rtype: str
+    """
+    return nodeid.split("::")[0]
+
+
+def start_collection(config):
+    """Start collecting the test node ids in the subprocess with the same arguments.
+
+    Executed on the master node side.
+
+    :param config: pytest config object
+    :type config: pytest.Config
+
+    :return: collecting subprocess and path to the file the test node ids are written to
+    :rtype: tuple
+    """
+    params = getattr(config, "invocation_params", None)
+    args = list(params.args) if params else sys.argv[1:]
+    handle, path = tempfile.mkstemp(prefix="pytest-cloud-", suffix=".json")
+    os.close(handle)
+    env = dict(os.environ)
+    env[COLLECT_IDS_ENV] = path
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "pytest", "--collect-only", "-q"] + args,
+            cwd=str(params.dir) if params else None,
+            env=env,
+            stdout=devnull,
+            stderr=devnull,
+        )
+    return process, path
+
+
+def finish_collection(process, path):
+    """Wait for the collecting subprocess to finish.
+
+    Executed on the master node side.
+
+    :param process: collecting subprocess
+    :type process: subprocess.Popen
+    :param path: path to the file the test node ids are written to
+    :type path: str
+
+    :return: `list` of the collected test node ids, None if the collection failed
+    :rtype: list
+    """
+    try:
+        process.wait()
+        with open(path) as fd:
+            return json.load(fd)
+    except ValueError:
+        # nothing was written, the collection failed
+        return None
+    finally:
+        os.remove(path)
+
+
+def write_collection(session):
+    """Write the collected test node ids for the master, if collecting in the subprocess.
+
+    :param session: pytest session
+    :type session: pytest.Session
+    """
+    path = os.environ.get(COLLECT_IDS_ENV)
+    if path:
+        with open(path, "w") as fd:
+            json.dump([item.nodeid for item in session.items], fd)
+
+
+def get_collect_files(ids, worker_ids):
+    """Partition the test files among the test processes of each test node, balanced by the number of tests.
+
+    :param ids: `list` of the collected test node ids
+    :type ids: list
+    :param worker_ids: `list` of the test process ids in form [<hostname>_<index>, ...]
+    :type worker_ids: list
+
+    :return: `dict` in form {<test process id>: [<test file>, ...]}
+    :rtype: dict
+    """
+    counts = {}
+    for nodeid in ids:
+        path = get_test_file(nodeid)
+        counts[path] = counts.get(path, 0) + 1
+    paths = sorted(counts, key=lambda path: (-counts[path], path))
+    hosts = {}
+    for worker_id in worker_ids:
+        hosts.setdefault(worker_id.rsplit("_", 1)[0], []).append(worker_id)
+    files = dict((worker_id, []) for worker_id in worker_ids)
+    for workers in hosts.values():
+        loads = [(0, worker_id) for worker_id in workers]
+        for path in paths:
+            load, worker_id = heapq.heappop(loads)
+            files[worker_id].append(path)
+            heapq.heappush(loads, (load + counts[path], worker_id))
+    return files
+
+
+def collect_files(session, files):
+    """Collect only the given test files.
+
+    Executed on the remote side.
+
+    :param session: pytest session
+    :type session: pytest.Session
+    :param files: `list` of the test files relative to the root dir
+    :type files: list
+    """
+    rootdir = session.config.rootdir
+    session.perform_collect([str(rootdir.join(path)) for path in files])
+
+
+def fill_collection(session, ids):
+    """Fill the collection up to the collection of the master, so the test indices match.
+
+    Executed on the remote side.
+
+    :param session: pytest session
+    :type session: pytest.Session
+    :param ids: `list` of the test node ids collected by the master
+    :type ids: list
+    """
+    items = dict((item.nodeid, item) for item in session.items)
+    session.items[:] = [
+        items.get(nodeid) or CollectPlaceholder(nodeid) for nodeid in ids
+    ]
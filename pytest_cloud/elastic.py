@@ -0,0 +1,73 @@
+"""Elastic test node pool."""
+import threading
+
+
+# pylint: disable=R0205
+class ElasticPool(object):
+    """Test nodes which were not connectable at the start of the test run, retried in the background.
+
+    Once some of them are set up, their test gateway specs are sent to the DSession as `cloud_addnodes` event, so the
+    test processes are started from the DSession loop. The test nodes are set up under the lock, which is shared by
+    the pools, as setting them up records the state of the test run on the pytest config.
+    """
+
+    # pylint: disable=R0913
+    def __init__(self, nodes, get_specs, putevent, interval, attempts=None, lock=None):
+        """Initialize new ElasticPool instance.
+
+        :param nodes: `list` of node names in form [[<username>@]<hostname>, ...]
+        :type nodes: list
+        :param get_specs: function to set up the test nodes, it gets the `list` of node names and returns
+            the `list` of test gateway specs and the `list` of the node names which are still not connectable
+        :type get_specs: callable
+        :param putevent: function to put the event to the DSession queue
+        :type putevent: callable
+        :param interval: time between the retries, in seconds
+        :type interval: float
+        :param attempts: optional maximum number of the retries, unlimited by default
+        :type attempts: int
+        :param lock: optional lock to set up the test nodes under, shared with the other pools
+        :type lock: threading.Lock
+        """
+        self.nodes = list(nodes)
+        self.get_specs = get_specs
+        self.putevent = putevent
+        self.interval = interval
+        self.attempts = attempts
+        self.lock = lock or threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start retrying the test nodes in the background."""
+        self.thread = threading.Thread(target=self.run, name="pytest-cloud-elastic")
+        # daemon thread does not block the interpreter exit on hanging ssh connections
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop retrying the test nodes."""
+        self.stopped.set()
+
+    def run(self):
+        """Retry the test nodes until all of them are set up, the attempts are exhausted or the pool is stopped."""
+        attempt = 0
+        while (
+            self.nodes
+            and (self.attempts is None or attempt < self.attempts)
+            and not self.stopped.wait(self.interval)
+        ):
+            attempt += 1
+            self.retry()
+
+    def retry(self):
+        """Try to set up the test nodes once."""
+        try:
+            with self.lock:
+                specs, unreachable = self.get_specs(self.nodes)
+        except Exception:  # pylint: disable=W0703
+            # none of the test nodes is connectable yet
+            return
+        self.nodes = [node for node in self.nodes if node in unreachable]
+        if specs and not self.stopped.is_set():
+            self.putevent(("cloud_addnodes", dict(specs=specs)))
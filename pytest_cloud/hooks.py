@@ -0,0 +1,14 @@
+"""Hook specifications of pytest-cloud."""
+
+
+def pytest_cloud_timings(config, timings):
+    """Called on the master at the end of the test run with the timings of the test run phases.
+
+    Phases are the test nodes connection, sync, virtualenv build and activation, capabilities detection, test
+    processes startup, collection and tests execution.
+
+    :param config: pytest config object
+    :type config: pytest.Config
+    :param timings: timings report, see `pytest_cloud.timings.Timings.get_report`
+    :type timings: dict
+    """
@@ -1,10 +1,21 @@
 """Monkey patches."""
 
 import os
+import time
+
+import execnet
+from execnet.gateway_base import Message, dumps_internal
 import xdist
-from xdist import workermanage
+from xdist import dsession, workermanage
 
+from .aggregate import DEFAULT_INTERVAL, Aggregator
 from .rsync import make_reltoroot
+from .scheduler import get_host
+
+# crashed test process handler of the DSession, used for the test nodes which are not lost
+worker_errordown_crashed = dsession.DSession.worker_errordown
+# test report handler of the DSession, used for the accepted test reports
+worker_testreport_accepted = dsession.DSession.worker_testreport
 
 
 # pylint: disable=R0913,W0613
@@ -32,10 +43,21 @@ def rsync(self, gateway, source, notify=None, verbose=False, ignores=None):
     )
 
 
-def activate_env(channel, virtualenv_path, develop_eggs=None):
+# pylint: disable=R0914,R0912
+def activate_env(
+    channel,
+    virtualenv_path,
+    develop_eggs=None,
+    bytecode="purge",
+    cache_dir="~/.cache/pytest-cloud/develop-eggs",
+):
     """Activate virtual environment.
 
     Executed on the remote side.
+    Develop eggs are installed only if their metadata files changed since the last install, or if the links to them
+    in the virtualenv were changed. The installed develop eggs are recorded in the cache directory, out of the synced
+    directory structure.
+    Sends back the timings of the steps taken in form {<step>: <seconds>}.
 
     :param channel: execnet channel for communication with master node
     :type channel: execnet.gateway_base.Channel
@@ -43,13 +65,28 @@ def activate_env(channel, virtualenv_path, develop_eggs=None):
     :type virtualenv_path: str
     :param develop_eggs: optional list of python packages to be installed in develop mode
     :type develop_eggs: list
+    :param bytecode: bytecode handling mode: `purge` to delete all the bytecode, `keep` to keep it, as it's
+        invalidated by the source modification time which is preserved by the sync, `compile` to also precompile
+        the changed modules in parallel
+    :type bytecode: str
+    :param cache_dir: path to the directory to record the installed develop eggs in, per virtualenv
+    :type cache_dir: str
     """
+    import glob  # pylint: disable=C0415
+    import hashlib  # pylint: disable=C0415
+    import json  # pylint: disable=C0415
     import os.path  # pylint: disable=W0404,C0415
+    import re  # pylint: disable=C0415
     import sys  # pylint: disable=W0404,C0415
     import subprocess  # pylint: disable=W0404,C0415
+    import time  # pylint: disable=W0404,C0415
     from itertools import chain  # pylint: disable=W0404,C0415
 
-    subprocess.check_call(["find", ".", "-name", "*.pyc", "-delete"])
+    timings = {}
+    if bytecode == "purge":
+        start = time.time()
+        subprocess.check_call(["find", ".", "-name", "*.pyc", "-delete"])
+        timings["bytecode_purge"] = time.time() - start
     if virtualenv_path:
         if develop_eggs:
             python_script = os.path.abspath(
@@ -58,43 +95,451 @@ def activate_env(channel, virtualenv_path, develop_eggs=None):
             pip_script = os.path.abspath(
                 os.path.normpath(os.path.join(virtualenv_path, "bin", "pip"))
             )
-            egg = None
-            args = (
-                python_script,
-                pip_script,
-                "install",
-                "--no-index",
-                "--no-deps",
-            ) + tuple(chain.from_iterable([("-e", egg) for egg in develop_eggs]))
-            subprocess.check_call(args)
+            cache_dir = os.path.expanduser(cache_dir)
+            marker_path = os.path.join(
+                cache_dir,
+                hashlib.sha1(
+                    os.path.abspath(virtualenv_path).encode("utf-8")
+                ).hexdigest(),
+            )
+            try:
+                with open(marker_path) as fd:
+                    marker = json.load(fd)
+            except (IOError, ValueError):
+                marker = {}
+            links_pattern = os.path.join(
+                virtualenv_path, "lib", "*", "site-packages", "*"
+            )
+            # links to the develop eggs are checked by content, as the sync may overwrite them
+            digest = hashlib.sha1()
+            for path in sorted(glob.glob(links_pattern)):
+                if path.endswith((".pth", ".egg-link")):
+                    with open(path, "rb") as fd:
+                        digest.update(path.encode("utf-8") + b"\0" + fd.read())
+            installed = marker.get("eggs", {})
+            if marker.get("links") != digest.hexdigest():
+                installed = {}
+            fingerprints = {}
+            changed = []
+            for egg in develop_eggs:
+                digest = hashlib.sha1()
+                for name in ("setup.py", "setup.cfg", "pyproject.toml"):
+                    path = os.path.join(egg, name)
+                    if os.path.exists(path):
+                        with open(path, "rb") as fd:
+                            digest.update(
+                                name.encode("utf-8") + b"\0" + fd.read() + b"\0"
+                            )
+                fingerprints[egg] = digest.hexdigest()
+                if installed.get(egg) != fingerprints[egg]:
+                    changed.append(egg)
+            if changed:
+                start = time.time()
+                args = (
+                    python_script,
+                    pip_script,
+                    "install",
+                    "--no-index",
+                    "--no-deps",
+                ) + tuple(chain.from_iterable([("-e", egg) for egg in changed]))
+                subprocess.check_call(args)
+                timings["develop_eggs"] = time.time() - start
+                installed.update(fingerprints)
+                digest = hashlib.sha1()
+                for path in sorted(glob.glob(links_pattern)):
+                    if path.endswith((".pth", ".egg-link")):
+                        with open(path, "rb") as fd:
+                            digest.update(path.encode("utf-8") + b"\0" + fd.read())
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(marker_path, "w") as fd:
+                    json.dump(dict(eggs=installed, links=digest.hexdigest()), fd)
 
         activate_script = os.path.abspath(
             os.path.normpath(os.path.join(virtualenv_path, "bin", "activate_this.py"))
         )
         exec(open(activate_script).read(), {'__file__': activate_script})
 
+    if bytecode == "compile":
+        start = time.time()
+        python_script = sys.executable
+        args = []
+        if virtualenv_path:
+            python_script = os.path.abspath(
+                os.path.normpath(os.path.join(virtualenv_path, "bin", "python"))
+            )
+            if not os.path.isabs(virtualenv_path):
+                # virtualenv is compiled by pip already
+                args = ["-x", "^" + re.escape(os.path.join(".", virtualenv_path, ""))]
+        # compileall skips the modules with the up to date bytecode, the exit code is ignored as the tests
+        # may contain modules which are not supposed to compile
+        subprocess.call(
+            [python_script, "-m", "compileall", "-q", "-j", "0"] + args + ["."]
+        )
+        timings["bytecode_compile"] = time.time() - start
+    channel.send(timings)
+
+
+def build_virtualenv(channel, requirements, fingerprint, cache_dir):
+    """Build the virtualenv with given requirements, or reuse the one already built.
+
+    Executed on the remote side.
+    Virtualenvs are kept in the cache directory under the key made of the requirements fingerprint and
+    the interpreter version, so the test nodes which already have the matching virtualenv skip building it.
+    Sends the absolute path of the virtualenv back.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    :param requirements: `list` of requirements files contents in form [(<file name>, <content>), ...]
+    :type requirements: list
+    :param fingerprint: fingerprint of the requirements
+    :type fingerprint: str
+    :param cache_dir: path to the directory to keep the virtualenvs in on the remote test node
+    :type cache_dir: str
+    """
+    import fcntl  # pylint: disable=C0415
+    import hashlib  # pylint: disable=C0415
+    import os.path  # pylint: disable=W0404,C0415
+    import platform  # pylint: disable=C0415
+    import shutil  # pylint: disable=C0415
+    import subprocess  # pylint: disable=W0404,C0415
+    import sys  # pylint: disable=W0404,C0415
+
+    key = hashlib.sha1(
+        "\n".join([fingerprint, sys.version, platform.machine()]).encode("utf-8")
+    ).hexdigest()
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, key)
+    complete_marker = os.path.join(path, ".pytest-cloud-complete")
+    # other test runs may be building the same virtualenv at the same time
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(complete_marker):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            subprocess.check_call([sys.executable, "-m", "virtualenv", path])
+            pip_script = os.path.join(path, "bin", "pip")
+            for name, content in requirements:
+                requirements_path = os.path.join(path, name)
+                with open(requirements_path, "w") as fd:
+                    fd.write(content)
+                subprocess.check_call(
+                    [
+                        os.path.join(path, "bin", "python"),
+                        pip_script,
+                        "install",
+                        "-r",
+                        requirements_path,
+                    ]
+                )
+            open(complete_marker, "w").close()
+    channel.send(path)
+
+
+def start_zygote(channel, python, script, modules):
+    """Start the zygote process which preloads the modules once and forks the test processes.
+
+    Executed on the remote side.
+    The zygote is started in the current (activated) environment, in its own session, so it survives the detection
+    gateway, and exits on its own when it has no test processes left.
+    Sends back the command to use as the python executable of the test processes, or None if the zygote failed.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    :param python: python executable of the test processes, its path relative to the home directory, or its name
+        to look up in PATH
+    :type python: str
+    :param script: source code of the zygote script
+    :type script: str
+    :param modules: `list` of the module names to preload
+    :type modules: list
+    """
+    import os.path  # pylint: disable=W0404,C0415
+    import shutil  # pylint: disable=C0415
+    import subprocess  # pylint: disable=W0404,C0415
+    import tempfile  # pylint: disable=C0415
+    import time  # pylint: disable=C0415
+
+    if os.path.sep not in python:
+        python = shutil.which(python) or python
+    elif not os.path.isabs(python):
+        python = os.path.join(os.path.expanduser("~"), python)
+    directory = tempfile.mkdtemp(prefix="pytest-cloud-zygote-")
+    script_path = os.path.join(directory, "zygote.py")
+    with open(script_path, "w") as fd:
+        fd.write(script)
+    path = os.path.join(directory, "zygote.sock")
+    try:
+        with open(os.devnull, "r+") as devnull:
+            process = subprocess.Popen(
+                [python, script_path, "serve", path] + list(modules),
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull,
+                close_fds=True,
+                start_new_session=True,
+            )
+    except (IOError, OSError):
+        shutil.rmtree(directory, ignore_errors=True)
+        channel.send(None)
+        return
+    # the socket is bound once the modules are preloaded
+    while not os.path.exists(path) and process.poll() is None:
+        time.sleep(0.1)
+    if process.poll() is not None:
+        shutil.rmtree(directory, ignore_errors=True)
+        channel.send(None)
+        return
+    channel.send("{0} -S {1} connect {2}".format(python, script_path, path))
+
+
+def get_worker_options(config):
+    """Get the options to send to the test workers, as a diff from the option defaults.
+
+    Test workers parse the same arguments, so the options which have their default values are not sent. Computed once
+    per test run.
+
+    :param config: pytest config object
+    :type config: pytest.Config
+
+    :return: `dict` of the options which differ from their defaults
+    :rtype: dict
+    """
+    options = getattr(config, "_cloud_worker_options", None)
+    if options is None:
+        option_dict = vars(config.option)
+        try:
+            defaults = vars(config._parser.parse([]))  # pylint: disable=W0212
+        except (Exception, SystemExit):  # pylint: disable=W0703
+            # the full option namespace is sent
+            defaults = {}
+        missing = object()
+        # older xdist versions extend the plugins option on the worker side
+        options = config._cloud_worker_options = dict(
+            (name, value)
+            for name, value in option_dict.items()
+            if name == "plugins" or defaults.get(name, missing) != value
+        )
+    return options
+
+
+def get_worker_args(config, roots):
+    """Get the arguments to send to the test workers, relative to the root dirs.
+
+    Computed once per test run.
+
+    :param config: pytest config object
+    :type config: pytest.Config
+    :param roots: `list` of the root dirs
+    :type roots: list
+
+    :return: `list` of the arguments
+    :rtype: list
+    """
+    args = getattr(config, "_cloud_worker_args", None)
+    if args is None:
+        args = config._cloud_worker_args = make_reltoroot(roots, config.args)
+    return args
+
 
 def setup(self):
-    """Set up a new test worker."""
+    """Set up a new test worker.
+
+    The handshake carries the options which differ from their defaults only. Its size and serialization time are
+    recorded for the terminal summary.
+    """
     self.log("setting up worker session")
     spec = self.gateway.spec
     args = self.config.args
     if not spec.popen or spec.chdir:
-        args = make_reltoroot(self.nodemanager.roots, args)
-    option_dict = vars(self.config.option)
+        args = get_worker_args(self.config, self.nodemanager.roots)
+    option_dict = get_worker_options(self.config)
     if spec.popen and not spec.via:
         name = "popen-%s" % self.gateway.id
         basetemp = self.config._tmpdirhandler.getbasetemp()
-        option_dict["basetemp"] = str(basetemp.join(name))
+        option_dict = dict(option_dict, basetemp=str(basetemp.join(name)))
     self.config.hook.pytest_configure_node(node=self)
     self.channel = self.gateway.remote_exec(xdist.remote)
     if self.putevent:
         self.channel.setcallback(self.process_from_remote, endmarker=self.ENDMARK)
-    self.channel.send((self.workerinput, args, option_dict, None))
+    start = time.time()
+    data = dumps_internal((self.workerinput, args, option_dict, None))
+    if not hasattr(self.config, "_cloud_handshake"):
+        self.config._cloud_handshake = dict(count=0, size=0, seconds=0.0)
+    stats = self.config._cloud_handshake
+    stats["count"] += 1
+    stats["size"] += len(data)
+    stats["seconds"] += time.time() - start
+    # same as channel.send, serialized once
+    self.gateway._send(  # pylint: disable=W0212
+        Message.CHANNEL_DATA, self.channel.id, data
+    )
+
+
+def handoff_gateway(config, group, gateway, worker_id):
+    """Hand off the gateway to the test worker with given id.
+
+    The gateway is detached from the group, so that it survives the group termination, and stays alive until the
+    worker with given id is set up.
+
+    :param config: pytest config object
+    :type config: pytest.Config
+    :param group: execnet group the gateway belongs to
+    :type group: execnet.Group
+    :param gateway: gateway to hand off
+    :type gateway: execnet.gateway.Gateway
+    :param worker_id: id of the worker to reuse the gateway
+    :type worker_id: str
+    """
+    # pylint: disable=W0212
+    group._gateways.remove(gateway)
+    del gateway._group
+    gateway.id = worker_id
+    if not hasattr(config, "_cloud_gateways"):
+        config._cloud_gateways = {}
+    config._cloud_gateways[worker_id] = gateway
+
+
+def close_handoff_gateways(config):
+    """Close the handed off gateways which were not taken by any test worker."""
+    gateways = getattr(config, "_cloud_gateways", {})
+    while gateways:
+        _, gateway = gateways.popitem()
+        try:
+            gateway.exit()
+            gateway.join(timeout=workermanage.NodeManager.EXIT_TIMEOUT)
+        except Exception:  # pylint: disable=W0703
+            pass
+
+
+def start_aggregator(self, host):
+    """Start the aggregator of the test process events of the test node.
+
+    :param host: hostname of the test node
+    :type host: str
+
+    :return: aggregator of the test node
+    :rtype: pytest_cloud.aggregate.Aggregator
+    """
+    gateway = self.group.makegateway(self.config._cloud_aggregator_specs[host])
+    if not hasattr(self.config, "_cloud_aggregators"):
+        self.config._cloud_aggregators = {}
+    aggregator = self.config._cloud_aggregators[host] = Aggregator(
+        gateway, DEFAULT_INTERVAL
+    )
+    return aggregator
+
+
+def close_aggregators(config):
+    """Stop the aggregators of the test process events."""
+    aggregators = getattr(config, "_cloud_aggregators", {})
+    while aggregators:
+        _, aggregator = aggregators.popitem()
+        aggregator.close()
+
+
+def setup_node(self, spec, putevent):
+    """Set up a new test node reusing the handed off gateway if there's one for the node.
+
+    Test nodes started via the aggregator of their test node get the aggregator started first.
+    """
+    if (
+        getattr(spec, "execmodel", None) is None
+        and self.group.execmodel.backend == "main_thread_only"
+    ):
+        spec = execnet.XSpec("execmodel=main_thread_only//{0}".format(spec))
+    aggregator = None
+    if spec.via:
+        aggregator = getattr(self.config, "_cloud_aggregators", {}).get(spec.via)
+        if aggregator is None or aggregator.closed:
+            if aggregator is not None:
+                # the test node is set up again after all its test processes went down
+                aggregator.gateway.exit()
+            aggregator = start_aggregator(self, spec.via)
+    gateway = getattr(self.config, "_cloud_gateways", {}).pop(spec.id, None)
+    if gateway is None:
+        gw = self.group.makegateway(spec)
+    else:
+        gw = gateway
+        gw.spec = spec
+        self.group._register(gw)  # pylint: disable=W0212
+    self.config.hook.pytest_xdist_newgateway(gateway=gw)
+    self.rsync_roots(gw)
+    node = workermanage.WorkerController(self, gw, self.config, putevent)
+    # keep the node alive
+    gw.node = node
+    if aggregator is not None:
+        aggregator.add_node(node)
+    node.setup()
+    self.trace("started node %r" % node)
+    return node
+
+
+def add_nodes(self, specs):
+    """Start the test processes on the test nodes which were set up during the test run.
+
+    Handles `cloud_addnodes` event put to the DSession queue by the elastic test node pool.
+    """
+    if self.shuttingdown:
+        return
+    self.report_line(
+        "pytest-cloud: adding {0} test processes: {1}".format(
+            len(specs), ", ".join(execnet.XSpec(spec).id for spec in specs)
+        )
+    )
+    for spec in specs:
+        node = self.nodemanager.setup_node(execnet.XSpec(spec), self.queue.put)
+        self._active_nodes.add(node)  # pylint: disable=W0212
+
+
+def worker_errordown(self, node, error):
+    """Handle the test process which went down with an error.
+
+    When the test node the test process runs on is lost, its tests, the running one included, are sent to the test
+    processes of the other test nodes, and the test process is not replaced, so the test node is quarantined for
+    the rest of the session. The test process stopped by the scheduler is removed quietly. Otherwise the test process
+    is handled as crashed.
+    """
+    cloud = self.config.pluginmanager.getplugin("cloudxdist")
+    # the test process was stopped by the scheduler as it ran only the copy of the test which lost
+    abandoned = node in getattr(self.sched, "abandoned", ())
+    if not abandoned and (
+        self.shuttingdown
+        or cloud is None
+        or not hasattr(self.sched, "remove_lost_node")
+        or not cloud.is_lost(node)
+    ):
+        return worker_errordown_crashed(self, node, error)
+    if not abandoned:
+        self.report_line(
+            "pytest-cloud: test node {0} is lost, sending the tests of {1} to the other test nodes".format(
+                get_host(node), node.gateway.id
+            )
+        )
+    self.config.hook.pytest_testnodedown(node=node, error=error)
+    if node in self.sched.nodes:
+        self.sched.remove_lost_node(node)
+    # unregister the gateway, so the test node can be connected again under the same id
+    node.gateway.exit()
+    self._active_nodes.remove(node)  # pylint: disable=W0212
+    return None
+
+
+def worker_testreport(self, node, rep):
+    """Handle the test report, unless the scheduler drops it as the report of the test copy which lost."""
+    accept_report = getattr(self.sched, "accept_report", None)
+    if accept_report is None or accept_report(node, rep):
+        worker_testreport_accepted(self, node, rep)
 
 
 def apply_patches():
     """Apply monkey patches."""
     workermanage.make_reltoroot = make_reltoroot
     workermanage.NodeManager.rsync = rsync
+    workermanage.NodeManager.setup_node = setup_node
     workermanage.WorkerController.setup = setup
+    dsession.DSession.worker_cloud_addnodes = add_nodes
+    dsession.DSession.worker_errordown = worker_errordown
+    dsession.DSession.worker_testreport = worker_testreport
@@ -5,17 +5,19 @@ Provides an easy way of running tests amoung several test nodes (workers).
 from __future__ import division
 
 import argparse
+import functools
+import hashlib
+import importlib
 import sys
 
 try:
     from itertools import filterfalse  # pylint: disable=E0611
 except ImportError:
     from itertools import ifilterfalse as filterfalse  # pylint: disable=E0611
-from itertools import chain
 import math
 import os.path
-
-import timeout_decorator
+import threading
+import time
 
 import execnet
 from xdist.workermanage import (
@@ -25,24 +27,427 @@ import six
 
 import pytest
 
+from .aggregate import EventForwarder
+from .cache import (
+    CapabilitiesCache,
+    SyncCache,
+    get_cache,
+    get_durations,
+    get_mem_per_process,
+    set_mem_per_process,
+    update_durations,
+)
+from .collect import (
+    collect_files,
+    fill_collection,
+    finish_collection,
+    get_collect_files,
+    start_collection,
+    write_collection,
+)
+from .elastic import ElasticPool
 from .rsync import RSync
-from . import patches
+from .scheduler import SPECULATIVE_MARKER, CloudLoadScheduling, get_host
+from .ssh import SSHMultiplexer
+from .timings import Timings, write_report
+from .sync import (
+    SYNC_MARKER,
+    ExecnetSync,
+    get_fingerprint,
+    get_manifest,
+    is_empty,
+    read_sync_marker,
+    send_archive,
+    write_sync_marker,
+)
+from . import hooks, patches, zygote
+
+DEFAULT_CONNECT_TIMEOUT = 3
+# time the test node found connectable is not probed again when its test processes crash, in seconds
+REACHABLE_TTL = 30
+DEFAULT_VIRTUALENV_CACHE_DIR = "~/.cache/pytest-cloud/virtualenvs"
+DEFAULT_DEVELOP_EGGS_CACHE_DIR = "~/.cache/pytest-cloud/develop-eggs"
+# bytecode on the test nodes which is kept between the syncs unless purged
+BYTECODE_PATTERNS = ["*.pyc", "__pycache__/"]
+# links to the develop eggs in the virtualenv, made on the test nodes instead of synced, as they point to the local paths
+DEVELOP_LINK_PATTERNS = ["*.egg-link", "easy-install.pth", "__editable__*"]
+# modules every test process imports, preloaded by the zygote in addition to the configured ones
+ZYGOTE_PRELOAD = ["pytest", "xdist.remote"]
 
 
-# pylint: disable=R0903,R0205
+# pylint: disable=R0205
 class CloudXdistPlugin(object):
     """Plugin class to defer pytest-xdist hook handler."""
 
+    def __init__(self):
+        """Initialize new CloudXdistPlugin instance."""
+        self.scheduler = None
+        # test durations of the current run, setup and teardown included
+        self.durations = {}
+        # peak memory usage of the test processes, in bytes
+        self.maxrss = []
+        # test nodes retried in the background, set up one pool at a time
+        self.elastic_pools = []
+        self.elastic_lock = threading.Lock()
+        # test nodes lost during the test run
+        self.lost_hosts = set()
+        # times the test nodes were last found connectable at in form {<hostname>: <time>}
+        self.reachable_hosts = {}
+        # times the test processes reached the phases at in form {<test process id>: <time>}
+        self.node_started = {}
+        self.node_ready = {}
+        self.node_collected = {}
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_xdist_make_scheduler(self, config, log):
+        """Make the scheduler aware of the test nodes differences for the load distribution."""
+        if config.getvalue("dist") == "load":
+            cache = get_cache(config) if config.option.cloud_longest_first else None
+            self.scheduler = CloudLoadScheduling(
+                config,
+                log,
+                speeds=getattr(config, "_cloud_node_speeds", None),
+                durations=get_durations(cache) if cache is not None else None,
+                retire_slow=config.option.cloud_elastic,
+                speculate=config.option.cloud_speculate,
+                affinity=config.option.cloud_host_affinity,
+                collected=dict(
+                    (worker_id, set(files))
+                    for worker_id, files in getattr(
+                        config, "_cloud_collect_files", {}
+                    ).items()
+                ),
+            )
+            return self.scheduler
+        return None
+
+    def get_specs(self, config, nodes):
+        """Set up the test nodes during the test run.
+
+        :param config: pytest config object
+        :type config: pytest.Config
+        :param nodes: `list` of node names in form [[<username>@]<hostname>, ...]
+        :type nodes: list
+
+        :return: `list` of test gateway specs and `list` of node names which are still not connectable
+        :rtype: tuple
+        """
+        # the test run output is not interrupted by the test nodes set up in the background
+        kwargs = dict(
+            config._cloud_nodes_kwargs,
+            reuse_gateways=False,
+            ssh_multiplex=False,
+            quiet=True,
+        )
+        try:
+            specs = get_nodes_specs(nodes, **kwargs)
+        except pytest.exit.Exception:
+            # none of the test nodes is connectable or able to serve as a test node
+            return [], nodes
+        for node in nodes:
+            if node not in config._cloud_unreachable:
+                self.lost_hosts.discard(node.split("@")[1] if "@" in node else node)
+        return specs, config._cloud_unreachable
+
+    def start_elastic_pool(self, config, nodes, attempts=None):
+        """Start retrying the test nodes in the background, adding them to the test run once they are set up."""
+        pool = ElasticPool(
+            nodes,
+            functools.partial(self.get_specs, config),
+            config.pluginmanager.getplugin("dsession").queue.put,
+            config.option.cloud_elastic_interval,
+            attempts=attempts,
+            lock=self.elastic_lock,
+        )
+        self.elastic_pools.append(pool)
+        pool.start()
+
+    def is_lost(self, node):
+        """Check if the test node the test process runs on is lost, quarantining it then.
+
+        Test node is lost if it does not accept the connection anymore. Lost test node is connected again in
+        the background if the reconnect attempts are given. The connection is probed from the DSession loop, so
+        the test node found connectable is not probed again for a while, as its test processes crashing one after
+        another is not a sign of it being lost.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+
+        :return: True if the test node is lost
+        :rtype: bool
+        """
+        host = get_host(node)
+        if host in self.lost_hosts:
+            return True
+        if time.time() - self.reachable_hosts.get(host, 0) < REACHABLE_TTL:
+            return False
+        config = node.config
+        spec = node.gateway.spec
+        if spec.via:
+            spec = execnet.XSpec(config._cloud_aggregator_specs[spec.via])
+        group = execnet.Group()
+        try:
+            connected = make_gateways(
+                group,
+                ["ssh={0}//id={1}//python={2}".format(spec.ssh, host, spec.python)],
+                timeout=config.option.cloud_connect_timeout,
+            )
+        finally:
+            try:
+                group.terminate()
+            except Exception:  # pylint: disable=W0703
+                pass
+        if connected:
+            self.reachable_hosts[host] = time.time()
+            return False
+        self.lost_hosts.add(host)
+        attempts = config.option.cloud_reconnect_attempts
+        nodes = [
+            name
+            for name in config.option.cloud_nodes
+            if (name.split("@")[1] if "@" in name else name) == host
+        ]
+        if attempts and nodes:
+            self.start_elastic_pool(config, nodes, attempts=attempts)
+        return True
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_sessionstart(self, session):
+        """Start retrying the test nodes which were not connectable, once the test processes are started."""
+        config = session.config
+        unreachable = getattr(config, "_cloud_unreachable", None)
+        if (
+            config.option.cloud_elastic
+            and unreachable
+            and config.pluginmanager.getplugin("dsession")
+        ):
+            self.start_elastic_pool(config, unreachable)
+
+    def pytest_configure_node(self, node):
+        """Tell the test process which test files to collect if the tests were collected once.
+
+        Tell the test process where to send the events to if they are aggregated.
+        """
+        files = getattr(node.config, "_cloud_collect_files", {}).get(node.gateway.id)
+        if files is not None:
+            node.workerinput["cloud_collect_ids"] = node.config._cloud_collect_ids
+            node.workerinput["cloud_collect_files"] = files
+        node.workerinput["cloud_report_rss"] = True
+        aggregator = getattr(node.config, "_cloud_aggregators", {}).get(get_host(node))
+        if aggregator is not None:
+            node.workerinput["cloud_aggregator"] = aggregator.path
+
+    def pytest_xdist_newgateway(self, gateway):
+        """Record the time the test process startup began at."""
+        self.node_started[gateway.id] = time.time()
+
+    def pytest_testnodeready(self, node):
+        """Record the time the test process took to start."""
+        self.add_node_timing(node, "worker_startup", self.node_started, self.node_ready)
+
+    def pytest_xdist_node_collection_finished(self, node, ids):
+        """Record the time the test process took to collect the tests."""
+        self.add_node_timing(node, "collection", self.node_ready, self.node_collected)
+
+    def add_node_timing(self, node, phase, starts, ends=None):
+        """Add the span of the test process phase, which started at the time the previous phase ended.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+        :param phase: name of the phase
+        :type phase: str
+        :param starts: `dict` of the times the test processes started the phase at
+        :type starts: dict
+        :param ends: optional `dict` to record the time the test process ended the phase at
+        :type ends: dict
+        """
+        timings = getattr(node.config, "_cloud_timings", None)
+        worker_id = node.gateway.id
+        end = time.time()
+        if ends is not None:
+            ends[worker_id] = end
+        if timings is not None and worker_id in starts:
+            timings.add(phase, starts[worker_id], end, node=worker_id)
+
+    def pytest_testnodedown(self, node, error):
+        """Collect the peak memory usage reported by the test process.
+
+        Stop the aggregator of the test node once all its test processes are down.
+        """
+        self.add_node_timing(node, "test_execution", self.node_collected)
+        aggregator = getattr(node.config, "_cloud_aggregators", {}).get(get_host(node))
+        if aggregator is not None and all(
+            other._down for other in aggregator.nodes.values()  # pylint: disable=W0212
+        ):
+            aggregator.close()
+        workeroutput = getattr(node, "workeroutput", {})
+        if workeroutput.get("cloud_maxrss"):
+            self.maxrss.append(workeroutput["cloud_maxrss"])
+
+    def pytest_runtest_logreport(self, report):
+        """Collect the test durations reported by the test processes."""
+        self.durations[report.nodeid] = (
+            self.durations.get(report.nodeid, 0) + report.duration
+        )
+
+    def pytest_sessionfinish(self, session):
+        """Record the test durations for the following test runs and report the timings of the test run phases."""
+        for pool in self.elastic_pools:
+            pool.stop()
+        cache = get_cache(session.config)
+        if session.config.option.cloud_longest_first and cache is not None:
+            update_durations(
+                cache,
+                self.durations,
+                collection=self.scheduler.collection if self.scheduler else None,
+            )
+        if self.maxrss and cache is not None:
+            set_mem_per_process(cache, get_percentile(self.maxrss, 95))
+        timings = getattr(session.config, "_cloud_timings", None)
+        if timings is not None:
+            report = timings.get_report()
+            session.config.hook.pytest_cloud_timings(
+                config=session.config, timings=report
+            )
+            if session.config.option.cloud_timings:
+                write_report(report, session.config.option.cloud_timings)
+
+    def pytest_terminal_summary(self, terminalreporter, config):
+        """Report the makespan of the longest first schedule, the measured memory per process and the handshake size."""
+        if self.maxrss:
+            used = getattr(config, "_cloud_mem_per_process", None)
+            if used:
+                used = "{0} MB".format(int(math.ceil(used / 1024 / 1024)))
+            terminalreporter.write_line(
+                "pytest-cloud: recommended memory per process {0} MB, used {1}".format(
+                    int(math.ceil(get_percentile(self.maxrss, 95) / 1024 / 1024)),
+                    used or "none",
+                )
+            )
+        scheduler = self.scheduler
+        if (
+            scheduler
+            and scheduler.predicted_makespan is not None
+            and scheduler.finished
+        ):
+            terminalreporter.write_line(
+                "pytest-cloud: predicted makespan {0:.2f}s, actual {1:.2f}s".format(
+                    scheduler.predicted_makespan, scheduler.finished - scheduler.started
+                )
+            )
+        handshake = getattr(config, "_cloud_handshake", None)
+        if handshake:
+            terminalreporter.write_line(
+                "pytest-cloud: worker handshake {0:.1f} KB per test process ({1} of {2} options), "
+                "serialized in {3:.1f}ms for {4} test processes".format(
+                    handshake["size"] / handshake["count"] / 1024,
+                    len(config._cloud_worker_options),
+                    len(vars(config.option)),
+                    handshake["seconds"] * 1000,
+                    handshake["count"],
+                )
+            )
+
+
+def get_percentile(values, percent):
+    """Get the percentile of the values, using the nearest rank method.
+
+    :param values: `list` of the values
+    :type values: list
+    :param percent: percentile to get, from 0 to 100
+    :type percent: float
+
+    :return: the smallest value which is greater or equal to the given percent of the values
+    """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100 * len(values))) - 1)]
+
+
+def pytest_sessionfinish(session):
+    """Report the peak memory usage of the test process, unless it runs on windows."""
+    config = session.config
+    if getattr(config, "workerinput", {}).get("cloud_report_rss"):
+        try:
+            import resource  # pylint: disable=C0415
+        except ImportError:
+            return
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macos reports bytes
+        config.workeroutput["cloud_maxrss"] = (
+            maxrss if sys.platform == "darwin" else maxrss * 1024
+        )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection(session):
+    """Collect only the test files given by the master, if the tests were collected once."""
+    files = getattr(session.config, "workerinput", {}).get("cloud_collect_files")
+    if files is None:
+        return None
+    collect_files(session, files)
+    return True
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_finish(session):
+    """Pass the collected test node ids to the master, if the tests are collected once.
+
+    Test processes which collected only the given test files fill the collection up to the one of the master before
+    xdist reports it.
+    """
+    write_collection(session)
+    ids = getattr(session.config, "workerinput", {}).get("cloud_collect_ids")
+    if ids is not None:
+        fill_collection(session, ids)
+
+
+def pytest_addhooks(pluginmanager):
+    """Register pytest-cloud's hooks."""
+    pluginmanager.add_hookspecs(hooks)
+
 
 @pytest.mark.trylast
 def pytest_configure(config):
     """Register pytest-cloud's deferred plugin."""
+    config.addinivalue_line(
+        "markers",
+        "{0}: the test is safe to run more than once at the same time, "
+        "so its copy can be run on the idle test node (see --cloud-speculate)".format(
+            SPECULATIVE_MARKER
+        ),
+    )
+    path = getattr(config, "workerinput", {}).get("cloud_aggregator")
+    if path:
+        forward_events(config, path)
     if (
         getattr(config, "workerinput", {}).get("workerid", "local") == "local"
         and config.option.cloud_nodes
+        and not config.option.collectonly
         and config.pluginmanager.getplugin("xdist")
     ):
-        config.pluginmanager.register(CloudXdistPlugin())
+        config.pluginmanager.register(CloudXdistPlugin(), "cloudxdist")
+
+
+def forward_events(config, path):
+    """Send the events of the test process to the aggregator of its test node instead of the test process channel.
+
+    Executed on the remote side.
+
+    :param config: pytest config object
+    :type config: pytest.Config
+    :param path: path to the unix socket of the aggregator
+    :type path: str
+    """
+    for plugin in config.pluginmanager.get_plugins():
+        # the worker interactor class comes from xdist.remote executed over the channel
+        if type(plugin).__name__ == "WorkerInteractor":
+            try:
+                forwarder = EventForwarder(path, config.workerinput["workerid"])
+            except (IOError, OSError):
+                # the events are sent over the test process channel
+                return
+            plugin.sendevent = forwarder.sendevent
+            return
 
 
 # pylint: disable=W0105
@@ -127,6 +532,26 @@ def pytest_addoption(parser):
         metavar="PATH",
         default=get_virtualenv_path(),
     )
+    group.addoption(
+        "--cloud-virtualenv-requirements",
+        help="requirements file to build the virtualenv from on the remote test nodes, instead of syncing "
+        "the local one. Can be given multiple times",
+        type=str,
+        action="append",
+        dest="cloud_virtualenv_requirements",
+        metavar="PATH",
+        default=[],
+    )
+    group.addoption(
+        "--cloud-virtualenv-cache-dir",
+        help="path to the directory to keep the virtualenvs built from the requirements in on the remote test nodes. "
+        "Default is {0}".format(DEFAULT_VIRTUALENV_CACHE_DIR),
+        type=str,
+        action="store",
+        dest="cloud_virtualenv_cache_dir",
+        metavar="DIR",
+        default=DEFAULT_VIRTUALENV_CACHE_DIR,
+    )
     group.addoption(
         "--cloud-mem-per-process",
         help="amount of memory roughly needed for test process, in megabytes",
@@ -136,6 +561,14 @@ def pytest_addoption(parser):
         metavar="NUMBER",
         default=None,
     )
+    group.addoption(
+        "--cloud-auto-mem-per-process",
+        help="use the memory per process measured by the previous test run, "
+        "unless --cloud-mem-per-process is given",
+        action="store_true",
+        dest="cloud_auto_mem_per_process",
+        default=False,
+    )
     group.addoption(
         "--cloud-max-processes",
         help="maximum number of processes per test node",
@@ -145,6 +578,133 @@ def pytest_addoption(parser):
         metavar="NUMBER",
         default=None,
     )
+    group.addoption(
+        "--cloud-sizing-policy",
+        help="policy to calculate the number of processes per test node: cpu (one per logical CPU core), "
+        "contention (one per physical CPU core not loaded already, within cgroup limits) "
+        "or <module>:<function> of the custom one",
+        type=str,
+        action="store",
+        dest="cloud_sizing_policy",
+        metavar="NAME",
+        default="cpu",
+    )
+    group.addoption(
+        "--cloud-speed-weighted",
+        help="run the calibration benchmark on the test nodes and send more tests to the faster ones",
+        action="store_true",
+        dest="cloud_speed_weighted",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-longest-first",
+        help="record the test durations in the pytest cache and schedule the tests longest first",
+        action="store_true",
+        dest="cloud_longest_first",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-caps-ttl",
+        help="time to keep the detected test node capabilities in the pytest cache, in seconds. "
+        "Default is 0, capabilities are detected on each run",
+        type=float,
+        action="store",
+        dest="cloud_caps_ttl",
+        metavar="SECONDS",
+        default=0,
+    )
+    group.addoption(
+        "--cloud-caps-refresh",
+        help="detect the test node capabilities even if the cached ones are up to date",
+        action="store_true",
+        dest="cloud_caps_refresh",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-elastic",
+        help="retry the test nodes which were not connectable in the background and add them to the test run, "
+        "retire the test processes which are much slower than the others",
+        action="store_true",
+        dest="cloud_elastic",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-elastic-interval",
+        help="time between the retries of the test nodes which were not connectable, in seconds. Default is 30",
+        type=float,
+        action="store",
+        dest="cloud_elastic_interval",
+        metavar="SECONDS",
+        default=30,
+    )
+    group.addoption(
+        "--cloud-reconnect-attempts",
+        help="number of attempts to connect again to the test node lost during the test run, "
+        "with --cloud-elastic-interval between them. Default is 0, lost test node is quarantined",
+        type=int,
+        action="store",
+        dest="cloud_reconnect_attempts",
+        metavar="NUMBER",
+        default=0,
+    )
+    group.addoption(
+        "--cloud-speculate",
+        help="run the copies of the longest running tests marked as {0} on the idle test processes "
+        "at the end of the test run, the first result wins".format(SPECULATIVE_MARKER),
+        action="store_true",
+        dest="cloud_speculate",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-host-affinity",
+        help="assign whole test modules to the test nodes, so the module scoped fixtures are set up "
+        "by the test processes of single test node",
+        action="store_true",
+        dest="cloud_host_affinity",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-collect-once",
+        help="collect the tests once on the master and partition the test files among the test processes "
+        "of each test node, so each test process imports only its test files",
+        action="store_true",
+        dest="cloud_collect_once",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-zygote",
+        help="start single zygote process per test node, which preloads the modules once and forks the test "
+        "processes",
+        action="store_true",
+        dest="cloud_zygote",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-zygote-preload",
+        help="module for the zygote process to preload, in addition to pytest and xdist. Can be given multiple "
+        "times",
+        type=str,
+        action="append",
+        dest="cloud_zygote_preload",
+        metavar="MODULE",
+        default=[],
+    )
+    group.addoption(
+        "--cloud-aggregate",
+        help="start the test processes via single connection per test node, which forwards their events to "
+        "the master in compressed batches",
+        action="store_true",
+        dest="cloud_aggregate",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-timings",
+        help="write the timings of the test run phases, in aggregate and per test node, to the JSON file",
+        action="store",
+        dest="cloud_timings",
+        metavar="PATH",
+        default=None,
+    )
     group.addoption(
         "--cloud-rsync-max-processes",
         help="maximum number of rsync processes",
@@ -163,6 +723,15 @@ def pytest_addoption(parser):
         metavar="NUMBER",
         default=10000,
     )
+    group.addoption(
+        "--cloud-rsync-fanout",
+        help="number of test nodes each node relays rsync to, the master node rsyncs only to that number of nodes",
+        type=int,
+        action="store",
+        dest="cloud_rsync_fanout",
+        metavar="NUMBER",
+        default=None,
+    )
     parser.addoption(
         "--cloud-rsync-cipher",
         help="cipher for ssh connection used by rsync",
@@ -171,6 +740,66 @@ def pytest_addoption(parser):
         metavar="STRING",
         default="aes128-gcm@openssh.com",
     )
+    group.addoption(
+        "--cloud-sync-backend",
+        help="backend to sync the directory structure to the test nodes with: "
+        "rsync (requires rsync and GNU parallel) or execnet (built-in, over the test nodes connections)",
+        type=str,
+        action="store",
+        dest="cloud_sync_backend",
+        choices=["rsync", "execnet"],
+        default="rsync",
+    )
+    group.addoption(
+        "--cloud-sync-cache",
+        help="remember the directory structure synced to the test nodes, "
+        "skip the sync for the test nodes which are up to date",
+        action="store_true",
+        dest="cloud_sync_cache",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-sync-cold-archive",
+        help="stream the directory structure as single compressed archive to the test nodes "
+        "with the empty target directory",
+        action="store_true",
+        dest="cloud_sync_cold_archive",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-bytecode",
+        help="bytecode handling on the test nodes: purge (delete all the bytecode before the run), "
+        "keep (keep the bytecode, stale bytecode is detected by python) or compile (keep and precompile "
+        "the changed modules in parallel before the run)",
+        type=str,
+        action="store",
+        dest="cloud_bytecode",
+        choices=["purge", "keep", "compile"],
+        default="purge",
+    )
+    group.addoption(
+        "--cloud-connect-timeout",
+        help="time to wait for the test nodes to accept the connection, in seconds",
+        type=float,
+        action="store",
+        dest="cloud_connect_timeout",
+        metavar="SECONDS",
+        default=DEFAULT_CONNECT_TIMEOUT,
+    )
+    group.addoption(
+        "--cloud-reuse-gateways",
+        help="reuse the connections made for the test nodes detection for the first test process of each node",
+        action="store_true",
+        dest="cloud_reuse_gateways",
+        default=False,
+    )
+    group.addoption(
+        "--cloud-ssh-multiplex",
+        help="share single ssh connection per test node between rsync and all the test processes",
+        action="store_true",
+        dest="cloud_ssh_multiplex",
+        default=False,
+    )
     parser.addini(
         "cloud_develop_eggs",
         "list of python package paths to install in develop mode on the remote side",
@@ -184,30 +813,213 @@ def pytest_cmdline_main(config):
     check_options(config)
 
 
-def get_node_capabilities(channel):
+def get_node_capabilities(channel, calibrate=False):
     """Get test node capabilities.
 
     Executed on the remote side.
+    Uses psutil if it's available to the remote interpreter, the standard library otherwise.
 
     :param channel: execnet channel for communication with master node
     :type channel: execnet.gateway_base.Channel
+    :param calibrate: run the calibration benchmark to get the `speed` score of the test node
+    :type calibrate: bool
 
-    :return: `dict` in form {'cpu_count': 1, 'virtual_memory': {'available': 100, 'total': 200}}
+    :return: `dict` in form {'cpu_count': 1, 'virtual_memory': {'available': 100, 'total': 200}, ...}, optional
+        capabilities which can't be detected are None: `physical_cpu_count`, `load_average` (1, 5 and 15 minutes),
+        `disk_free` (in the current directory, in bytes), `cpu_freq` (in megahertz), `cpu_quota` (cgroup quota,
+        in cores), `memory_limit` and `memory_usage` (cgroup limit and current usage, in bytes), `speed`
+        (calibration benchmark iterations per second)
     :rtype: dict
     """
-    import psutil  # pylint: disable=C0415
+    import os  # pylint: disable=W0404,C0415
+    import time  # pylint: disable=W0404,C0415
 
-    memory = psutil.virtual_memory()
+    try:
+        import psutil  # pylint: disable=C0415
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        memory = psutil.virtual_memory()
+        total, available = memory.total, memory.available
+        cpu_count = psutil.cpu_count()
+        physical_cpu_count = psutil.cpu_count(logical=False)
+        disk_free = psutil.disk_usage(".").free
+    else:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        available = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+        try:
+            with open("/proc/meminfo") as fd:
+                for line in fd:
+                    if line.startswith("MemAvailable:"):
+                        available = int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+        cpu_count = os.cpu_count()
+        physical_cpu_count = None
+        stat = os.statvfs(".")
+        disk_free = stat.f_bavail * stat.f_frsize
     caps = dict(
-        cpu_count=psutil.cpu_count(),
-        virtual_memory=dict(available=memory.available, total=memory.total),
+        cpu_count=cpu_count,
+        physical_cpu_count=physical_cpu_count,
+        virtual_memory=dict(available=available, total=total),
+        load_average=list(os.getloadavg()) if hasattr(os, "getloadavg") else None,
+        disk_free=disk_free,
+        cpu_freq=None,
+        cpu_quota=None,
+        memory_limit=None,
+        memory_usage=None,
+        speed=None,
     )
+    if calibrate:
+        # single threaded pure python workload, similar to what the test process does
+        iterations = 0
+        start = time.time()
+        while time.time() - start < 0.2:
+            sorted(map(str, range(1000)))
+            iterations += 1
+        caps["speed"] = iterations / (time.time() - start)
+    try:
+        freq = psutil.cpu_freq()
+    except (AttributeError, NotImplementedError, OSError):
+        # psutil is not available, or the frequency is not detectable
+        freq = None
+    if freq:
+        caps["cpu_freq"] = freq.max or freq.current
+    # cgroup v2 has single hierarchy, the process cgroup is in the line starting with 0::
+    cgroup_path = ""
+    try:
+        with open("/proc/self/cgroup") as fd:
+            for line in fd:
+                if line.startswith("0::"):
+                    cgroup_path = line.strip()[3:].lstrip("/")
+    except (IOError, OSError):
+        pass
+    unified = os.path.join("/sys/fs/cgroup", cgroup_path)
+    values = {}
+    for name, path in (
+        ("cpu.max", os.path.join(unified, "cpu.max")),
+        ("memory.max", os.path.join(unified, "memory.max")),
+        ("memory.current", os.path.join(unified, "memory.current")),
+        ("cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"),
+        ("cpu.cfs_period_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+        ("memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+        ("memory.usage_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ):
+        try:
+            with open(path) as fd:
+                values[name] = fd.read().split()
+        except (IOError, OSError):
+            pass
+    if values.get("cpu.max", ["max"])[0] != "max":
+        caps["cpu_quota"] = int(values["cpu.max"][0]) / int(values["cpu.max"][1])
+    elif int(values.get("cpu.cfs_quota_us", ["-1"])[0]) > 0:
+        caps["cpu_quota"] = int(values["cpu.cfs_quota_us"][0]) / int(
+            values["cpu.cfs_period_us"][0]
+        )
+    if values.get("memory.max", ["max"])[0] != "max":
+        caps["memory_limit"] = int(values["memory.max"][0])
+        caps["memory_usage"] = int(values.get("memory.current", ["0"])[0])
+    # cgroup v1 reports huge number when there is no limit
+    elif int(values.get("memory.limit_in_bytes", [total])[0]) < total:
+        caps["memory_limit"] = int(values["memory.limit_in_bytes"][0])
+        caps["memory_usage"] = int(values.get("memory.usage_in_bytes", ["0"])[0])
     channel.send(caps)
 
 
+def size_by_cpu(caps, mem_per_process=None, max_processes=None):
+    """Get number of test processes for the test node: one per logical CPU core, limited by the available memory.
+
+    :param caps: test node capabilities
+    :type caps: dict
+    :param mem_per_process: optional amount of memory per process needed, in bytes
+    :type mem_per_process: int
+    :param max_processes: optional maximum number of processes per test node
+    :type max_processes: int
+
+    :return: number of test processes
+    :rtype: int
+    """
+    count = min(max_processes or six.MAXSIZE, caps["cpu_count"])
+    if mem_per_process:
+        count = min(
+            int(math.floor(caps["virtual_memory"]["available"] / mem_per_process)),
+            count,
+        )
+    return count
+
+
+def size_by_contention(caps, mem_per_process=None, max_processes=None):
+    """Get number of test processes for the test node avoiding the contention.
+
+    One process per physical CPU core, not taken by the load already running on the test node, limited by the cgroup
+    CPU quota and by the available memory within the cgroup memory limit. At least one process is started.
+
+    :param caps: test node capabilities
+    :type caps: dict
+    :param mem_per_process: optional amount of memory per process needed, in bytes
+    :type mem_per_process: int
+    :param max_processes: optional maximum number of processes per test node
+    :type max_processes: int
+
+    :return: number of test processes
+    :rtype: int
+    """
+    cores = caps.get("physical_cpu_count") or caps["cpu_count"]
+    if caps.get("cpu_quota"):
+        # the quota is guaranteed to the container, the load average is of the whole host then
+        cores = min(cores, caps["cpu_quota"])
+    elif caps.get("load_average"):
+        cores -= caps["load_average"][0]
+    count = min(max_processes or six.MAXSIZE, max(1, int(math.floor(cores))))
+    if mem_per_process:
+        available = caps["virtual_memory"]["available"]
+        if caps.get("memory_limit"):
+            available = min(
+                available, caps["memory_limit"] - (caps.get("memory_usage") or 0)
+            )
+        count = min(int(math.floor(available / mem_per_process)), count)
+    return count
+
+
+SIZING_POLICIES = {
+    "cpu": size_by_cpu,
+    "contention": size_by_contention,
+}
+
+
+def get_sizing_policy(name):
+    """Get sizing policy by name, or by the import path of the custom one in form <module>:<function>.
+
+    :return: function which gets the node capabilities, the memory per process and the maximum number of processes
+        and returns the number of test processes for the test node
+    :rtype: callable
+    """
+    if name in SIZING_POLICIES:
+        return SIZING_POLICIES[name]
+    if ":" in name:
+        module_name, _, function_name = name.partition(":")
+        try:
+            return getattr(importlib.import_module(module_name), function_name)
+        except (ImportError, AttributeError) as exc:
+            pytest.exit("Can't load sizing policy {0}: {1}".format(name, exc))
+    pytest.exit(
+        "Unknown sizing policy {0}, should be one of: {1}, or <module>:<function>".format(
+            name, ", ".join(sorted(SIZING_POLICIES))
+        )
+    )
+
+
 # pylint: disable=R0913
 def get_node_specs(
-    node, host, caps, python=None, chdir=None, mem_per_process=None, max_processes=None
+    node,
+    host,
+    caps,
+    python=None,
+    chdir=None,
+    mem_per_process=None,
+    max_processes=None,
+    sizing_policy=None,
+    via=False,
 ):
     """Get single node specs.
 
@@ -225,18 +1037,21 @@ def get_node_specs(
     :type mem_per_process: int
     :param max_processes: optional maximum number of processes per test node
     :type max_processes: int
+    :param sizing_policy: optional function to get the number of test processes, `size_by_cpu` by default
+    :type sizing_policy: callable
+    :param via: start the test processes via the gateway with the id of the hostname
+    :type via: bool
 
     :return: `list` of test gateway specs for single test node in form ['1*ssh=<node>//id=<hostname>_<index>', ...]
     :rtype: list
     """
-    count = min(max_processes or six.MAXSIZE, caps["cpu_count"])
-    if mem_per_process:
-        count = min(
-            int(math.floor(caps["virtual_memory"]["available"] / mem_per_process)),
-            count,
-        )
+    count = (sizing_policy or size_by_cpu)(
+        caps, mem_per_process=mem_per_process, max_processes=max_processes
+    )
     for index in range(count):
         fmt = "ssh={node}//id={host}_{index}//chdir={chdir}//python={python}"
+        if via:
+            fmt = "popen//via={host}//id={host}_{index}//chdir={chdir}//python={python}"
         yield fmt.format(
             count=count, node=node, host=host, index=index, chdir=chdir, python=python
         )
@@ -260,10 +1075,72 @@ def unique_everseen(iterable, key=None):
                 yield element
 
 
-@timeout_decorator.timeout(3)
-def make_gateway(group, spec):
-    """Make a gateway."""
-    group.makegateway(spec)
+def make_gateways(group, specs, timeout=None):
+    """Make gateways for all given specs concurrently.
+
+    Every connection attempt runs in its own thread and gets the same deadline, so the total wait is roughly
+    the connect time of the slowest reachable node rather than the sum for all the nodes.
+    Gateways are made in the staging group and moved to the given group only if they come up before the deadline,
+    gateways which come up after the deadline are closed and never show up in the given group.
+
+    :param group: execnet group to create gateways in
+    :type group: execnet.Group
+    :param specs: `list` of gateway specs
+    :type specs: list
+    :param timeout: connection deadline in seconds
+    :type timeout: float
+
+    :return: `list` of connectable specs with the connect latency in seconds in form [(<spec>, 0.5), ...]
+    :rtype: list
+    """
+    lock = threading.Lock()
+    latencies = {}
+    expired = []
+    staging = execnet.Group()
+    staging.set_execmodel(group.execmodel.backend, group.remote_execmodel.backend)
+
+    def connect(spec):
+        start = time.time()
+        try:
+            gateway = staging.makegateway(spec)
+        except Exception:  # pylint: disable=W0703
+            return
+        with lock:
+            if not expired:
+                latencies[spec] = time.time() - start
+                # pylint: disable=W0212
+                staging._gateways.remove(gateway)
+                del gateway._group
+                group._register(gateway)
+                return
+        gateway.exit()
+
+    threads = [threading.Thread(target=connect, args=(spec,)) for spec in specs]
+    deadline = time.time() + (timeout or DEFAULT_CONNECT_TIMEOUT)
+    for thread in threads:
+        # daemon threads do not block the interpreter exit on hanging ssh connections
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    with lock:
+        expired.append(True)
+        return [(spec, latencies[spec]) for spec in specs if spec in latencies]
+
+
+def get_develop_links(virtualenv_path):
+    """Get the patterns of the links to the develop eggs in the virtualenv, which are excluded from the sync.
+
+    :param virtualenv_path: relative path to the virtualenv
+    :type virtualenv_path: str
+
+    :return: `list` of rsync-like patterns relative to the synced directory
+    :rtype: list
+    """
+    return [
+        os.path.join(virtualenv_path, "lib", "*", "site-packages", pattern)
+        for pattern in DEVELOP_LINK_PATTERNS
+    ]
 
 
 def get_develop_eggs(root_dir, config):
@@ -274,6 +1151,153 @@ def get_develop_eggs(root_dir, config):
     ]
 
 
+def get_requirements(paths, chdir=None):
+    """Read the requirements files to build the virtualenv from on the remote side.
+
+    :param paths: `list` of requirements file paths
+    :type paths: list
+    :param chdir: relative path where tests are synced to on the remote side, given when the develop eggs are installed
+        into the virtualenv, as they are linked to that path
+    :type chdir: str
+
+    :return: `tuple` of requirements files contents in form [(<file name>, <content>), ...] and their fingerprint
+    :rtype: tuple
+    """
+    requirements = []
+    digest = hashlib.sha1()
+    for index, path in enumerate(paths):
+        with open(path) as fd:
+            content = fd.read()
+        requirements.append(("requirements-{0}.txt".format(index), content))
+        digest.update(content.encode("utf-8"))
+        digest.update(b"\0")
+    if chdir:
+        digest.update(chdir.encode("utf-8"))
+    return requirements, digest.hexdigest()
+
+
+def sync_nodes(
+    rsync,
+    group,
+    node_specs,
+    root_dir,
+    chdir,
+    cache=None,
+    cold_archive=False,
+    quiet=False,
+):
+    """Sync the directory structure to the test nodes.
+
+    Executed on the master node side.
+    When the cache is given, test nodes report the fingerprint of the directory structure they were synced to, so that
+    the test nodes which are up to date are skipped, and the changes for the others are calculated without walking
+    the directory structure on the remote side, if the backend supports it.
+
+    :param rsync: sync backend instance with the test nodes added as targets
+    :type rsync: pytest_cloud.rsync.RSync
+    :param group: execnet group with the gateways to the test nodes
+    :type group: execnet.Group
+    :param node_specs: `list` of connectable test nodes in form [(<node>, <hostname>), ...]
+    :type node_specs: list
+    :param root_dir: directory to sync
+    :type root_dir: py.path.local
+    :param chdir: relative path where to sync tests on the remote side
+    :type chdir: str
+    :param cache: optional pytest cache
+    :type cache: _pytest.cacheprovider.Cache
+    :param cold_archive: stream the compressed archive to the test nodes with the empty target directory
+    :type cold_archive: bool
+    :param quiet: do not print the progress
+    :type quiet: bool
+    """
+    if cache is None and not cold_archive:
+        rsync.send()
+        return
+    hosts = dict(node_specs)
+    manifest = get_manifest(str(root_dir), rsync.get_ignores())
+    fingerprint = get_fingerprint(manifest)
+    remote_manifests = {}
+    up_to_date = []
+    synced = []
+    if cache is not None:
+        sync_cache = SyncCache(cache, chdir)
+        markers = receive_each(group, read_sync_marker, path=SYNC_MARKER)
+        for node, host in node_specs:
+            if markers.get(host) == fingerprint:
+                rsync.targets.discard(node)
+                up_to_date.append(host)
+                continue
+            remote_manifest = sync_cache.get_manifest(host, markers.get(host))
+            if remote_manifest is not None:
+                remote_manifests[node] = remote_manifest
+        if up_to_date and not quiet:
+            print("Test nodes already up to date: {0}".format(", ".join(up_to_date)))
+    if cold_archive:
+        empty = receive_each(group, is_empty, path=SYNC_MARKER)
+        cold = [node for node in sorted(rsync.targets) if empty.get(hosts[node])]
+        if cold:
+            if not quiet:
+                print(
+                    "Streaming archive to empty test nodes: {0}".format(", ".join(cold))
+                )
+            send_archive(
+                str(root_dir),
+                manifest,
+                [group[hosts[node]] for node in cold],
+                quiet=quiet,
+            )
+            for node in cold:
+                rsync.targets.discard(node)
+                synced.append(hosts[node])
+    if rsync.targets:
+        rsync.send(manifest=manifest, remote_manifests=remote_manifests)
+        synced.extend(hosts[node] for node in rsync.synced)
+    if cache is not None:
+        for host in synced:
+            group[host].remote_exec(
+                write_sync_marker, path=SYNC_MARKER, fingerprint=fingerprint
+            ).waitclose()
+        sync_cache.update(up_to_date + synced, fingerprint, manifest)
+
+
+def add_remote_timings(timings, node_timings):
+    """Add the timings of the steps measured on the test nodes, as if they ended just now.
+
+    :param timings: timings of the test run phases
+    :type timings: pytest_cloud.timings.Timings
+    :param node_timings: `dict` in form {<hostname>: {<step>: <seconds>}}
+    :type node_timings: dict
+    """
+    end = time.time()
+    for host, steps in node_timings.items():
+        for step, seconds in steps.items():
+            timings.add(step, end - seconds, end, node=host)
+
+
+def receive_each(group, function, **kwargs):
+    """Execute the function on all the gateways of the group and receive single result from each of them.
+
+    :param group: execnet group or `list` of the gateways
+    :type group: execnet.Group
+
+    :return: `dict` in form {<gateway id>: <result>}
+    :rtype: dict
+    """
+    if hasattr(group, "remote_exec"):
+        multi_channel = group.remote_exec(function, **kwargs)
+    else:
+        multi_channel = execnet.MultiChannel(
+            [gateway.remote_exec(function, **kwargs) for gateway in group]
+        )
+    try:
+        return dict(
+            (channel.gateway.id, result)
+            for channel, result in multi_channel.receive_each(True)
+        )
+    finally:
+        multi_channel.waitclose()
+
+
 def get_nodes_specs(
     nodes,
     python=None,
@@ -284,6 +1308,23 @@ def get_nodes_specs(
     rsync_max_processes=None,
     rsync_bandwidth_limit=None,
     rsync_cipher=None,
+    rsync_fanout=None,
+    connect_timeout=None,
+    reuse_gateways=False,
+    ssh_multiplex=False,
+    sync_backend="rsync",
+    sync_cache=False,
+    sync_cold_archive=False,
+    virtualenv_requirements=None,
+    virtualenv_cache_dir=None,
+    bytecode="purge",
+    sizing_policy=None,
+    speed_weighted=False,
+    caps_ttl=None,
+    caps_refresh=False,
+    zygote_preload=None,
+    aggregate=False,
+    quiet=False,
     config=None,
 ):
     """Get nodes specs.
@@ -308,6 +1349,43 @@ def get_nodes_specs(
     :type rsync_max_processes: int
     :param rsync_bandwidth_limit: optional bandwidth limit per rsync process in kilobytes per second
     :type rsync_bandwidth_limit: int
+    :param rsync_fanout: optional number of test nodes each node relays rsync to
+    :type rsync_fanout: int
+    :param connect_timeout: optional time to wait for the test nodes to accept the connection, in seconds
+    :type connect_timeout: float
+    :param reuse_gateways: hand off the detection gateways to the first test process of each node, if it runs the
+        same python interpreter
+    :type reuse_gateways: bool
+    :param ssh_multiplex: share single ssh connection per node between rsync and all the test processes
+    :type ssh_multiplex: bool
+    :param sync_backend: backend to sync the directory structure with, `rsync` or `execnet`
+    :type sync_backend: str
+    :param sync_cache: skip the sync for the test nodes which already have the current directory structure
+    :type sync_cache: bool
+    :param sync_cold_archive: stream the compressed archive to the test nodes with the empty target directory
+    :type sync_cold_archive: bool
+    :param virtualenv_requirements: optional `list` of requirements files to build the virtualenv from on the remote
+        side, instead of syncing the local virtualenv
+    :type virtualenv_requirements: list
+    :param virtualenv_cache_dir: path to the directory to keep the built virtualenvs in on the remote side
+    :type virtualenv_cache_dir: str
+    :param bytecode: bytecode handling mode on the remote side, `purge`, `keep` or `compile`
+    :type bytecode: str
+    :param sizing_policy: optional function to get the number of test processes per test node
+    :type sizing_policy: callable
+    :param speed_weighted: measure the test nodes speed for the scheduler to send more tests to the faster ones
+    :type speed_weighted: bool
+    :param caps_ttl: optional time to use the cached test node capabilities for, in seconds
+    :type caps_ttl: float
+    :param caps_refresh: detect the test node capabilities even if the cached ones are up to date
+    :type caps_refresh: bool
+    :param zygote_preload: optional `list` of the module names for the zygote process to preload, the test
+        processes are started normally if not given
+    :type zygote_preload: list
+    :param aggregate: start the test processes via the aggregator of the test node events
+    :type aggregate: bool
+    :param quiet: do not print the progress, for the test nodes set up during the test run
+    :type quiet: bool
     :param config: pytest config object
     :type config: pytest.Config
 
@@ -317,80 +1395,285 @@ def get_nodes_specs(
     """
     # pylint: disable=E1101
     group = execnet.Group()
+    multiplexer = None
+    timings = getattr(config, "_cloud_timings", None) or Timings()
+    setup_start = time.time()
+    echo = (lambda *args: None) if quiet else print
+    n_m = NodeManager(config, specs=[])
     try:
-        n_m = NodeManager(config, specs=[])
+        if ssh_multiplex:
+            multiplexer = config._cloud_ssh_multiplexer = SSHMultiplexer()
+        protects = list(BYTECODE_PATTERNS) if bytecode != "purge" else []
         if virtualenv_path:
             virtualenv_path = os.path.relpath(virtualenv_path)
+            if virtualenv_requirements:
+                # the virtualenv is built on the remote side
+                n_m.rsyncoptions["ignores"].append(os.path.abspath(virtualenv_path))
+            else:
+                develop_links = get_develop_links(virtualenv_path)
+                n_m.rsyncoptions["ignores"].extend(
+                    os.path.abspath(pattern) for pattern in develop_links
+                )
+                protects.extend(develop_links)
         node_specs = []
-        node_caps = {}
         root_dir = config.rootdir
         nodes = list(unique_everseen(nodes))
-        print("Detected root dir: {0}".format(root_dir))
-        rsync = RSync(
-            root_dir,
-            chdir,
-            includes=config.getini("rsyncdirs"),
-            jobs=rsync_max_processes or len(nodes),
-            bwlimit=rsync_bandwidth_limit,
-            bandwidth_limit=rsync_bandwidth_limit,
-            ssh_cipher=rsync_cipher,
-            **n_m.rsyncoptions
-        )
-        print("Detecting connectable test nodes...")
+        echo("Detected root dir: {0}".format(root_dir))
+        gateways = {}
+        if sync_backend == "execnet":
+            rsync = ExecnetSync(
+                root_dir,
+                chdir,
+                gateways=gateways,
+                protects=protects,
+                quiet=quiet,
+                **n_m.rsyncoptions
+            )
+        else:
+            rsync = RSync(
+                root_dir,
+                chdir,
+                includes=config.getini("rsyncdirs"),
+                jobs=rsync_max_processes or len(nodes),
+                bwlimit=rsync_bandwidth_limit,
+                bandwidth_limit=rsync_bandwidth_limit,
+                ssh_cipher=rsync_cipher,
+                ssh_options=multiplexer.get_options() if multiplexer else None,
+                fanout=rsync_fanout,
+                protects=protects,
+                **n_m.rsyncoptions
+            )
+        echo("Detecting connectable test nodes...")
+        specs = {}
+        ssh_nodes = {}
         for node in nodes:
             host = node.split("@")[1] if "@" in node else node
+            ssh_nodes[node] = multiplexer.get_ssh_args(node) if multiplexer else node
             spec = "ssh={node}//id={host}//chdir={chdir}//python={python}".format(
-                node=node, host=host, chdir=chdir, python=python
+                node=ssh_nodes[node], host=host, chdir=chdir, python=python
             )
-            try:
-                make_gateway(group, spec)
-            except Exception:  # pylint: disable=W0703
-                continue
+            if reuse_gateways:
+                # the gateway has to run the same execution model as xdist workers do
+                spec = "execmodel={0}//{1}".format(n_m.group.execmodel.backend, spec)
+            specs[spec] = (node, host)
+        connect_start = time.time()
+        for spec, latency in make_gateways(group, list(specs), timeout=connect_timeout):
+            node, host = specs[spec]
+            echo("Connected to {0} in {1:.2f}s".format(node, latency))
+            timings.add("connect", time.time() - latency, time.time(), node=host)
+            if sync_backend == "execnet":
+                gateways[node] = group[host]
             rsync.add_target_host(node)
             node_specs.append((node, host))
+        timings.add("connect", connect_start, time.time())
+        connected = set(node for node, _ in node_specs)
+        config._cloud_unreachable = [node for node in nodes if node not in connected]
         if node_specs:
-            print(
+            echo(
                 "Found {0} connectable test nodes: {1}".format(
                     len(node_specs), rsync.targets
                 )
             )
         else:
             pytest.exit("None of the given test nodes are connectable")
-        print("RSyncing directory structure")
-        rsync.send()
-        print("RSync finished")
+        echo("RSyncing directory structure")
+        with timings.measure("sync"):
+            sync_nodes(
+                rsync,
+                group,
+                node_specs,
+                root_dir,
+                chdir,
+                cache=get_cache(config) if sync_cache else None,
+                cold_archive=sync_cold_archive,
+                quiet=quiet,
+            )
+        add_remote_timings(
+            timings,
+            dict(
+                (host, {"sync": rsync.durations[node]})
+                for node, host in node_specs
+                if node in rsync.durations
+            ),
+        )
+        echo("RSync finished")
         develop_eggs = get_develop_eggs(root_dir, config)
-        group.remote_exec(
-            patches.activate_env,
-            virtualenv_path=virtualenv_path,
-            develop_eggs=develop_eggs,
-        ).waitclose()
-        multi_channel = group.remote_exec(get_node_capabilities)
-        try:
-            caps = multi_channel.receive_each(True)
-            for channel, cap in caps:
-                node_caps[channel.gateway.id] = cap
-        finally:
-            multi_channel.waitclose()
-        return list(
-            chain.from_iterable(
+        virtualenv_paths = dict((host, virtualenv_path) for _, host in node_specs)
+        if virtualenv_requirements:
+            requirements, fingerprint = get_requirements(
+                virtualenv_requirements, chdir=chdir if develop_eggs else None
+            )
+            echo("Preparing virtualenv {0}".format(fingerprint))
+            with timings.measure("virtualenv"):
+                virtualenv_paths = receive_each(
+                    group,
+                    patches.build_virtualenv,
+                    requirements=requirements,
+                    fingerprint=fingerprint,
+                    cache_dir=virtualenv_cache_dir or DEFAULT_VIRTUALENV_CACHE_DIR,
+                )
+        with timings.measure("activate_env"):
+            if virtualenv_requirements:
+                # virtualenv paths differ per test node
+                channels = [
+                    (
+                        host,
+                        group[host].remote_exec(
+                            patches.activate_env,
+                            virtualenv_path=virtualenv_paths[host],
+                            develop_eggs=develop_eggs,
+                            bytecode=bytecode,
+                            cache_dir=DEFAULT_DEVELOP_EGGS_CACHE_DIR,
+                        ),
+                    )
+                    for _, host in node_specs
+                ]
+                activated = {}
+                for host, channel in channels:
+                    activated[host] = channel.receive()
+                    channel.waitclose()
+            else:
+                activated = receive_each(
+                    group,
+                    patches.activate_env,
+                    virtualenv_path=virtualenv_path,
+                    develop_eggs=develop_eggs,
+                    bytecode=bytecode,
+                    cache_dir=DEFAULT_DEVELOP_EGGS_CACHE_DIR,
+                )
+        add_remote_timings(timings, activated)
+        cache = get_cache(config) if caps_ttl else None
+        caps_cache = CapabilitiesCache(cache, caps_ttl) if cache is not None else None
+        node_caps = {}
+        if caps_cache is not None and not caps_refresh:
+            for _, host in node_specs:
+                caps = caps_cache.get(host)
+                if caps is not None and (caps.get("speed") or not speed_weighted):
+                    node_caps[host] = caps
+            if node_caps:
+                echo("Using cached capabilities of {0}".format(", ".join(node_caps)))
+        if len(node_caps) < len(node_specs):
+            targets = group
+            if node_caps:
+                targets = [
+                    group[host] for _, host in node_specs if host not in node_caps
+                ]
+            with timings.measure("capabilities"):
+                probed = receive_each(
+                    targets, get_node_capabilities, calibrate=speed_weighted
+                )
+            if caps_cache is not None:
+                caps_cache.update(probed)
+            node_caps.update(probed)
+        if speed_weighted:
+            # updated in place, as the scheduler keeps the speeds of the test nodes set up during the test run
+            if not hasattr(config, "_cloud_node_speeds"):
+                config._cloud_node_speeds = {}
+            config._cloud_node_speeds.update(
+                (host, caps["speed"]) for host, caps in node_caps.items()
+            )
+        # the virtualenv built from the requirements has absolute path
+        pythons = dict(
+            (
+                host,
+                (
+                    os.path.join(chdir, virtualenv_paths[host], "bin", python)
+                    if virtualenv_paths[host]
+                    else python
+                ),
+            )
+            for _, host in node_specs
+        )
+        if aggregate:
+            # the aggregator gateways are started with the test processes
+            if not hasattr(config, "_cloud_aggregator_specs"):
+                config._cloud_aggregator_specs = {}
+            config._cloud_aggregator_specs.update(
+                (
+                    host,
+                    "execmodel=thread//ssh={node}//id={host}//python={python}".format(
+                        node=ssh_nodes[node], host=host, python=pythons[host]
+                    ),
+                )
+                for node, host in node_specs
+            )
+        zygote_start = time.time()
+        if zygote_preload:
+            echo("Starting zygote processes")
+            with open(os.path.splitext(zygote.__file__)[0] + ".py") as fd:
+                source = fd.read()
+            channels = [
+                (
+                    host,
+                    group[host].remote_exec(
+                        patches.start_zygote,
+                        python=pythons[host],
+                        script=source,
+                        modules=zygote_preload,
+                    ),
+                )
+                for _, host in node_specs
+            ]
+            for host, channel in channels:
+                try:
+                    command = channel.receive()
+                except execnet.RemoteError:
+                    command = None
+                if command:
+                    pythons[host] = command
+                else:
+                    echo(
+                        "Zygote process failed to start on {0}, starting the test processes normally".format(
+                            host
+                        )
+                    )
+            timings.add("zygote", zygote_start, time.time())
+        result = []
+        for node, hst in node_specs:
+            host_specs = list(
                 get_node_specs(
-                    node,
+                    ssh_nodes[node],
                     hst,
                     node_caps[hst],
-                    python=os.path.join(chdir, virtualenv_path, "bin", python),
+                    python=pythons[hst],
                     chdir=chdir,
                     mem_per_process=mem_per_process,
                     max_processes=max_processes,
+                    sizing_policy=sizing_policy,
+                    via=aggregate,
                 )
-                for node, hst in node_specs
             )
-        )
+            # the test processes of the aggregated test node are started via the aggregator gateway, the detection
+            # gateway only runs the same interpreter as the test processes if they don't use the virtualenv or zygote
+            if (
+                reuse_gateways
+                and host_specs
+                and not aggregate
+                and pythons[hst] == python
+            ):
+                patches.handoff_gateway(config, group, group[hst], "{0}_0".format(hst))
+            result.extend(host_specs)
+        timings.add("setup", setup_start, time.time())
+        return result
+    except BaseException:
+        if multiplexer:
+            multiplexer.close()
+        raise
     finally:
-        try:
-            group.terminate()
-        except Exception:  # pylint: disable=W0703
-            pass
+        for grp in (group, n_m.group):
+            try:
+                grp.terminate()
+            except Exception:  # pylint: disable=W0703
+                pass
+
+
+def pytest_unconfigure(config):
+    """Close the connections to the test nodes which are still open."""
+    patches.close_handoff_gateways(config)
+    patches.close_aggregators(config)
+    multiplexer = getattr(config, "_cloud_ssh_multiplexer", None)
+    if multiplexer:
+        multiplexer.close()
 
 
 def check_options(config):
@@ -398,16 +1681,22 @@ def check_options(config):
     if (
         getattr(config, "workerinput", {}).get("workerid", "local") == "local"
         and config.option.cloud_nodes
+        and not config.option.collectonly
     ):
         patches.apply_patches()
+        config._cloud_timings = Timings()
         mem_per_process = config.option.cloud_mem_per_process
         if mem_per_process:
             mem_per_process = mem_per_process * 1024 * 1024
+        elif config.option.cloud_auto_mem_per_process:
+            cache = get_cache(config)
+            if cache is not None:
+                mem_per_process = get_mem_per_process(cache)
+        config._cloud_mem_per_process = mem_per_process
         virtualenv_path = config.option.cloud_virtualenv_path
         chdir = config.option.cloud_chdir
         python = config.option.cloud_python
-        node_specs = get_nodes_specs(
-            config.option.cloud_nodes,
+        config._cloud_nodes_kwargs = kwargs = dict(
             chdir=chdir,
             python=python,
             virtualenv_path=virtualenv_path,
@@ -416,8 +1705,44 @@ def check_options(config):
             max_processes=config.option.cloud_max_processes,
             mem_per_process=mem_per_process,
             rsync_cipher=config.option.cloud_rsync_cipher,
+            rsync_fanout=config.option.cloud_rsync_fanout,
+            connect_timeout=config.option.cloud_connect_timeout,
+            reuse_gateways=config.option.cloud_reuse_gateways,
+            ssh_multiplex=config.option.cloud_ssh_multiplex,
+            sync_backend=config.option.cloud_sync_backend,
+            sync_cache=config.option.cloud_sync_cache,
+            sync_cold_archive=config.option.cloud_sync_cold_archive,
+            virtualenv_requirements=config.option.cloud_virtualenv_requirements,
+            virtualenv_cache_dir=config.option.cloud_virtualenv_cache_dir,
+            bytecode=config.option.cloud_bytecode,
+            sizing_policy=get_sizing_policy(config.option.cloud_sizing_policy),
+            speed_weighted=config.option.cloud_speed_weighted,
+            caps_ttl=config.option.cloud_caps_ttl,
+            caps_refresh=config.option.cloud_caps_refresh,
+            zygote_preload=(
+                ZYGOTE_PRELOAD + config.option.cloud_zygote_preload
+                if config.option.cloud_zygote
+                else None
+            ),
+            aggregate=config.option.cloud_aggregate,
             config=config,
         )
+        # the tests are collected while the test nodes are set up
+        collection = (
+            start_collection(config) if config.option.cloud_collect_once else None
+        )
+        collection_start = time.time()
+        try:
+            node_specs = get_nodes_specs(config.option.cloud_nodes, **kwargs)
+        finally:
+            ids = finish_collection(*collection) if collection else None
+            if collection:
+                config._cloud_timings.add("collect_once", collection_start, time.time())
+        if ids is not None:
+            config._cloud_collect_ids = ids
+            config._cloud_collect_files = get_collect_files(
+                ids, [execnet.XSpec(spec).id for spec in node_specs]
+            )
         if node_specs:
             print("Scheduling with {0} parallel test sessions".format(len(node_specs)))
         if not node_specs:
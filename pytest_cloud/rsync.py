@@ -1,6 +1,7 @@
 """Faster rsync."""
 
 import os
+import shlex
 import tempfile
 import subprocess
 
@@ -26,6 +27,34 @@ def make_reltoroot(roots, args):
     return res
 
 
+# rsync exit codes meaning the target is synced, partial transfers are tolerated as --ignore-errors is used
+RSYNC_SUCCESS_CODES = (0, 23, 24)
+
+
+def get_tree(targets, fanout):
+    """Get the k-ary distribution tree for the targets, with the master node as the root.
+
+    :param targets: target hosts
+    :type targets: iterable
+    :param fanout: number of the targets each node sends the directory structure to
+    :type fanout: int
+
+    :return: `list` of waves, each wave is the `list` of (<source>, <target>), where the source is None for the master
+        node, all the sources of the wave are targets of the previous waves
+    :rtype: list
+    """
+    nodes = [None] + sorted(targets)
+    waves = []
+    depths = {None: 0}
+    for index, target in enumerate(nodes[1:], 1):
+        source = nodes[(index - 1) // fanout]
+        depths[target] = depths[source] + 1
+        if len(waves) < depths[target]:
+            waves.append([])
+        waves[depths[target] - 1].append((source, target))
+    return waves
+
+
 # pylint: disable=R0902,R0205
 class RSync(object):
     """Send a directory structure (recursively) to one or multiple remote filesystems."""
@@ -42,6 +71,9 @@ class RSync(object):
         debug=False,
         bwlimit=None,
         ssh_cipher=None,
+        ssh_options=None,
+        fanout=None,
+        protects=None,
         **kwargs
     ):
         """Initialize new RSync instance."""
@@ -55,6 +87,16 @@ class RSync(object):
         self.jobs = jobs
         self.bwlimit = bwlimit
         self.ssh_cipher = ssh_cipher
+        self.ssh_options = ssh_options or []
+        self.fanout = fanout
+        # patterns of the files on the targets which are excluded from the sync, but should not be deleted
+        self.protects = protects or []
+        # targets synced by the last send
+        self.synced = set()
+        # time it took to sync each target by the last send, in seconds
+        self.durations = {}
+        # run times of the commands run by the last `run_parallel`, in seconds
+        self.runtimes = []
 
     def get_ignores(self):
         """Get ignores."""
@@ -72,10 +114,173 @@ class RSync(object):
             for include in self.includes
         ]
 
-    def send(self, raises=True):
+    def get_command(self, includes_path, ignores_path, target="{}"):
+        """Get rsync command to send the directory structure from the master node to the target."""
+        return (
+            "rsync -arHAXx{verbose} "
+            "{bwlimit}"
+            "--ignore-errors "
+            "{protects}"
+            "--include-from={includes} "
+            "--exclude-from={ignores} "
+            "--numeric-ids "
+            "--force "
+            "--inplace "
+            "--delete-excluded "
+            "--delete "
+            '-e "ssh -T -c {ssh_cipher} -o Compression=no -x{ssh_options}" '
+            ". {target}:{chdir}".format(
+                verbose="v" if self.verbose else "",
+                bwlimit="--bwlimit={0} ".format(self.bwlimit) if self.bwlimit else "",
+                protects="".join(
+                    shlex.quote("--filter=P " + protect) + " "
+                    for protect in self.protects
+                ),
+                ssh_cipher=self.ssh_cipher,
+                ssh_options="".join(" " + option for option in self.ssh_options),
+                chdir=self.targetdir,
+                ignores=ignores_path,
+                includes=includes_path,
+                target=target,
+            )
+        )
+
+    def get_relay_command(self, source, target):
+        """Get command to send the directory structure from the already synced source node to the target.
+
+        The ssh agent is forwarded to the source node, so it can connect to the target with the master's keys.
+        """
+        command = (
+            "cd {chdir} && rsync -arHAXx{verbose} "
+            "{bwlimit}"
+            "--ignore-errors "
+            "{filters}"
+            "--numeric-ids "
+            "--force "
+            "--inplace "
+            "--delete-excluded "
+            "--delete "
+            "-e {ssh} "
+            ". {target}:{chdir}".format(
+                verbose="v" if self.verbose else "",
+                bwlimit="--bwlimit={0} ".format(self.bwlimit) if self.bwlimit else "",
+                filters="".join(
+                    [
+                        shlex.quote("--filter=P " + protect) + " "
+                        for protect in self.protects
+                    ]
+                    + [
+                        shlex.quote("--include=" + include) + " "
+                        for include in self.get_includes()
+                    ]
+                    + [
+                        shlex.quote("--exclude=" + ignore) + " "
+                        for ignore in self.get_ignores()
+                    ]
+                ),
+                ssh=shlex.quote(
+                    "ssh -T -c {0} -o Compression=no -o BatchMode=yes -x".format(
+                        self.ssh_cipher
+                    )
+                ),
+                chdir=shlex.quote(self.targetdir),
+                target=target,
+            )
+        )
+        return "ssh -A -T -x{ssh_options} {source} {command}".format(
+            ssh_options="".join(" " + option for option in self.ssh_options),
+            source=source,
+            command=shlex.quote(command),
+        )
+
+    def run_parallel(self, parallel, commands):
+        """Run the commands with GNU parallel.
+
+        Run times of the commands are kept in `runtimes` attribute.
+
+        :return: `list` of the exit codes of the commands
+        :rtype: list
+        """
+        fd_joblog, joblog_path = tempfile.mkstemp()
+        os.close(fd_joblog)
+        try:
+            subprocess.call(
+                [parallel]
+                + (["--verbose"] if self.verbose else [])
+                + [
+                    "--gnu",
+                    "--jobs={0}".format(self.jobs or len(commands)),
+                    "--joblog={0}".format(joblog_path),
+                    ":::",
+                ]
+                + commands
+            )
+            exit_codes = [None] * len(commands)
+            self.runtimes = [None] * len(commands)
+            with open(joblog_path) as fd_joblog:
+                # skip the header, columns are: Seq Host Starttime JobRuntime Send Receive Exitval Signal Command
+                for line in list(fd_joblog)[1:]:
+                    columns = line.split("\t")
+                    exit_codes[int(columns[0]) - 1] = int(columns[6])
+                    self.runtimes[int(columns[0]) - 1] = float(columns[3])
+            return exit_codes
+        finally:
+            os.unlink(joblog_path)
+
+    def send_tree(self, parallel, includes_path, ignores_path):
+        """Send a sourcedir to all added targets along the k-ary tree.
+
+        The master node sends the directory structure only to `fanout` targets, each synced target relays it
+        to the next `fanout` targets, so the master uplink usage doesn't depend on the number of targets.
+        If relaying fails, the target is synced from the nearest synced ancestor, and eventually from the master.
+        """
+        parents = {}
+        synced = set()
+        failed = []
+        for wave in get_tree(self.targets, self.fanout):
+            jobs = []
+            for source, target in wave:
+                parents[target] = source
+                while source is not None and source not in synced:
+                    source = parents[source]
+                jobs.append((source, target))
+            exit_codes = self.run_parallel(
+                parallel,
+                [
+                    self.get_command(includes_path, ignores_path, target)
+                    if source is None
+                    else self.get_relay_command(source, target)
+                    for source, target in jobs
+                ],
+            )
+            self.add_durations([target for _, target in jobs])
+            for (source, target), exit_code in zip(jobs, exit_codes):
+                if exit_code in RSYNC_SUCCESS_CODES:
+                    synced.add(target)
+                elif source is not None:
+                    failed.append(target)
+        if failed:
+            exit_codes = self.run_parallel(
+                parallel,
+                [
+                    self.get_command(includes_path, ignores_path, target)
+                    for target in failed
+                ],
+            )
+            self.add_durations(failed)
+            synced.update(
+                target
+                for target, exit_code in zip(failed, exit_codes)
+                if exit_code in RSYNC_SUCCESS_CODES
+            )
+        self.synced = synced
+
+    def send(self, raises=True, manifest=None, remote_manifests=None):
         """Send a sourcedir to all added targets.
 
         Flag indicates whether to raise an error or return in case of lack of targets.
+        Known manifests of the source and the targets are not used, rsync compares the files itself.
+        Targets which were synced successfully are collected in `synced` attribute.
         """
         parallel = find_executable("parallel")
         if not parallel:
@@ -89,36 +294,24 @@ class RSync(object):
             fd_ignores.flush()
             fd_includes.writelines(include + "\n" for include in self.get_includes())
             fd_includes.flush()
-            subprocess.call(
-                [parallel]
-                + (["--verbose"] if self.verbose else [])
-                + [
-                    "--gnu",
-                    "--jobs={0}".format(self.jobs or len(self.targets)),
-                    "rsync -arHAXx{verbose} "
-                    "{bwlimit}"
-                    "--ignore-errors "
-                    "--include-from={includes} "
-                    "--exclude-from={ignores} "
-                    "--numeric-ids "
-                    "--force "
-                    "--inplace "
-                    "--delete-excluded "
-                    "--delete "
-                    '-e "ssh -T -c {ssh_cipher} -o Compression=no -x" '
-                    ". {{}}:{chdir}".format(
-                        verbose="v" if self.verbose else "",
-                        bwlimit="--bwlimit={0} ".format(self.bwlimit)
-                        if self.bwlimit
-                        else "",
-                        ssh_cipher=self.ssh_cipher,
-                        chdir=self.targetdir,
-                        ignores=ignores_path,
-                        includes=includes_path,
-                    ),
-                    ":::",
-                ]
-                + list(self.targets)
+            self.synced = set()
+            self.durations = {}
+            if self.fanout and len(self.targets) > self.fanout:
+                self.send_tree(parallel, includes_path, ignores_path)
+                return
+            targets = list(self.targets)
+            exit_codes = self.run_parallel(
+                parallel,
+                [
+                    self.get_command(includes_path, ignores_path, target)
+                    for target in targets
+                ],
+            )
+            self.add_durations(targets)
+            self.synced.update(
+                target
+                for target, exit_code in zip(targets, exit_codes)
+                if exit_code in RSYNC_SUCCESS_CODES
             )
         finally:
             fd_ignores.close()
@@ -126,6 +319,16 @@ class RSync(object):
             os.unlink(ignores_path)
             os.unlink(includes_path)
 
+    def add_durations(self, targets):
+        """Add the run times of the last commands to the sync durations of their targets.
+
+        :param targets: `list` of the targets of the last commands
+        :type targets: list
+        """
+        for target, runtime in zip(targets, self.runtimes):
+            if runtime is not None:
+                self.durations[target] = self.durations.get(target, 0) + runtime
+
     def add_target_host(self, host):
         """Add a remote target."""
         self.targets.add(host)
@@ -0,0 +1,533 @@
+"""Test scheduling among the test nodes."""
+from __future__ import division
+
+import heapq
+import time
+
+from xdist.scheduler import LoadScheduling
+
+# number of tests the test process should complete before its observed throughput is trusted
+THROUGHPUT_MIN_TESTS = 10
+# how many times slower than the median of the others the test process should be to get retired
+RETIRE_SLOWDOWN = 4
+# marker of the tests which are safe to run more than once at the same time
+SPECULATIVE_MARKER = "cloud_speculative"
+
+
+def get_host(node):
+    """Get hostname of the test node the test process runs on.
+
+    :param node: test process
+    :type node: xdist.workermanage.WorkerController
+
+    :return: hostname of the test node, test process ids are in form <hostname>_<index>
+    :rtype: str
+    """
+    return node.gateway.id.rsplit("_", 1)[0]
+
+
+def get_estimates(collection, durations):
+    """Estimate the durations of the tests.
+
+    Tests without the history are estimated by the average duration of the known tests of the same module, or of all
+    the known tests.
+
+    :param collection: `list` of test node ids
+    :type collection: list
+    :param durations: `dict` of the known test durations in form {<node id>: <duration in seconds>}
+    :type durations: dict
+
+    :return: `list` of estimated test durations in the collection order
+    :rtype: list
+    """
+    modules = {}
+    for nodeid, duration in durations.items():
+        stats = modules.setdefault(nodeid.split("::")[0], [0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+    default = sum(durations.values()) / len(durations) if durations else 0
+    estimates = []
+    for nodeid in collection:
+        if nodeid in durations:
+            estimates.append(durations[nodeid])
+            continue
+        count, total = modules.get(nodeid.split("::")[0], (0, 0))
+        estimates.append(total / count if count else default)
+    return estimates
+
+
+def get_makespan(estimates, workers):
+    """Get the makespan of the longest processing time first schedule.
+
+    :param estimates: `list` of the test durations
+    :type estimates: list
+    :param workers: number of test processes
+    :type workers: int
+
+    :return: time the last test process finishes, in seconds
+    :rtype: float
+    """
+    loads = [0.0] * max(1, workers)
+    for estimate in sorted(estimates, reverse=True):
+        heapq.heapreplace(loads, loads[0] + estimate)
+    return max(loads)
+
+
+class CloudLoadScheduling(LoadScheduling):
+    """Load scheduling aware of the test nodes differences.
+
+    When the test node speeds are given, the chunks of tests are weighted by the speed of the test node relative to the
+    others, so faster test nodes get proportionally more tests. Speeds measured by the calibration benchmark are
+    replaced by the observed throughput of the test processes once they completed enough tests.
+
+    When the test durations are given, the tests are sent longest first (LPT), and the chunks are limited by
+    the estimated duration rather than by the number of tests, so the long tests are spread among the test processes
+    and the short ones fill the tail.
+
+    When retiring is enabled, the test process which runs the tests much slower than the others is shut down, and
+    the tests pending on it are taken back and sent to the other test processes.
+
+    When speculating, the test process which has no more tests to run gets the copy of the test which runs longest on
+    the other test node, if the test is marked as safe to run more than once. The first result of the test wins,
+    the test reports of the other copy are dropped, and the test process which runs only the other copy is stopped.
+
+    With the host affinity, whole test modules are assigned to the test nodes, balanced by the number of test processes
+    (and the speed) of the test nodes, so the module scoped fixtures of the module are set up only by the test
+    processes of single test node. Test node which runs out of its modules takes over the last module of the test node
+    with the most pending tests.
+
+    When the test processes collected only some of the test files, they get only the tests of those files.
+    """
+
+    # pylint: disable=R0913
+    def __init__(
+        self,
+        config,
+        log=None,
+        speeds=None,
+        durations=None,
+        retire_slow=False,
+        speculate=False,
+        affinity=False,
+        collected=None,
+    ):
+        """Initialize new CloudLoadScheduling instance.
+
+        :param config: pytest config object
+        :type config: pytest.Config
+        :param log: xdist log producer
+        :type log: xdist.remote.Producer
+        :param speeds: optional `dict` of the test node speed scores in form {<hostname>: <speed>}
+        :type speeds: dict
+        :param durations: optional `dict` of the known test durations in form {<node id>: <duration in seconds>}
+        :type durations: dict
+        :param retire_slow: retire the test processes which are much slower than the others
+        :type retire_slow: bool
+        :param speculate: run the copies of the longest running tests on the idle test processes
+        :type speculate: bool
+        :param affinity: assign whole test modules to the test nodes
+        :type affinity: bool
+        :param collected: optional `dict` of the test files collected by the test processes in form
+            {<test process id>: {<test file>, ...}}, test processes which are not given collected all the test files
+        :type collected: dict
+        """
+        super(CloudLoadScheduling, self).__init__(config, log=log)
+        self.speeds = speeds
+        self.durations = durations
+        # estimated durations in the collection order, set once the collection is known
+        self.estimates = None
+        self.predicted_makespan = None
+        self.started = None
+        self.finished = None
+        self.retire_slow = retire_slow
+        # test process: [<number of tests completed>, <total duration>, <total estimated duration>]
+        self.node2stats = {}
+        self.speculate = speculate
+        # test process: time its current test started
+        self.node2started = {}
+        # test process: (<node id>, <phase>, <safe to run more than once>) of its last test report
+        self.node2report = {}
+        # node id of the test run more than once: [<test index>, <test process which reported the result first>]
+        self.speculated = {}
+        # test processes stopped as they run only the copy of the test which lost
+        self.abandoned = set()
+        self.affinity = affinity
+        # test modules in the collection order, set once the collection is known
+        self.index2module = None
+        # test module: hostname of the test node it's assigned to
+        self.module2host = None
+        self.collected = collected
+
+    def get_weight(self, node):
+        """Get the weight of the test process, relative to the average of all the test processes.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+
+        :return: weight of the test process, 1 for the average one
+        :rtype: float
+        """
+        if not self.speeds:
+            return 1
+        observed = dict(
+            (other, count / total)
+            for other, (count, total, _) in self.node2stats.items()
+            if other in self.node2pending and count >= THROUGHPUT_MIN_TESTS and total
+        )
+        if node in observed and len(observed) == len(self.node2pending):
+            speeds = observed
+        else:
+            speeds = dict(
+                (other, self.speeds.get(get_host(other), 0))
+                for other in self.node2pending
+            )
+        average = sum(speeds.values()) / len(speeds)
+        if not average or not speeds.get(node):
+            return 1
+        return speeds[node] / average
+
+    def get_slowdowns(self):
+        """Get how slow the test processes run the tests.
+
+        :return: `dict` of the test processes which completed enough tests in form {<test process>: <slowdown>},
+            slowdown is the ratio of the actual and the estimated durations if the estimates are known, or the average
+            test duration
+        :rtype: dict
+        """
+        return dict(
+            (node, total / expected if expected else total / count)
+            for node, (count, total, expected) in self.node2stats.items()
+            if node in self.node2pending and count >= THROUGHPUT_MIN_TESTS
+        )
+
+    def check_retire(self, node):
+        """Retire the test process if it runs the tests much slower than the others."""
+        if node.shutting_down or not any(
+            not other.shutting_down for other in self.node2pending if other is not node
+        ):
+            return
+        slowdowns = self.get_slowdowns()
+        peers = sorted(
+            slowdown for other, slowdown in slowdowns.items() if other is not node
+        )
+        if node not in slowdowns or not peers:
+            return
+        median = peers[len(peers) // 2]
+        if median and slowdowns[node] > RETIRE_SLOWDOWN * median:
+            self.log("retiring slow test process", node.gateway.id)
+            # the first two tests may be running already, stealing needs pytest-xdist 3.2 or newer
+            indices = self.node2pending[node][2:]
+            if indices and hasattr(node, "send_steal"):
+                node.send_steal(indices)
+            node.shutdown()
+
+    def remove_pending_tests_from_node(self, node, indices):
+        """Take back the tests stolen from the retired test process and send them to the others."""
+        for index in indices:
+            self.node2pending[node].remove(index)
+        self.pending[:0] = indices
+        for other in self.node2pending:
+            self.check_schedule(other)
+
+    def remove_lost_node(self, node):
+        """Remove the test process of the lost test node, sending all its tests to the other test processes.
+
+        Unlike for the crashed test process, the test which was running is not reported as failed but sent again,
+        first of all.
+        """
+        pending = self.node2pending.pop(node)
+        self.pending[:0] = pending
+        for other in self.node2pending:
+            self.check_schedule(other)
+
+    def accept_report(self, node, report):
+        """Check if the test report should be passed on.
+
+        Reports of the copy of the test run more than once are passed on only if the copy reported the result first.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+        :param report: test report
+        :type report: pytest.TestReport
+
+        :return: True if the test report should be passed on
+        :rtype: bool
+        """
+        if not self.speculate:
+            return True
+        self.node2report[node] = (
+            report.nodeid,
+            report.when,
+            SPECULATIVE_MARKER in report.keywords,
+        )
+        if report.nodeid not in self.speculated:
+            return True
+        index, winner = self.speculated[report.nodeid]
+        if report.when == "setup":
+            # the setup of the test was reported before the copy was sent
+            return False
+        if report.when == "call" and winner is None:
+            self.speculated[report.nodeid][1] = winner = node
+            for other, pending in self.node2pending.items():
+                if other is not node and pending == [index]:
+                    self.abandon(other)
+        return winner is node
+
+    def abandon(self, node):
+        """Stop the test process which runs only the copy of the test which lost."""
+        self.log("stopping", node.gateway.id, "running the copy of the test which lost")
+        del self.node2pending[node][:]
+        self.abandoned.add(node)
+        node.gateway._io.kill()  # pylint: disable=W0212
+
+    def send_speculative(self, node):
+        """Send the copy of the test which runs longest on the other test node to the idle test process."""
+        candidates = []
+        for other, pending in self.node2pending.items():
+            if other is node or not pending or get_host(other) == get_host(node):
+                continue
+            nodeid = self.collection[pending[0]]
+            # the test is running and is safe to run more than once
+            if (
+                self.node2report.get(other) == (nodeid, "setup", True)
+                and nodeid not in self.speculated
+                and self.is_collected(node, pending[0])
+            ):
+                candidates.append((self.node2started.get(other, 0), pending[0]))
+        if candidates:
+            _, index = min(candidates)
+            self.log("speculating", self.collection[index], "on", node.gateway.id)
+            self.speculated[self.collection[index]] = [index, None]
+            self.node2pending[node].append(index)
+            node.send_runtest_some([index])
+
+    def check_schedule(self, node, duration=0):
+        """Maybe schedule new tests on the test process, or the copy of the longest running test once there's none."""
+        if (
+            self.speculate
+            and not self.pending
+            and self.collection is not None
+            and not node.shutting_down
+            and len(self.node2pending[node]) < 2
+        ):
+            self.send_speculative(node)
+        super(CloudLoadScheduling, self).check_schedule(node, duration=duration)
+
+    def mark_test_complete(self, node, item_index, duration=0):
+        """Mark test item as completed by the test process, collecting its throughput.
+
+        Completion of the copy of the test which lost, sent before the test process was stopped, is ignored.
+        """
+        if node in self.abandoned:
+            return
+        now = time.time()
+        self.node2started[node] = now
+        speculated = self.speculated.get(self.collection[item_index])
+        # the copy of the test which lost is not counted
+        if speculated is None or speculated[1] in (None, node):
+            stats = self.node2stats.setdefault(node, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            if self.estimates is not None:
+                stats[2] += self.estimates[item_index]
+            self.finished = now
+        super(CloudLoadScheduling, self).mark_test_complete(
+            node, item_index, duration=duration
+        )
+        if self.retire_slow:
+            self.check_retire(node)
+
+    def sort_pending(self):
+        """Sort the pending tests longest first, once the collection is known."""
+        self.estimates = get_estimates(self.collection, self.durations)
+        self.pending.sort(key=lambda index: -self.estimates[index])
+        self.predicted_makespan = get_makespan(self.estimates, len(self.node2pending))
+        self.started = time.time()
+
+    def get_modules(self):
+        """Get the test modules in the collection order.
+
+        :return: `list` of the test module paths
+        :rtype: list
+        """
+        if self.index2module is None:
+            self.index2module = [nodeid.split("::")[0] for nodeid in self.collection]
+        return self.index2module
+
+    def is_collected(self, node, index):
+        """Check if the test process collected the test.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+        :param index: test index
+        :type index: int
+
+        :return: True if the test can be sent to the test process
+        :rtype: bool
+        """
+        files = (self.collected or {}).get(node.gateway.id)
+        return files is None or self.get_modules()[index] in files
+
+    def prefer_collected(self, node, host=None):
+        """Put the pending tests collected by the test process first.
+
+        With the host affinity, only the collected tests of the test modules assigned to the test node are counted.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+        :param host: optional hostname of the test node, given with the host affinity
+        :type host: str
+
+        :return: number of the pending tests collected by the test process
+        :rtype: int
+        """
+        files = self.collected.get(node.gateway.id)
+        if files is None:
+            return len(self.pending)
+        index2module = self.get_modules()
+        own = [index for index in self.pending if index2module[index] in files]
+        if host is not None:
+            own = [
+                index for index in own if self.module2host[index2module[index]] == host
+            ]
+        preferred = set(own)
+        self.pending[:] = own + [
+            index for index in self.pending if index not in preferred
+        ]
+        return len(own)
+
+    def check_collected_done(self, node):
+        """Shut down the test process which has a single pending test and no more pending tests it collected.
+
+        The test process needs at least two pending tests to run them, and it can't be given the tests of the test files
+        it did not collect, so it's shut down to run its last test.
+
+        :param node: test process
+        :type node: xdist.workermanage.WorkerController
+        """
+        host = get_host(node) if self.affinity else None
+        if (
+            not node.shutting_down
+            and len(self.node2pending[node]) == 1
+            and not any(
+                self.is_collected(node, index)
+                and (host is None or self.module2host[self.index2module[index]] == host)
+                for index in self.pending
+            )
+        ):
+            node.shutdown()
+
+    def assign_modules(self):
+        """Assign the test modules to the test nodes, longest first, balanced by the capacity of the test nodes."""
+        self.get_modules()
+        sizes = {}
+        for index, module in enumerate(self.index2module):
+            sizes[module] = sizes.get(module, 0) + (
+                self.estimates[index] if self.estimates is not None else 1
+            )
+        capacities = {}
+        for node in self.node2pending:
+            host = get_host(node)
+            capacities[host] = capacities.get(host, 0) + (
+                (self.speeds or {}).get(host) or 1
+            )
+        loads = dict((host, 0) for host in capacities)
+        self.module2host = {}
+        for module in sorted(sizes, key=lambda module: -sizes[module]):
+            host = min(loads, key=lambda host: loads[host] / capacities[host])
+            loads[host] += sizes[module]
+            self.module2host[module] = host
+
+    def prefer_host(self, host):
+        """Put the pending tests of the test modules assigned to the test node first.
+
+        Test node which has no more pending tests takes over the last test module of the test node with the most
+        pending tests.
+
+        :param host: hostname of the test node
+        :type host: str
+
+        :return: number of the pending tests of the test node
+        :rtype: int
+        """
+        if self.module2host is None:
+            self.assign_modules()
+        module2host = self.module2host
+        index2module = self.index2module
+        own = [
+            index for index in self.pending if module2host[index2module[index]] == host
+        ]
+        if not own and self.pending:
+            counts = {}
+            for index in self.pending:
+                other = module2host[index2module[index]]
+                counts[other] = counts.get(other, 0) + 1
+            victim = max(counts, key=counts.get)
+            module = index2module[
+                [
+                    index
+                    for index in self.pending
+                    if module2host[index2module[index]] == victim
+                ][-1]
+            ]
+            self.log("moving", module, "from", victim, "to", host)
+            module2host[module] = host
+            own = [index for index in self.pending if index2module[index] == module]
+        if own:
+            preferred = set(own)
+            self.pending[:] = own + [
+                index for index in self.pending if index not in preferred
+            ]
+        return len(own)
+
+    def _send_tests(self, node, num):
+        """Send the chunk of tests weighted by the test process speed, limited by the estimated duration."""
+        weight = self.get_weight(node)
+        if self.speeds:
+            # the test process needs at least two pending tests to run them
+            num = max(2 - len(self.node2pending[node]), int(round(num * weight)))
+        if self.durations and self.estimates is None:
+            self.sort_pending()
+        # number of the pending tests at the front which can be sent to the test process
+        limit = len(self.pending)
+        if self.affinity:
+            # the test process needs at least two pending tests to run them
+            limit = max(
+                self.prefer_host(get_host(node)), 2 - len(self.node2pending[node])
+            )
+        if self.collected:
+            limit = min(
+                limit,
+                self.prefer_collected(
+                    node, host=get_host(node) if self.affinity else None
+                ),
+            )
+            if not limit:
+                self.check_collected_done(node)
+                return
+        num = min(num, limit)
+        if self.durations:
+            budget = (
+                sum(self.estimates[index] for index in self.pending)
+                / len(self.node2pending)
+                / 4
+                * weight
+            )
+            count = 1
+            total = self.estimates[self.pending[0]] if self.pending else 0
+            while count < num and count < len(self.pending):
+                total += self.estimates[self.pending[count]]
+                if total > budget:
+                    break
+                count += 1
+            # the test process needs at least two pending tests to run them, so the long test is paired with
+            # the shortest one
+            if count < min(num, 2 - len(self.node2pending[node]), len(self.pending)):
+                self.pending.insert(
+                    count, self.pending.pop(min(limit, len(self.pending)) - 1)
+                )
+                count += 1
+            num = count
+        super(CloudLoadScheduling, self)._send_tests(node, num)
+        if self.collected:
+            self.check_collected_done(node)
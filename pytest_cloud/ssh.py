@@ -0,0 +1,63 @@
+"""Shared ssh connections."""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+# pylint: disable=R0205
+class SSHMultiplexer(object):
+    """Single multiplexed ssh master connection per test node.
+
+    All the ssh clients started with the options of the multiplexer (execnet gateways, rsync) share one
+    ssh connection per test node, so the key exchange happens only once per node.
+    The control sockets live in the temporary directory owned by the multiplexer.
+    Master connections persist for a while after the last client is gone, so that the connections made during the
+    test nodes detection are still there for the test workers, and don't stay forever if the test run is aborted.
+    """
+
+    persist = 60
+
+    def __init__(self):
+        """Initialize new SSHMultiplexer instance."""
+        # keep the path short, unix socket paths are limited to about 100 characters
+        self.control_dir = tempfile.mkdtemp(prefix="pytest-cloud-")
+        self.nodes = set()
+
+    def get_options(self):
+        """Get ssh command line options to use the shared connection."""
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            "ControlPath={0}".format(os.path.join(self.control_dir, "%C")),
+            "-o",
+            "ControlPersist={0}".format(self.persist),
+        ]
+
+    def get_ssh_args(self, node):
+        """Get ssh arguments for the node to use in the execnet ssh gateway spec.
+
+        :param node: node name in form [<username>@]<hostname>
+        :type node: str
+
+        :return: ssh arguments in form '-o ControlMaster=auto ... <node>'
+        :rtype: str
+        """
+        self.nodes.add(node)
+        return " ".join(self.get_options() + [node])
+
+    def close(self):
+        """Stop the master connections and remove the control sockets."""
+        try:
+            for node in self.nodes:
+                with open(os.devnull, "w") as devnull:
+                    subprocess.call(
+                        ["ssh"] + self.get_options() + ["-O", "exit", node],
+                        stdout=devnull,
+                        stderr=devnull,
+                    )
+        finally:
+            self.nodes.clear()
+            shutil.rmtree(self.control_dir, ignore_errors=True)
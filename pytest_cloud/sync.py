@@ -0,0 +1,474 @@
+"""Directory structure sync over execnet channels.
+
+The module is executed on the remote side as well (via `remote_exec`), so it must only depend on the standard library.
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import tarfile
+import time
+import zlib
+
+# maximum amount of raw file data to pack into a single message
+BATCH_SIZE = 1024 * 1024
+
+# file in the target directory keeping the fingerprint of the last synced directory structure
+SYNC_MARKER = ".pytest-cloud-sync"
+
+
+def is_ignored(path, ignores):
+    """Check if relative path matches any of the rsync-like ignore patterns.
+
+    Patterns without a slash match the base name on any level, other patterns match the whole relative path.
+    """
+    name = os.path.basename(path)
+    for pattern in ignores:
+        pattern = pattern.rstrip("/")
+        if "/" in pattern:
+            if fnmatch.fnmatch(path, pattern.lstrip("/")):
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def get_manifest(sourcedir, ignores=None):
+    """Get the manifest of the directory structure.
+
+    :param sourcedir: directory to get the manifest for
+    :type sourcedir: str
+    :param ignores: optional list of rsync-like ignore patterns
+    :type ignores: list
+
+    :return: `dict` in form {<relative path>: (<kind>, <size>, <mtime>, <mode>)}, where kind is one of
+        'd' (directory), 'f' (file) or 'l' (symbolic link), symbolic links have the link target instead of the mode
+    :rtype: dict
+    """
+    ignores = ignores or []
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(sourcedir):
+        reldir = os.path.relpath(dirpath, sourcedir)
+        for name in list(dirnames) + filenames:
+            path = os.path.normpath(os.path.join(reldir, name))
+            if is_ignored(path, ignores):
+                if name in dirnames:
+                    dirnames.remove(name)
+                continue
+            fullpath = os.path.join(dirpath, name)
+            info = os.lstat(fullpath)
+            if stat.S_ISLNK(info.st_mode):
+                if name in dirnames:
+                    # do not follow symbolic links to directories
+                    dirnames.remove(name)
+                manifest[path] = ("l", 0, 0, os.readlink(fullpath))
+            elif stat.S_ISDIR(info.st_mode):
+                # directory size and modification time change with its contents, so they are not compared
+                manifest[path] = ("d", 0, 0, stat.S_IMODE(info.st_mode))
+            elif stat.S_ISREG(info.st_mode):
+                manifest[path] = (
+                    "f",
+                    info.st_size,
+                    int(info.st_mtime),
+                    stat.S_IMODE(info.st_mode),
+                )
+    return manifest
+
+
+def get_fingerprint(manifest):
+    """Get the fingerprint of the directory structure manifest."""
+    return hashlib.sha1(
+        json.dumps(sorted(manifest.items())).encode("utf-8")
+    ).hexdigest()
+
+
+def read_sync_marker(channel, path):
+    """Read the fingerprint of the last synced directory structure.
+
+    Executed on the remote side.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    :param path: path to the sync marker file
+    :type path: str
+    """
+    try:
+        with open(path) as fd:
+            channel.send(fd.read().strip())
+    except IOError:
+        channel.send(None)
+
+
+def write_sync_marker(channel, path, fingerprint):
+    """Write the fingerprint of the synced directory structure.
+
+    Executed on the remote side.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    :param path: path to the sync marker file
+    :type path: str
+    :param fingerprint: fingerprint of the synced directory structure
+    :type fingerprint: str
+    """
+    with open(path, "w") as fd:
+        fd.write(fingerprint)
+
+
+def is_empty(channel, path):
+    """Check if the current working directory is empty, apart from the sync marker.
+
+    Executed on the remote side.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    :param path: path to the sync marker file
+    :type path: str
+    """
+    import os  # pylint: disable=W0404,W0621,C0415
+
+    names = os.listdir(".")
+    if path in names:
+        names.remove(path)
+    channel.send(not names)
+
+
+# pylint: disable=R0903,R0205
+class ChannelReader(object):
+    """Read decompressed archive data sent by ArchiveWriter from the channel."""
+
+    def __init__(self, channel):
+        """Initialize new ChannelReader instance."""
+        self.channel = channel
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b""
+        self.eof = False
+
+    def read(self, size):
+        """Read up to size bytes, less only at the end of the stream."""
+        while len(self.buffer) < size and not self.eof:
+            data = self.channel.receive()
+            if data is None:
+                self.eof = True
+                self.buffer += self.decompressor.flush()
+            else:
+                self.buffer += self.decompressor.decompress(data)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def extract_archive(channel):
+    """Extract the compressed tar archive streamed over the channel into the current working directory.
+
+    Executed on the remote side.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    """
+    with tarfile.open(fileobj=ChannelReader(channel), mode="r|") as tar:
+        if hasattr(tarfile, "tar_filter"):
+            tar.extractall(filter="tar")
+        else:
+            tar.extractall()
+
+
+# pylint: disable=R0903,R0205
+class ArchiveWriter(object):
+    """Compress archive data and send it to several channels at once."""
+
+    def __init__(self, channels, level=6):
+        """Initialize new ArchiveWriter instance."""
+        self.channels = channels
+        self.compressor = zlib.compressobj(level)
+        self.buffer = b""
+        self.bytes = 0
+        self.compressed_bytes = 0
+
+    def write(self, data):
+        """Compress the data, send the compressed data once there's enough of it."""
+        self.bytes += len(data)
+        self.buffer += self.compressor.compress(data)
+        if len(self.buffer) >= BATCH_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """Send the compressed data."""
+        if self.buffer:
+            self.compressed_bytes += len(self.buffer)
+            for channel in self.channels:
+                channel.send(self.buffer)
+            self.buffer = b""
+
+    def close(self):
+        """Send the rest of the compressed data and the end of the stream."""
+        self.buffer += self.compressor.flush()
+        self.flush()
+        for channel in self.channels:
+            channel.send(None)
+
+
+def send_archive(sourcedir, manifest, gateways, quiet=False):
+    """Stream the directory structure as the compressed tar archive to all the gateways at once.
+
+    The archive is built and compressed only once, for all the gateways, gateways have to run in the target directory.
+    Intended for the empty target directories, as it does a single round trip instead of comparing the files.
+
+    :param sourcedir: directory to send
+    :type sourcedir: str
+    :param manifest: manifest of the directory to send
+    :type manifest: dict
+    :param gateways: `list` of gateways to send the archive to
+    :type gateways: list
+    :param quiet: do not print the transfer statistics
+    :type quiet: bool
+
+    :return: `dict` with the transfer statistics in form
+        {'files': 1, 'bytes': 100, 'compressed_bytes': 50, 'duration': 0.1}
+    :rtype: dict
+    """
+    start = time.time()
+    channels = []
+    for gateway in gateways:
+        channel = gateway.remote_exec(sys.modules[__name__])
+        channel.send(("archive",))
+        channels.append(channel)
+    writer = ArchiveWriter(channels)
+    with tarfile.open(fileobj=writer, mode="w|") as tar:
+        for path in sorted(manifest):
+            tar.add(os.path.join(sourcedir, path), arcname=path, recursive=False)
+    writer.close()
+    for channel in channels:
+        channel.receive()
+        channel.waitclose()
+    stats = dict(
+        files=len(manifest),
+        bytes=writer.bytes,
+        compressed_bytes=writer.compressed_bytes,
+        duration=time.time() - start,
+    )
+    if not quiet:
+        print(
+            "Streamed {files} files, {bytes} bytes ({compressed_bytes} compressed) "
+            "in {duration:.2f}s".format(**stats)
+        )
+    return stats
+
+
+def get_changes(local, remote, protects=None):
+    """Get the changes needed to turn the remote manifest into the local one.
+
+    :param protects: optional list of rsync-like patterns of the remote paths which are not deleted if they don't
+        exist locally
+    :type protects: list
+
+    :return: `tuple` of the paths to delete and the paths to send
+    :rtype: tuple
+    """
+    protects = protects or []
+    delete = sorted(
+        path
+        for path, entry in remote.items()
+        if (path not in local and not is_ignored(path, protects))
+        or (path in local and local[path][0] != entry[0])
+    )
+    send = sorted(
+        path
+        for path, entry in local.items()
+        if entry != remote.get(path) or path in delete
+    )
+    return delete, send
+
+
+def serve(channel):
+    """Receive the directory structure into the current working directory.
+
+    Executed on the remote side.
+    The first message selects the mode: ('archive',) to extract the streamed archive, or
+    ('changes', <ignores>, <walk>) to receive the changed files, after which the time it took is sent back.
+
+    :param channel: execnet channel for communication with master node
+    :type channel: execnet.gateway_base.Channel
+    """
+    start = time.time()
+    command = channel.receive()
+    if command[0] == "archive":
+        extract_archive(channel)
+        channel.send(None)
+        return
+    _, ignores, walk = command
+    if walk:
+        channel.send(get_manifest(".", ignores))
+    while True:
+        command = channel.receive()
+        if command is None:
+            break
+        kind, items = command
+        if kind == "delete":
+            # reverse order removes directory contents before the directories
+            for path in reversed(items):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                elif os.path.lexists(path):
+                    os.unlink(path)
+        elif kind == "files":
+            for path, (kind, _, mtime, mode), data in items:
+                if kind == "d":
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    os.chmod(path, mode)
+                    continue
+                dirname = os.path.dirname(path)
+                if dirname and not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                if os.path.lexists(path):
+                    os.unlink(path)
+                if kind == "l":
+                    os.symlink(mode, path)
+                    continue
+                with open(path, "wb") as fd:
+                    fd.write(zlib.decompress(data))
+                os.chmod(path, mode)
+                os.utime(path, (mtime, mtime))
+    channel.send(time.time() - start)
+
+
+# pylint: disable=R0902,R0205
+class ExecnetSync(object):
+    """Send a directory structure (recursively) to one or multiple remote filesystems over execnet gateways.
+
+    Only the files which differ in size or modification time are sent, compressed and packed in batches.
+    Files which do not exist on the master are deleted on the remote side.
+    """
+
+    # pylint: disable=R0913,W0613
+    def __init__(
+        self,
+        sourcedir,
+        targetdir,
+        gateways=None,
+        verbose=False,
+        ignores=None,
+        protects=None,
+        quiet=False,
+        **kwargs
+    ):
+        """Initialize new ExecnetSync instance.
+
+        :param gateways: `dict` in form {<target host>: <gateway>}, gateways have to run in the target directory
+        :param protects: patterns of the files on the targets which are excluded from the sync, but should not be
+            deleted
+        :param quiet: do not print the transfer statistics
+        """
+        self.sourcedir = str(sourcedir)
+        self.targetdir = str(targetdir)
+        self.gateways = gateways if gateways is not None else {}
+        self.verbose = verbose
+        self.ignores = ignores or []
+        self.protects = protects or []
+        self.quiet = quiet
+        self.targets = set()
+        # targets synced by the last send
+        self.synced = set()
+        # time it took to sync each target by the last send, in seconds
+        self.durations = {}
+
+    def get_ignores(self):
+        """Get ignores."""
+        cwd = os.path.abspath(".")
+        ignores = []
+        for ignore in self.ignores:
+            path = os.path.abspath(str(ignore))
+            if path.startswith(cwd + os.path.sep):
+                ignores.append(os.path.relpath(path, cwd))
+        return ignores
+
+    def send(self, raises=True, manifest=None, remote_manifests=None):
+        """Send a sourcedir to all added targets.
+
+        :param manifest: optional, already known manifest of the sourcedir
+        :type manifest: dict
+        :param remote_manifests: optional, already known manifests of the targets in form {<target>: <manifest>},
+            given targets are not walked
+        :type remote_manifests: dict
+
+        :return: `dict` with the transfer statistics in form
+            {'files': 1, 'bytes': 100, 'compressed_bytes': 50, 'duration': 0.1}
+        :rtype: dict
+        """
+        start = time.time()
+        ignores = self.get_ignores()
+        if manifest is None:
+            manifest = get_manifest(self.sourcedir, ignores)
+        remote_manifests = remote_manifests or {}
+        channels = {}
+        for target in self.targets:
+            channel = self.gateways[target].remote_exec(sys.modules[__name__])
+            channel.send(("changes", ignores, target not in remote_manifests))
+            channels[target] = channel
+        wanted = {}
+        # number of the files each target still waits for
+        remaining = {}
+        for target, channel in channels.items():
+            remote_manifest = remote_manifests.get(target)
+            if remote_manifest is None:
+                remote_manifest = channel.receive()
+            delete, send = get_changes(manifest, remote_manifest, self.protects)
+            if delete:
+                channel.send(("delete", delete))
+            for path in send:
+                wanted.setdefault(path, []).append(channel)
+            remaining[channel] = len(send)
+            if not send:
+                channel.send(None)
+        stats = dict(files=0, bytes=0, compressed_bytes=0)
+        batches = {}
+        sizes = {}
+        for path in sorted(wanted):
+            entry = manifest[path]
+            kind = entry[0]
+            fullpath = os.path.join(self.sourcedir, path)
+            if kind == "f":
+                with open(fullpath, "rb") as fd:
+                    data = fd.read()
+            else:
+                data = b""
+            compressed = zlib.compress(data)
+            stats["files"] += 1
+            stats["bytes"] += len(data)
+            stats["compressed_bytes"] += len(compressed)
+            for channel in wanted[path]:
+                batches.setdefault(channel, []).append((path, entry, compressed))
+                sizes[channel] = sizes.get(channel, 0) + len(data)
+                remaining[channel] -= 1
+                if sizes[channel] >= BATCH_SIZE or not remaining[channel]:
+                    channel.send(("files", batches.pop(channel)))
+                    sizes[channel] = 0
+                if not remaining[channel]:
+                    # the target finishes without waiting for the files of the other targets
+                    channel.send(None)
+        self.durations = {}
+        for target, channel in channels.items():
+            # each target measures the time it took itself
+            self.durations[target] = channel.receive()
+            channel.waitclose()
+        self.synced = set(self.targets)
+        stats["duration"] = time.time() - start
+        if not self.quiet:
+            print(
+                "Sent {files} files, {bytes} bytes ({compressed_bytes} compressed) "
+                "in {duration:.2f}s".format(**stats)
+            )
+        return stats
+
+    def add_target_host(self, host):
+        """Add a remote target."""
+        self.targets.add(host)
+
+
+if __name__ == "__channelexec__":
+    serve(channel)  # pylint: disable=E0602
@@ -0,0 +1,94 @@
+"""Timings of the test run phases."""
+import contextlib
+import json
+import threading
+import time
+
+
+# pylint: disable=R0205
+class Timings(object):
+    """Timings of the test run phases, in aggregate and per test node or test process.
+
+    Each phase keeps the wall clock span it took on the master and the time it took for each test node or
+    test process, which may overlap as the test nodes are set up in parallel.
+    """
+
+    def __init__(self):
+        """Initialize new Timings instance."""
+        self.started = time.time()
+        # phases in form {<name>: [<start>, <end>, {<node>: <seconds>}]}
+        self.phases = {}
+        # the test nodes may be set up in the background during the test run
+        self.lock = threading.Lock()
+
+    def add(self, phase, start, end, node=None):
+        """Add the span of the phase.
+
+        :param phase: name of the phase
+        :type phase: str
+        :param start: time the phase started at
+        :type start: float
+        :param end: time the phase ended at
+        :type end: float
+        :param node: optional test node hostname or test process id the phase took the time for
+        :type node: str
+        """
+        with self.lock:
+            span = self.phases.setdefault(phase, [start, end, {}])
+            span[0] = min(span[0], start)
+            span[1] = max(span[1], end)
+            if node is not None:
+                span[2][node] = span[2].get(node, 0) + end - start
+
+    @contextlib.contextmanager
+    def measure(self, phase, node=None):
+        """Measure the span of the phase as the context.
+
+        :param phase: name of the phase
+        :type phase: str
+        :param node: optional test node hostname or test process id the phase takes the time for
+        :type node: str
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, start, time.time(), node=node)
+
+    def get_report(self):
+        """Get the report of the phases timings, ordered by the start time.
+
+        :return: `dict` in form {"started": <timestamp>, "duration": <seconds>, "phases": [{"name": <name>,
+            "start": <seconds since started>, "duration": <seconds>, "nodes": {<node>: <seconds>}, "total": <seconds>,
+            "max": <seconds>}, ...]}
+        :rtype: dict
+        """
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda item: item[1][0])
+            return dict(
+                started=self.started,
+                duration=time.time() - self.started,
+                phases=[
+                    dict(
+                        name=name,
+                        start=start - self.started,
+                        duration=end - start,
+                        nodes=dict(nodes),
+                        total=sum(nodes.values()),
+                        max=max(nodes.values()) if nodes else None,
+                    )
+                    for name, (start, end, nodes) in phases
+                ],
+            )
+
+
+def write_report(report, path):
+    """Write the timings report as JSON.
+
+    :param report: timings report
+    :type report: dict
+    :param path: path to write the report to
+    :type path: str
+    """
+    with open(path, "w") as fd:
+        json.dump(report, fd, indent=2, sort_keys=True)
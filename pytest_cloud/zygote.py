@@ -0,0 +1,178 @@
+"""Zygote process forking the test processes on the test node.
+
+Executed on the remote side as a standalone script, so it only uses the standard library.
+
+``zygote.py serve <socket path> [<module> ...]`` preloads the modules and forks a test process for each connection to
+the unix socket. ``zygote.py connect <socket path>`` is started by execnet in place of the python interpreter: it hands
+its standard streams to the forked test process and exits with its exit status.
+"""
+import array
+import importlib
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+
+# time to wait for the connections after the last test process exited, in seconds
+IDLE_TIMEOUT = 60
+# time between the checks for the exited test processes, in seconds
+POLL_INTERVAL = 0.5
+
+
+def send_fds(sock, fds):
+    """Send the file descriptors over the unix socket.
+
+    :param sock: connected unix socket
+    :type sock: socket.socket
+    :param fds: `list` of the file descriptors
+    :type fds: list
+    """
+    sock.sendmsg(
+        [b"1"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    )
+
+
+def receive_fds(sock, count):
+    """Receive the file descriptors over the unix socket.
+
+    :param sock: connected unix socket
+    :type sock: socket.socket
+    :param count: number of the file descriptors
+    :type count: int
+
+    :return: `list` of the file descriptors
+    :rtype: list
+    """
+    fds = array.array("i")
+    _, ancdata, _, _ = sock.recvmsg(1, socket.CMSG_LEN(count * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[: len(data) - len(data) % fds.itemsize])
+    return list(fds)
+
+
+def get_exit_status(status):
+    """Get the exit status of the process from the status returned by `os.waitpid`."""
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_child(fds):
+    """Run the test process in the forked child, as if it was started with `python -u -c <execnet bootstrap line>`.
+
+    :param fds: file descriptors of the standard input, output and error
+    :type fds: list
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin = os.fdopen(0, "r")
+    sys.stdout = os.fdopen(1, "w", 1)
+    sys.stderr = os.fdopen(2, "w", 1)
+    # the bootstrap line is read unbuffered, as the following input belongs to the gateway
+    line = b""
+    while not line.endswith(b"\n"):
+        char = os.read(0, 1)
+        if not char:
+            os._exit(1)  # pylint: disable=W0212
+        line += char
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+    try:
+        exec(eval(line.decode("utf-8")), namespace)  # pylint: disable=W0122,W0123
+    except SystemExit as exc:
+        os._exit(exc.code if isinstance(exc.code, int) else 1)  # pylint: disable=W0212
+    except BaseException:  # pylint: disable=W0703
+        os._exit(1)  # pylint: disable=W0212
+    sys.stdout.flush()
+    os._exit(0)  # pylint: disable=W0212
+
+
+def serve(path, modules):
+    """Preload the modules and fork the test process for each connection.
+
+    :param path: path to the unix socket to listen on
+    :type path: str
+    :param modules: `list` of the module names to preload
+    :type modules: list
+    """
+    # the test processes see the current directory first, as with `python -c`
+    sys.path[0] = ""
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception:  # pylint: disable=W0703
+            # the test process will fail to import it as well, reporting the error
+            pass
+    # terminated zygote still removes its socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    server.settimeout(POLL_INTERVAL)
+    children = {}
+    idle_since = time.time()
+    try:
+        while children or time.time() - idle_since < IDLE_TIMEOUT:
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                conn = children.pop(pid)
+                conn.sendall(struct.pack("i", get_exit_status(status)))
+                conn.close()
+                idle_since = time.time()
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            fds = receive_fds(conn, 3)
+            pid = os.fork()
+            if not pid:
+                server.close()
+                conn.close()
+                run_child(fds)
+            for fd in fds:
+                os.close(fd)
+            children[pid] = conn
+    finally:
+        server.close()
+        os.remove(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        if os.path.dirname(os.path.abspath(__file__)) == directory:
+            # the script and its socket are written to the temporary directory by `patches.start_zygote`
+            os.remove(os.path.abspath(__file__))
+            os.rmdir(directory)
+
+
+def connect(path):
+    """Hand the standard streams to the test process forked by the zygote and wait for it to exit.
+
+    :param path: path to the unix socket of the zygote
+    :type path: str
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    send_fds(sock, [0, 1, 2])
+    # the test process owns the standard streams now
+    with open(os.devnull, "r+") as devnull:
+        for fd in (0, 1):
+            os.dup2(devnull.fileno(), fd)
+    data = b""
+    while len(data) < 4:
+        chunk = sock.recv(4 - len(data))
+        if not chunk:
+            os._exit(1)  # pylint: disable=W0212
+        data += chunk
+    os._exit(struct.unpack("i", data)[0])  # pylint: disable=W0212
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "serve":
+        serve(sys.argv[2], sys.argv[3:])
+    else:
+        connect(sys.argv[2])
@@ -31,7 +31,6 @@ setup(
         'pytest-xdist>=1.26.0',
         'setuptools',
         'six',
-        'timeout-decorator>=0.3.2',
         'virtualenv',
     ],
     python_requires=">=3.4.*",
@@ -0,0 +1,39 @@
+"""Tests for the aggregation of the test process events."""
+import time
+
+import execnet
+import mock
+
+from pytest_cloud.aggregate import Aggregator, EventForwarder
+
+
+def test_aggregator():
+    """Test the events of the test processes are forwarded in batches and dispatched to their controllers."""
+    group = execnet.Group()
+    try:
+        aggregator = Aggregator(group.makegateway("popen//id=local"), 0.01)
+        nodes = [mock.Mock(_down=False) for _ in range(2)]
+        for index, node in enumerate(nodes):
+            node.gateway.id = "local_{0}".format(index)
+            aggregator.add_node(node)
+        forwarders = [
+            EventForwarder(aggregator.path, node.gateway.id) for node in nodes
+        ]
+        forwarders[0].sendevent("logstart", nodeid="test_a", location=None)
+        forwarders[1].sendevent("logstart", nodeid="test_b", location=None)
+        # the test process channel is closed right after, so it waits for the event to be forwarded
+        forwarders[0].sendevent("workerfinished", workeroutput={})
+        for _ in range(100):
+            if nodes[1].process_from_remote.called:
+                break
+            time.sleep(0.01)
+        aggregator.close()
+    finally:
+        group.terminate(timeout=10)
+    assert nodes[0].process_from_remote.call_args_list == [
+        mock.call(("logstart", {"nodeid": "test_a", "location": None})),
+        mock.call(("workerfinished", {"workeroutput": {}})),
+    ]
+    assert nodes[1].process_from_remote.call_args_list == [
+        mock.call(("logstart", {"nodeid": "test_b", "location": None})),
+    ]
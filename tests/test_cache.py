@@ -0,0 +1,42 @@
+"""Tests for the state kept in the pytest cache."""
+import mock
+
+from pytest_cloud.cache import (
+    CapabilitiesCache,
+    get_mem_per_process,
+    set_mem_per_process,
+)
+
+
+def test_capabilities_cache():
+    """Test the capabilities are used within ttl, and the calibration score is kept."""
+    values = {}
+    cache = mock.Mock()
+    cache.get.side_effect = values.get
+    cache.set.side_effect = values.__setitem__
+    with mock.patch("time.time", return_value=1000):
+        CapabilitiesCache(cache, 60).update(
+            {"1.example.com": dict(cpu_count=2, speed=5)}
+        )
+    with mock.patch("time.time", return_value=1030):
+        caps_cache = CapabilitiesCache(cache, 60)
+        assert caps_cache.get("1.example.com") == dict(cpu_count=2, speed=5)
+        assert caps_cache.get("2.example.com") is None
+        caps_cache.update({"1.example.com": dict(cpu_count=4, speed=None)})
+    with mock.patch("time.time", return_value=1080):
+        assert CapabilitiesCache(cache, 60).get("1.example.com") == dict(
+            cpu_count=4, speed=5
+        )
+    with mock.patch("time.time", return_value=1100):
+        assert CapabilitiesCache(cache, 60).get("1.example.com") is None
+
+
+def test_mem_per_process():
+    """Test the measured memory per process is remembered."""
+    values = {}
+    cache = mock.Mock()
+    cache.get.side_effect = values.get
+    cache.set.side_effect = values.__setitem__
+    assert get_mem_per_process(cache) is None
+    set_mem_per_process(cache, 100)
+    assert get_mem_per_process(cache) == 100
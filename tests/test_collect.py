@@ -0,0 +1,55 @@
+"""Tests for the collection of the tests once per test run."""
+import os
+
+import mock
+
+import pytest_cloud
+from pytest_cloud.collect import (
+    CollectPlaceholder,
+    fill_collection,
+    finish_collection,
+    get_collect_files,
+    start_collection,
+)
+
+
+def test_get_collect_files():
+    """Test the test files are partitioned among the test processes of each test node."""
+    ids = (
+        ["a.py::test_{0}".format(i) for i in range(4)]
+        + ["b.py::test_{0}".format(i) for i in range(2)]
+        + ["c.py::test_{0}".format(i) for i in range(2)]
+    )
+    assert get_collect_files(
+        ids, ["1.example.com_0", "1.example.com_1", "2.example.com_0"]
+    ) == {
+        "1.example.com_0": ["a.py"],
+        "1.example.com_1": ["b.py", "c.py"],
+        "2.example.com_0": ["a.py", "b.py", "c.py"],
+    }
+
+
+def test_fill_collection():
+    """Test the collection is filled up with the placeholders in the order of the master."""
+    first, second = mock.Mock(nodeid="b.py::test_1"), mock.Mock(nodeid="b.py::test_0")
+    session = mock.Mock(items=[first, second])
+    fill_collection(session, ["a.py::test_0", "b.py::test_0", "b.py::test_1"])
+    assert isinstance(session.items[0], CollectPlaceholder)
+    assert session.items[0].nodeid == "a.py::test_0"
+    assert session.items[1:] == [second, first]
+
+
+def test_collection(tmpdir, monkeypatch):
+    """Test the test node ids are collected in the subprocess."""
+    monkeypatch.setenv(
+        "PYTHONPATH", os.path.dirname(os.path.dirname(pytest_cloud.__file__))
+    )
+    monkeypatch.setenv("PYTEST_PLUGINS", "pytest_cloud.plugin")
+    tmpdir.join("test_a.py").write(
+        "def test_1():\n    pass\n\n\ndef test_2():\n    pass\n"
+    )
+    config = mock.Mock()
+    config.invocation_params.args = (str(tmpdir),)
+    config.invocation_params.dir = tmpdir
+    ids = finish_collection(*start_collection(config))
+    assert [nodeid.split("::")[1] for nodeid in ids] == ["test_1", "test_2"]
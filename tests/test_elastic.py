@@ -0,0 +1,71 @@
+"""Tests for the elastic test node pool."""
+import threading
+import time
+
+import mock
+
+from pytest_cloud.elastic import ElasticPool
+
+
+def test_retry():
+    """Test the test nodes which became connectable are added, the others are retried."""
+    get_specs = mock.Mock(
+        return_value=(["ssh=1.example.com//id=1.example.com_0"], ["2.example.com"])
+    )
+    putevent = mock.Mock()
+    pool = ElasticPool(["1.example.com", "2.example.com"], get_specs, putevent, 0)
+    pool.retry()
+    get_specs.assert_called_once_with(["1.example.com", "2.example.com"])
+    putevent.assert_called_once_with(
+        ("cloud_addnodes", {"specs": ["ssh=1.example.com//id=1.example.com_0"]})
+    )
+    assert pool.nodes == ["2.example.com"]
+
+    get_specs.side_effect = RuntimeError
+    pool.retry()
+    assert pool.nodes == ["2.example.com"]
+    assert putevent.call_count == 1
+
+
+def test_run_until_set_up():
+    """Test the test nodes are retried until all of them are set up."""
+    get_specs = mock.Mock(side_effect=[([], ["1.example.com"]), (["spec"], [])])
+    pool = ElasticPool(["1.example.com"], get_specs, mock.Mock(), 0)
+    pool.start()
+    pool.thread.join(5)
+    assert not pool.thread.is_alive()
+    assert get_specs.call_count == 2
+
+
+def test_run_attempts():
+    """Test the test nodes are retried the given number of times."""
+    get_specs = mock.Mock(return_value=([], ["1.example.com"]))
+    pool = ElasticPool(["1.example.com"], get_specs, mock.Mock(), 0, attempts=3)
+    pool.start()
+    pool.thread.join(5)
+    assert not pool.thread.is_alive()
+    assert get_specs.call_count == 3
+
+
+def test_run_shared_lock():
+    """Test the pools sharing the lock do not set up the test nodes at the same time."""
+    running = []
+    overlapped = []
+
+    def get_specs(nodes):
+        running.append(nodes)
+        overlapped.append(len(running) > 1)
+        time.sleep(0.1)
+        running.remove(nodes)
+        return [], []
+
+    lock = threading.Lock()
+    pools = [
+        ElasticPool([node], get_specs, mock.Mock(), 0, attempts=1, lock=lock)
+        for node in ["1.example.com", "2.example.com"]
+    ]
+    for pool in pools:
+        pool.start()
+    for pool in pools:
+        pool.thread.join(5)
+    assert overlapped == [False, False]
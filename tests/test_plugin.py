@@ -1,11 +1,14 @@
 """Tests for pytest-bdd-splinter subplugin."""
+import os
 import sys
+import time
 
 import mock
 import pytest
 
 import xdist.dsession
 import execnet
+import pytest_cloud.patches
 import pytest_cloud.plugin
 
 
@@ -23,6 +26,10 @@ def mocked_group(request):
     mocked_group = mock.Mock()
     request.addfinalizer(fin)
     mocked_group.mkgateway.return_value = mock.Mock()
+    # gateways belong to the group which made them
+    mocked_group.return_value.makegateway.side_effect = lambda spec: mock.Mock(
+        _group=mocked_group.return_value
+    )
     execnet.Group = mocked_group
     return mocked_group
 
@@ -226,6 +233,16 @@ def test_schedule(
             },
         ),
     ]
+    # activate_env reports the timings of its steps
+    activate_channel = mock.Mock()
+    activate_channel.receive_each.return_value = [(ch1, {}), (ch2, {})]
+    caps_channel = mocked_group.return_value.remote_exec.return_value
+    mocked_group.return_value.remote_exec.side_effect = lambda function, **kwargs: (
+        activate_channel
+        if function is pytest_cloud.patches.activate_env
+        else caps_channel
+    )
+    mocked_rsync.return_value.durations = {}
     params = [
         "--cloud-nodes={0}".format(node1),
         "--cloud-node={0}".format(node2),
@@ -252,3 +269,524 @@ def test_schedule(
         tx.startswith(expected) for tx, expected in zip(config.option.tx, result)
     )
     assert config.option.dist == "load"
+
+
+def test_make_gateways():
+    """Test concurrent gateway creation drops the nodes which don't connect in time."""
+    group = execnet.Group()
+    makegateway = execnet.Group.makegateway
+    late = []
+
+    def slow_makegateway(self, spec):
+        if spec == "popen//id=slow":
+            time.sleep(2)
+            late.append(makegateway(self, spec))
+            return late[0]
+        if spec == "popen//id=dead":
+            raise IOError("connection refused")
+        return makegateway(self, spec)
+
+    try:
+        with mock.patch.object(
+            execnet.Group, "makegateway", slow_makegateway
+        ), mock.patch.object(group, "_register", wraps=group._register) as register:
+            start = time.time()
+            result = pytest_cloud.plugin.make_gateways(
+                group,
+                ["popen//id=1", "popen//id=slow", "popen//id=dead", "popen//id=2"],
+                timeout=1.5,
+            )
+            assert time.time() - start < 2
+            assert [spec for spec, _ in result] == ["popen//id=1", "popen//id=2"]
+            time.sleep(1.5)
+        # the late gateway never shows up in the group
+        assert sorted(call[0][0].id for call in register.call_args_list) == ["1", "2"]
+        assert sorted(gateway.id for gateway in group) == ["1", "2"]
+        assert late and not late[0].hasreceiver()
+    finally:
+        group.terminate(timeout=5)
+
+
+@pytest.mark.parametrize("virtualenv_path, handed_off", [("", True), ("env", False)])
+# pylint: disable=R0913,W0613
+def test_reuse_gateways(
+    mocked_dsession, mocked_group, mocked_rsync, testdir, virtualenv_path, handed_off
+):
+    """Test the detection gateway is handed off only if the test processes run the same python interpreter."""
+    channel = mock.Mock()
+    channel.gateway.id = "1.example.com"
+    multi_channel = mock.Mock()
+    multi_channel.receive_each.return_value = [
+        (channel, {"cpu_count": 1, "virtual_memory": {"available": 1024 ** 3}})
+    ]
+    activate_channel = mock.Mock()
+    activate_channel.receive_each.return_value = [(channel, {})]
+    mocked_group.return_value.remote_exec.side_effect = lambda function, **kwargs: (
+        activate_channel
+        if function is pytest_cloud.patches.activate_env
+        else multi_channel
+    )
+    mocked_group.return_value.__getitem__ = mock.Mock()
+    mocked_rsync.return_value.durations = {}
+    with mock.patch("pytest_cloud.patches.handoff_gateway") as handoff_gateway:
+        testdir.inline_run(
+            "--cloud-nodes=1.example.com",
+            "--cloud-reuse-gateways",
+            "--cloud-python=python",
+            "--cloud-virtualenv-path={0}".format(virtualenv_path),
+        )
+    assert handoff_gateway.called is handed_off
+
+
+def test_setup_node_reuses_handoff_gateway():
+    """Test the handed off detection gateway is reused by the test worker with the same id."""
+    config = mock.Mock(spec=["hook", "option"])
+    group = mock.Mock()
+    gateway = mock.Mock()
+    gateway.id = "1.example.com"
+    gateway._group = group
+    group._gateways = [gateway]
+    pytest_cloud.patches.handoff_gateway(config, group, gateway, "1.example.com_0")
+    assert group._gateways == []
+    assert gateway.id == "1.example.com_0"
+
+    nodemanager = mock.Mock()
+    nodemanager.config = config
+    nodemanager.group.execmodel.backend = "thread"
+    with mock.patch("xdist.workermanage.WorkerController") as controller:
+        pytest_cloud.patches.setup_node(
+            nodemanager, execnet.XSpec("ssh=1.example.com//id=1.example.com_0"), None
+        )
+        pytest_cloud.patches.setup_node(
+            nodemanager, execnet.XSpec("ssh=1.example.com//id=1.example.com_1"), None
+        )
+    assert nodemanager.group.makegateway.call_count == 1
+    assert nodemanager.group._register.call_args == mock.call(gateway)
+    assert controller.call_args_list[0][0][1] is gateway
+    assert (
+        controller.call_args_list[1][0][1] is nodemanager.group.makegateway.return_value
+    )
+    assert config._cloud_gateways == {}
+
+
+def test_setup_sends_compact_handshake(testdir):
+    """Test the test worker gets only the options which differ from their defaults."""
+    config = testdir.parseconfig("--cloud-max-processes=3")
+    node = mock.Mock()
+    node.config = config
+    node.workerinput = {"workerid": "1.example.com_0"}
+    node.gateway.spec = execnet.XSpec("ssh=1.example.com//id=1.example.com_0")
+    node.nodemanager.roots = []
+    pytest_cloud.patches.setup(node)
+    pytest_cloud.patches.setup(node)
+    _, channel_id, data = node.gateway._send.call_args[0]
+    assert channel_id == node.gateway.remote_exec.return_value.id
+    workerinput, _, option_dict, _ = execnet.gateway_base.loads_internal(data)
+    assert workerinput == node.workerinput
+    assert option_dict["cloud_max_processes"] == 3
+    assert "plugins" in option_dict
+    assert "cloud_chdir" not in option_dict
+    assert config._cloud_handshake["count"] == 2
+    assert config._cloud_handshake["size"] == 2 * len(data)
+
+
+def test_add_nodes():
+    """Test the test processes of the test nodes set up during the test run are started."""
+    dsession = mock.Mock()
+    dsession.shuttingdown = False
+    dsession._active_nodes = set()
+    specs = [
+        "ssh=1.example.com//id=1.example.com_0",
+        "ssh=1.example.com//id=1.example.com_1",
+    ]
+    pytest_cloud.patches.add_nodes(dsession, specs)
+    assert [
+        call[0][0].id for call in dsession.nodemanager.setup_node.call_args_list
+    ] == ["1.example.com_0", "1.example.com_1"]
+    assert dsession._active_nodes == set([dsession.nodemanager.setup_node.return_value])
+
+    dsession.shuttingdown = True
+    pytest_cloud.patches.add_nodes(dsession, specs)
+    assert dsession.nodemanager.setup_node.call_count == 2
+
+
+@pytest.mark.parametrize(
+    ["lost", "abandoned"], [(True, False), (False, False), (False, True)]
+)
+def test_worker_errordown(lost, abandoned):
+    """Test the test processes of the lost test node and the stopped ones are not replaced."""
+    dsession = mock.Mock()
+    dsession.shuttingdown = False
+    node = mock.Mock()
+    node.gateway.id = "1.example.com_0"
+    dsession._active_nodes = set([node])
+    dsession.sched.nodes = [node]
+    dsession.sched.abandoned = set([node]) if abandoned else set()
+    cloud = dsession.config.pluginmanager.getplugin.return_value
+    cloud.is_lost.return_value = lost
+    removed = lost or abandoned
+    with mock.patch("pytest_cloud.patches.worker_errordown_crashed") as crashed:
+        pytest_cloud.patches.worker_errordown(dsession, node, "lost")
+    assert crashed.called is not removed
+    assert dsession.sched.remove_lost_node.called is removed
+    assert node.gateway.exit.called is removed
+    assert dsession.report_line.called is lost
+    assert dsession._active_nodes == (set() if removed else set([node]))
+
+
+@pytest.mark.parametrize("accepted", [True, False])
+def test_worker_testreport(accepted):
+    """Test the test reports dropped by the scheduler are not passed on."""
+    dsession = mock.Mock()
+    dsession.sched.accept_report.return_value = accepted
+    node, report = mock.Mock(), mock.Mock()
+    with mock.patch("pytest_cloud.patches.worker_testreport_accepted") as handle:
+        pytest_cloud.patches.worker_testreport(dsession, node, report)
+    dsession.sched.accept_report.assert_called_once_with(node, report)
+    assert handle.called is accepted
+
+
+def test_is_lost():
+    """Test the test node is lost when it's not connectable, and connected again in the background."""
+    plugin = pytest_cloud.plugin.CloudXdistPlugin()
+    node = mock.Mock()
+    node.gateway.id = "1.example.com_0"
+    node.gateway.spec = execnet.XSpec(
+        "ssh=user@1.example.com//id=1.example.com_0//python=python"
+    )
+    node.config.option.cloud_nodes = ["user@1.example.com", "2.example.com"]
+    node.config.option.cloud_reconnect_attempts = 2
+    with mock.patch("pytest_cloud.plugin.make_gateways") as make_gateways, mock.patch(
+        "pytest_cloud.plugin.execnet.Group"
+    ), mock.patch.object(plugin, "start_elastic_pool") as start_elastic_pool:
+        make_gateways.return_value = [("spec", 0.1)]
+        assert not plugin.is_lost(node)
+        # the connectable test node is not probed again for a while
+        assert not plugin.is_lost(node)
+        assert make_gateways.call_count == 1
+        make_gateways.return_value = []
+        plugin.reachable_hosts["1.example.com"] -= pytest_cloud.plugin.REACHABLE_TTL
+        assert plugin.is_lost(node)
+        assert plugin.is_lost(node)
+    assert make_gateways.call_count == 2
+    start_elastic_pool.assert_called_once_with(
+        node.config, ["user@1.example.com"], attempts=2
+    )
+    assert plugin.lost_hosts == set(["1.example.com"])
+
+
+def test_get_specs_quiet(testdir, tmpdir_factory, monkeypatch, capsys):
+    """Test the test nodes set up during the test run do not print and do not leave the execnet groups open."""
+    testdir.makepyfile(test_module="def test_function(): pass")
+    homes = tmpdir_factory.mktemp("homes")
+    makegateway = execnet.Group.makegateway
+
+    def local_makegateway(group, spec):
+        spec = execnet.XSpec(spec)
+        home = homes.join(spec.ssh).ensure(dir=True)
+        return makegateway(
+            group,
+            "popen//id={0}//chdir={1}//python={2}".format(
+                spec.id, home.join(spec.chdir), sys.executable
+            ),
+        )
+
+    monkeypatch.setattr(execnet.Group, "makegateway", local_makegateway)
+    terminate = execnet.Group.terminate
+    terminated = []
+
+    def recording_terminate(group, *args, **kwargs):
+        terminated.append(group)
+        return terminate(group, *args, **kwargs)
+
+    monkeypatch.setattr(execnet.Group, "terminate", recording_terminate)
+    managers = []
+
+    class RecordingNodeManager(pytest_cloud.plugin.NodeManager):
+        """Node manager which records its instances."""
+
+        def __init__(self, *args, **kwargs):
+            super(RecordingNodeManager, self).__init__(*args, **kwargs)
+            managers.append(self)
+
+    monkeypatch.setattr(pytest_cloud.plugin, "NodeManager", RecordingNodeManager)
+    config = testdir.parseconfigure()
+    config._cloud_nodes_kwargs = dict(
+        python="python",
+        chdir="target",
+        virtualenv_path="",
+        sync_backend="execnet",
+        config=config,
+    )
+    capsys.readouterr()
+    specs, unreachable = pytest_cloud.plugin.CloudXdistPlugin().get_specs(
+        config, ["1.example.com"]
+    )
+    assert specs
+    assert unreachable == []
+    assert capsys.readouterr().out == ""
+    assert managers
+    assert all(manager.group in terminated for manager in managers)
+
+
+def test_build_virtualenv(tmpdir):
+    """Test the virtualenv is built once per requirements fingerprint and then reused."""
+    requirements_path = tmpdir.join("requirements.txt")
+    requirements_path.write("six==1.16.0\n")
+    requirements, fingerprint = pytest_cloud.plugin.get_requirements(
+        [str(requirements_path)]
+    )
+    assert requirements == [("requirements-0.txt", "six==1.16.0\n")]
+    assert (
+        pytest_cloud.plugin.get_requirements(
+            [str(requirements_path)], chdir="pytest_root"
+        )[1]
+        != fingerprint
+    )
+
+    channel = mock.Mock()
+    cache_dir = tmpdir.join("cache")
+
+    def check_call(args):
+        if "virtualenv" in args:
+            os.makedirs(args[-1])
+
+    with mock.patch("subprocess.check_call", side_effect=check_call) as check_call:
+        for _ in range(2):
+            pytest_cloud.patches.build_virtualenv(
+                channel, requirements, fingerprint, str(cache_dir)
+            )
+    assert check_call.call_count == 2
+    path = channel.send.call_args_list[0][0][0]
+    assert channel.send.call_args_list[1][0][0] == path
+    assert os.path.dirname(path) == str(cache_dir)
+    assert open(os.path.join(path, "requirements-0.txt")).read() == "six==1.16.0\n"
+
+
+@pytest.mark.parametrize(
+    "bytecode, stale_exists, compiled",
+    [
+        ("purge", False, False),
+        ("keep", True, False),
+        ("compile", True, True),
+    ],
+)
+def test_activate_env_bytecode(tmpdir, bytecode, stale_exists, compiled):
+    """Test bytecode handling modes on the remote side."""
+    tmpdir.join("module.py").write("value = 1\n")
+    stale = tmpdir.join("__pycache__", "other.pyc")
+    stale.write("", ensure=True)
+    gateway = execnet.makegateway("popen//chdir={0}".format(tmpdir))
+    try:
+        timings = gateway.remote_exec(
+            pytest_cloud.patches.activate_env, virtualenv_path=None, bytecode=bytecode
+        ).receive()
+    finally:
+        gateway.exit()
+    assert stale.check() is stale_exists
+    assert bool(tmpdir.join("__pycache__").listdir("module.*.pyc")) is compiled
+    assert ("bytecode_purge" in timings) is (bytecode == "purge")
+    assert ("bytecode_compile" in timings) is compiled
+
+
+def test_activate_env_develop_eggs(tmpdir):
+    """Test develop eggs are installed again only when changed."""
+    virtualenv = tmpdir.join("env")
+    virtualenv.join("bin").ensure(dir=True)
+    virtualenv.join("bin", "python").mksymlinkto(sys.executable)
+    virtualenv.join("bin", "activate_this.py").write("")
+    site_packages = virtualenv.join("lib", "python", "site-packages")
+    site_packages.ensure(dir=True)
+    log = tmpdir.join("pip.log")
+    # fake pip records the installed eggs and links them
+    virtualenv.join("bin", "pip").write(
+        "import sys\n"
+        "open({0!r}, 'a').write(' '.join(sys.argv[4:]) + '\\n')\n"
+        "open({1!r}, 'w').write(repr(sys.argv))\n".format(
+            str(log), str(site_packages.join("easy-install.pth"))
+        )
+    )
+    for egg in ["egg1", "egg2"]:
+        tmpdir.join(egg, "setup.py").write("version = 1", ensure=True)
+
+    def activate():
+        gateway = execnet.makegateway("popen//chdir={0}".format(tmpdir))
+        try:
+            gateway.remote_exec(
+                pytest_cloud.patches.activate_env,
+                virtualenv_path="env",
+                develop_eggs=["./egg1", "./egg2"],
+                bytecode="keep",
+                cache_dir=str(tmpdir.join("cache")),
+            ).waitclose()
+        finally:
+            gateway.exit()
+
+    activate()
+    activate()
+    assert log.read().splitlines() == ["-e ./egg1 -e ./egg2"]
+    tmpdir.join("egg2", "setup.py").write("version = 2")
+    activate()
+    assert log.read().splitlines()[1:] == ["-e ./egg2"]
+    site_packages.join("easy-install.pth").write("synced")
+    activate()
+    assert log.read().splitlines()[2:] == ["-e ./egg1 -e ./egg2"]
+
+
+def test_get_node_capabilities():
+    """Test node capabilities are detected on the remote side."""
+    gateway = execnet.makegateway("popen")
+    try:
+        caps = gateway.remote_exec(
+            pytest_cloud.plugin.get_node_capabilities, calibrate=True
+        ).receive()
+    finally:
+        gateway.exit()
+    assert caps["cpu_count"] >= 1
+    assert caps["disk_free"] > 0
+    assert caps["speed"] > 0
+    assert set(caps) >= set(
+        ["physical_cpu_count", "load_average", "cpu_freq", "cpu_quota", "memory_limit"]
+    )
+
+
+def test_get_node_capabilities_without_psutil():
+    """Test node capabilities are detected with the standard library if psutil is not available."""
+    node_caps = []
+    with mock.patch.dict(sys.modules, {"psutil": None}):
+        pytest_cloud.plugin.get_node_capabilities(mock.Mock(send=node_caps.append))
+    assert node_caps[0]["cpu_count"] >= 1
+    assert node_caps[0]["physical_cpu_count"] is None
+    memory = node_caps[0]["virtual_memory"]
+    assert 0 < memory["available"] <= memory["total"]
+
+
+def test_get_nodes_specs_cached_capabilities(testdir, tmpdir_factory, monkeypatch):
+    """Test the test node with the cached capabilities is not probed, and its cached capabilities are kept."""
+    testdir.makepyfile(test_module="def test_function(): pass")
+    homes = tmpdir_factory.mktemp("homes")
+    makegateway = execnet.Group.makegateway
+
+    def local_makegateway(group, spec):
+        spec = execnet.XSpec(spec)
+        home = homes.join(spec.ssh).ensure(dir=True)
+        return makegateway(
+            group,
+            "popen//id={0}//chdir={1}//python={2}".format(
+                spec.id, home.join(spec.chdir), sys.executable
+            ),
+        )
+
+    monkeypatch.setattr(execnet.Group, "makegateway", local_makegateway)
+    remote_exec = execnet.Gateway.remote_exec
+    executed = []
+
+    def recording_remote_exec(gateway, source, **kwargs):
+        executed.append(source)
+        return remote_exec(gateway, source, **kwargs)
+
+    monkeypatch.setattr(execnet.Gateway, "remote_exec", recording_remote_exec)
+    config = testdir.parseconfigure()
+    cache = pytest_cloud.plugin.get_cache(config)
+    caps = dict(
+        cpu_count=3,
+        virtual_memory=dict(available=1024 ** 3, total=1024 ** 3),
+        speed=5,
+    )
+    with mock.patch("time.time", return_value=time.time() - 30):
+        pytest_cloud.plugin.CapabilitiesCache(cache, 60).update({"1.example.com": caps})
+    cached = pytest_cloud.plugin.CapabilitiesCache(cache, 60).hosts["1.example.com"]
+    specs = pytest_cloud.plugin.get_nodes_specs(
+        ["1.example.com"],
+        python="python",
+        chdir="target",
+        virtualenv_path="",
+        sync_backend="execnet",
+        caps_ttl=60,
+        config=config,
+    )
+    # the test processes are planned by the cached capabilities
+    assert len(specs) == 3
+    assert pytest_cloud.plugin.get_node_capabilities not in executed
+    # the cached capabilities expire in time, they are not stamped again by the test runs which use them
+    assert (
+        pytest_cloud.plugin.CapabilitiesCache(cache, 60).hosts["1.example.com"]
+        == cached
+    )
+
+
+@pytest.mark.parametrize(
+    "caps, mem_per_process, max_processes, expected",
+    [
+        (dict(cpu_count=8, physical_cpu_count=4), None, None, 4),
+        (dict(cpu_count=8, physical_cpu_count=4, load_average=[2.5]), None, None, 1),
+        (dict(cpu_count=8, load_average=[9.0]), None, None, 1),
+        (dict(cpu_count=8, cpu_quota=2.5, load_average=[9.0]), None, None, 2),
+        (dict(cpu_count=8), None, 3, 3),
+        (
+            dict(
+                cpu_count=8,
+                virtual_memory=dict(available=1000),
+                memory_limit=500,
+                memory_usage=100,
+            ),
+            100,
+            None,
+            4,
+        ),
+    ],
+)
+def test_size_by_contention(caps, mem_per_process, max_processes, expected):
+    """Test contention avoiding sizing policy."""
+    assert (
+        pytest_cloud.plugin.size_by_contention(
+            caps, mem_per_process=mem_per_process, max_processes=max_processes
+        )
+        == expected
+    )
+
+
+def test_get_sizing_policy():
+    """Test sizing policies are found by name or by import path."""
+    assert (
+        pytest_cloud.plugin.get_sizing_policy("contention")
+        is pytest_cloud.plugin.size_by_contention
+    )
+    assert (
+        pytest_cloud.plugin.get_sizing_policy("pytest_cloud.plugin:size_by_cpu")
+        is pytest_cloud.plugin.size_by_cpu
+    )
+    with pytest.raises(pytest.exit.Exception):
+        pytest_cloud.plugin.get_sizing_policy("unknown")
+
+
+def test_get_percentile():
+    """Test nearest rank percentile."""
+    assert pytest_cloud.plugin.get_percentile([5, 1, 4, 2, 3], 95) == 5
+    assert pytest_cloud.plugin.get_percentile([5, 1, 4, 2, 3], 50) == 3
+    assert pytest_cloud.plugin.get_percentile([7], 95) == 7
+
+
+def test_worker_reports_maxrss():
+    """Test the test process reports its peak memory usage when asked."""
+    session = mock.Mock()
+    session.config.workerinput = {
+        "workerid": "1.example.com_0",
+        "cloud_report_rss": True,
+    }
+    session.config.workeroutput = {}
+    pytest_cloud.plugin.pytest_sessionfinish(session)
+    assert session.config.workeroutput["cloud_maxrss"] > 1024 * 1024
+
+
+def test_worker_reports_maxrss_without_resource():
+    """Test the test process does not report its peak memory usage where the resource module is missing."""
+    session = mock.Mock()
+    session.config.workerinput = {
+        "workerid": "1.example.com_0",
+        "cloud_report_rss": True,
+    }
+    session.config.workeroutput = {}
+    with mock.patch.dict(sys.modules, {"resource": None}):
+        pytest_cloud.plugin.pytest_sessionfinish(session)
+    assert "cloud_maxrss" not in session.config.workeroutput
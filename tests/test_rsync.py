@@ -0,0 +1,68 @@
+"""Tests for rsync."""
+import shlex
+import sys
+
+import mock
+
+from pytest_cloud.rsync import RSync, get_tree
+
+
+def test_get_tree():
+    """Test k-ary distribution tree."""
+    assert get_tree(["1", "2", "3", "4", "5", "6", "7"], 2) == [
+        [(None, "1"), (None, "2")],
+        [("1", "3"), ("1", "4"), ("2", "5"), ("2", "6")],
+        [("3", "7")],
+    ]
+
+
+def test_send_tree():
+    """Test failed relays are resent from the nearest synced ancestor and then from the master."""
+    rsync = RSync(".", "test", fanout=1, ssh_cipher="aes128-gcm@openssh.com")
+    for target in ["1", "2", "3", "4"]:
+        rsync.add_target_host(target)
+    with mock.patch.object(rsync, "run_parallel") as run_parallel:
+        run_parallel.side_effect = [[0], [255], [0], [0], [0]]
+        rsync.send_tree("parallel", "includes", "ignores")
+    assert rsync.synced == set(["1", "2", "3", "4"])
+    commands = [call[0][1] for call in run_parallel.call_args_list]
+    assert commands[0] == [rsync.get_command("includes", "ignores", "1")]
+    assert commands[1] == [rsync.get_relay_command("1", "2")]
+    assert commands[2] == [rsync.get_relay_command("1", "3")]
+    assert commands[3] == [rsync.get_relay_command("3", "4")]
+    assert commands[4] == [rsync.get_command("includes", "ignores", "2")]
+    assert commands[3][0].startswith("ssh -A -T -x 3 'cd test && rsync -arHAXx ")
+    assert commands[3][0].endswith(" . 4:test'")
+
+
+def test_protects():
+    """Test protected files are not deleted on the targets by both master and relay rsync."""
+    rsync = RSync(".", "test", ssh_cipher="aes128-gcm@openssh.com", protects=["*.pyc"])
+    assert "'--filter=P *.pyc' " in rsync.get_command("includes", "ignores", "1")
+    assert "'--filter=P *.pyc' " in shlex.split(rsync.get_relay_command("1", "2"))[-1]
+
+
+# GNU parallel stand-in, which writes the joblog with the run time of each rsync command equal to its target host
+PARALLEL = """#!{python}
+import sys
+joblog = [arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--joblog=")][0]
+commands = sys.argv[sys.argv.index(":::") + 1:]
+with open(joblog, "w") as fd:
+    fd.write("Seq\\tHost\\tStarttime\\tJobRuntime\\tSend\\tReceive\\tExitval\\tSignal\\tCommand\\n")
+    for seq, command in enumerate(commands, 1):
+        fd.write("{{0}}\\t:\\t0\\t{{1}}\\t0\\t0\\t0\\t0\\t{{2}}\\n".format(seq, command.split()[-1].split(":")[0], command))
+"""
+
+
+def test_send_durations(tmpdir):
+    """Test the sync duration of each target is the run time of its own command."""
+    parallel = tmpdir.join("parallel")
+    parallel.write(PARALLEL.format(python=sys.executable))
+    parallel.chmod(0o755)
+    rsync = RSync(".", "test", ssh_cipher="aes128-gcm@openssh.com")
+    for target in ["1", "22"]:
+        rsync.add_target_host(target)
+    with mock.patch("pytest_cloud.rsync.find_executable", return_value=str(parallel)):
+        rsync.send()
+    assert rsync.synced == set(["1", "22"])
+    assert rsync.durations == {"1": 1.0, "22": 22.0}
@@ -0,0 +1,377 @@
+"""Tests for the test scheduling."""
+import mock
+
+from pytest_cloud.cache import get_durations, update_durations
+from pytest_cloud.collect import get_collect_files
+from pytest_cloud.scheduler import (
+    RETIRE_SLOWDOWN,
+    SPECULATIVE_MARKER,
+    THROUGHPUT_MIN_TESTS,
+    CloudLoadScheduling,
+    get_estimates,
+    get_host,
+    get_makespan,
+)
+
+
+def make_scheduler(
+    worker_ids, speeds=None, durations=None, tests=100, collection=None, **kwargs
+):
+    """Make the scheduler with the test processes which collected the tests."""
+    config = mock.Mock()
+    config.getvalue.return_value = worker_ids
+    config.getoption.return_value = None
+    scheduler = CloudLoadScheduling(
+        config, speeds=speeds, durations=durations, **kwargs
+    )
+    nodes = []
+    for worker_id in worker_ids:
+        node = mock.Mock()
+        node.gateway.id = worker_id
+        node.shutting_down = False
+        scheduler.add_node(node)
+        scheduler.add_node_collection(
+            node, collection or ["test_{0}".format(i) for i in range(tests)]
+        )
+        nodes.append(node)
+    return scheduler, nodes
+
+
+def test_schedule_speed_weighted():
+    """Test faster test nodes get proportionally more tests."""
+    scheduler, (slow, fast) = make_scheduler(
+        ["slow.example.com_0", "fast.example.com_0"],
+        speeds={"slow.example.com": 100, "fast.example.com": 300},
+    )
+    scheduler.schedule()
+    assert len(scheduler.node2pending[slow]) == 6
+    assert len(scheduler.node2pending[fast]) == 18
+
+
+def test_schedule_speed_weighted_min_pending():
+    """Test the slow test nodes get at least two tests, as the test process can't run the single pending test."""
+    scheduler, nodes = make_scheduler(
+        ["1.example.com_0", "2.example.com_0", "3.example.com_0", "4.example.com_0"],
+        speeds={
+            "1.example.com": 100,
+            "2.example.com": 100,
+            "3.example.com": 100,
+            "4.example.com": 1000,
+        },
+        tests=8,
+    )
+    scheduler.schedule()
+    assert [len(scheduler.node2pending[node]) for node in nodes] == [2, 2, 2, 2]
+
+
+def test_schedule_observed_throughput():
+    """Test observed throughput replaces the calibration speed."""
+    scheduler, (first, second) = make_scheduler(
+        ["1.example.com_0", "2.example.com_0"],
+        speeds={"1.example.com": 100, "2.example.com": 300},
+    )
+    assert scheduler.get_weight(first) == 0.5
+    for _ in range(THROUGHPUT_MIN_TESTS):
+        scheduler.node2stats.setdefault(first, [0, 0.0, 0.0])
+        scheduler.node2stats[first][0] += 1
+        scheduler.node2stats[first][1] += 0.1
+        scheduler.node2stats.setdefault(second, [0, 0.0, 0.0])
+        scheduler.node2stats[second][0] += 1
+        scheduler.node2stats[second][1] += 0.1
+    assert scheduler.get_weight(first) == 1
+
+
+def test_schedule_not_weighted():
+    """Test the chunks are not weighted without the speeds."""
+    scheduler, (first, second) = make_scheduler(["1.example.com_0", "2.example.com_0"])
+    scheduler.schedule()
+    assert len(scheduler.node2pending[first]) == len(scheduler.node2pending[second])
+
+
+def test_schedule_not_weighted_round_robin():
+    """Test the tests are sent one by one as xdist does without the speeds, if there are too few of them."""
+    scheduler, (first, second) = make_scheduler(
+        ["1.example.com_0", "2.example.com_0"], tests=3
+    )
+    scheduler.schedule()
+    assert scheduler.node2pending[first] == [0, 2]
+    assert scheduler.node2pending[second] == [1]
+
+
+def test_get_estimates():
+    """Test tests without history are estimated by their module or by all the tests."""
+    durations = {"a.py::test_1": 1.0, "a.py::test_2": 3.0, "b.py::test_1": 8.0}
+    assert get_estimates(
+        ["a.py::test_1", "a.py::test_3", "b.py::test_2", "c.py::test_1"], durations
+    ) == [1.0, 2.0, 8.0, 4.0]
+
+
+def test_get_makespan():
+    """Test longest first makespan."""
+    assert get_makespan([3, 5, 3, 4, 3], 2) == 10
+
+
+def test_schedule_longest_first():
+    """Test the longest tests are spread among the test processes first."""
+    durations = dict(("test_{0}".format(i), 0.01) for i in range(100))
+    durations.update({"test_98": 60.0, "test_99": 50.0})
+    scheduler, (first, second) = make_scheduler(
+        ["1.example.com_0", "2.example.com_0"], durations=durations
+    )
+    scheduler.schedule()
+    assert scheduler.node2pending[first] == [98, 97]
+    assert scheduler.node2pending[second] == [99, 96]
+    assert scheduler.predicted_makespan == 60.0
+
+
+def test_update_durations():
+    """Test test durations are merged with the recorded ones."""
+    values = {}
+    cache = mock.Mock()
+    cache.get.side_effect = values.get
+    cache.set.side_effect = values.__setitem__
+    update_durations(cache, {"test_1": 1.0, "test_2": 2.0})
+    update_durations(cache, {"test_2": 3.0}, collection=["test_1", "test_2"])
+    assert get_durations(cache) == {"test_1": 1.0, "test_2": 3.0}
+    update_durations(cache, {}, collection=["test_2"])
+    assert get_durations(cache) == {"test_2": 3.0}
+
+
+def test_schedule_retire_slow():
+    """Test the slow test process is retired and its pending tests are sent to the others."""
+    scheduler, (first, second, slow) = make_scheduler(
+        ["1.example.com_0", "2.example.com_0", "slow.example.com_0"],
+        retire_slow=True,
+    )
+    scheduler.schedule()
+    durations = [(first, 0.1), (second, 0.1), (slow, 0.1 * RETIRE_SLOWDOWN)]
+    for node, duration in durations:
+        for _ in range(THROUGHPUT_MIN_TESTS):
+            scheduler.mark_test_complete(
+                node, scheduler.node2pending[node][0], duration
+            )
+    slow.shutdown.assert_not_called()
+    scheduler.mark_test_complete(slow, scheduler.node2pending[slow][0], 1)
+    slow.shutdown.assert_called_once_with()
+    (stolen,), _ = slow.send_steal.call_args
+    assert stolen == scheduler.node2pending[slow][2:]
+    slow.shutting_down = True
+    scheduler.remove_pending_tests_from_node(slow, stolen)
+    assert len(scheduler.node2pending[slow]) == 2
+    assert set(stolen) <= set(
+        scheduler.pending
+        + scheduler.node2pending[first]
+        + scheduler.node2pending[second]
+    )
+
+
+def test_remove_lost_node():
+    """Test all the tests of the lost test process are sent first, the running one included."""
+    scheduler, (first, lost) = make_scheduler(["1.example.com_0", "2.example.com_0"])
+    scheduler.schedule()
+    pending = list(scheduler.node2pending[lost])
+    scheduler.remove_lost_node(lost)
+    assert lost not in scheduler.node2pending
+    assert set(pending) <= set(scheduler.pending + scheduler.node2pending[first])
+
+
+def make_report(nodeid, when, speculative=True):
+    """Make the test report."""
+    return mock.Mock(
+        nodeid=nodeid,
+        when=when,
+        keywords={SPECULATIVE_MARKER: 1} if speculative else {},
+    )
+
+
+def test_schedule_speculate():
+    """Test the copy of the longest running test is sent to the idle test process and the first result wins."""
+    scheduler, (slow, fast) = make_scheduler(
+        ["slow.example.com_0", "fast.example.com_0"], tests=4, speculate=True
+    )
+    scheduler.schedule()
+    assert not scheduler.pending
+    scheduler.mark_test_complete(slow, scheduler.node2pending[slow][0], 1)
+    index = scheduler.node2pending[slow][0]
+    nodeid = scheduler.collection[index]
+    assert scheduler.accept_report(slow, make_report(nodeid, "setup"))
+    for other in list(scheduler.node2pending[fast]):
+        scheduler.mark_test_complete(fast, other, 0.1)
+    fast.send_runtest_some.assert_called_with([index])
+    assert scheduler.node2pending[fast] == [index]
+    assert not scheduler.accept_report(fast, make_report(nodeid, "setup"))
+    assert scheduler.accept_report(fast, make_report(nodeid, "call"))
+    assert scheduler.abandoned == set([slow])
+    assert slow.gateway._io.kill.called
+    assert scheduler.accept_report(fast, make_report(nodeid, "teardown"))
+    scheduler.mark_test_complete(fast, index, 0.1)
+    assert scheduler.node2stats[fast][0] == 3
+    assert scheduler.node2stats[slow][0] == 1
+    assert scheduler.tests_finished
+
+
+def test_schedule_speculate_original_wins():
+    """Test the reports of the copy are dropped when the original test reports the result first."""
+    scheduler, (slow, fast) = make_scheduler(
+        ["slow.example.com_0", "fast.example.com_0"], tests=4, speculate=True
+    )
+    scheduler.schedule()
+    index = scheduler.node2pending[slow][0]
+    nodeid = scheduler.collection[index]
+    scheduler.accept_report(slow, make_report(nodeid, "setup"))
+    for other in list(scheduler.node2pending[fast]):
+        scheduler.mark_test_complete(fast, other, 0.1)
+    assert scheduler.accept_report(slow, make_report(nodeid, "call"))
+    assert scheduler.abandoned == set([fast])
+    assert not scheduler.accept_report(fast, make_report(nodeid, "call"))
+    scheduler.mark_test_complete(slow, index, 10)
+    assert scheduler.node2stats[slow][0] == 1
+
+
+def test_schedule_speculate_late_completion():
+    """Test the completion of the copy which lost, sent before its test process was stopped, is ignored."""
+    scheduler, (slow, fast) = make_scheduler(
+        ["slow.example.com_0", "fast.example.com_0"], tests=4, speculate=True
+    )
+    scheduler.schedule()
+    index = scheduler.node2pending[slow][0]
+    nodeid = scheduler.collection[index]
+    scheduler.accept_report(slow, make_report(nodeid, "setup"))
+    for other in list(scheduler.node2pending[fast]):
+        scheduler.mark_test_complete(fast, other, 0.1)
+    assert scheduler.accept_report(slow, make_report(nodeid, "call"))
+    assert scheduler.abandoned == set([fast])
+    scheduler.mark_test_complete(fast, index, 0.1)
+    assert scheduler.node2pending[fast] == []
+    assert scheduler.node2stats[fast][0] == 2
+
+
+def test_schedule_speculate_not_marked():
+    """Test the tests which are not marked as safe to run more than once are not copied."""
+    scheduler, (slow, fast) = make_scheduler(
+        ["slow.example.com_0", "fast.example.com_0"], tests=4, speculate=True
+    )
+    scheduler.schedule()
+    nodeid = scheduler.collection[scheduler.node2pending[slow][0]]
+    assert scheduler.accept_report(
+        slow, make_report(nodeid, "setup", speculative=False)
+    )
+    for other in list(scheduler.node2pending[fast]):
+        scheduler.mark_test_complete(fast, other, 0.1)
+    assert not fast.send_runtest_some.call_args_list[1:]
+    assert scheduler.node2pending[fast] == []
+
+
+def test_schedule_host_affinity():
+    """Test whole test modules are assigned to the test nodes."""
+    collection = [
+        "test_{0}.py::test_{1}".format(module, test)
+        for module in range(4)
+        for test in range(20)
+    ]
+    scheduler, nodes = make_scheduler(
+        ["1.example.com_0", "1.example.com_1", "2.example.com_0", "2.example.com_1"],
+        collection=collection,
+        affinity=True,
+    )
+    scheduler.schedule()
+    hosts = {}
+    for node in nodes:
+        for index in scheduler.node2pending[node]:
+            module = collection[index].split("::")[0]
+            assert hosts.setdefault(module, get_host(node)) == get_host(node)
+    assert sorted(scheduler.module2host.values()) == [
+        "1.example.com",
+        "1.example.com",
+        "2.example.com",
+        "2.example.com",
+    ]
+
+    # the test node without the pending tests takes over the module of the other one
+    scheduler.pending[:] = [
+        index
+        for index in scheduler.pending
+        if scheduler.module2host[scheduler.index2module[index]] == "2.example.com"
+    ]
+    module = scheduler.index2module[scheduler.pending[-1]]
+    count = sum(
+        1 for index in scheduler.pending if scheduler.index2module[index] == module
+    )
+    assert scheduler.prefer_host("1.example.com") == count
+    assert scheduler.module2host[module] == "1.example.com"
+    assert set(
+        scheduler.index2module[index] for index in scheduler.pending[:count]
+    ) == set([module])
+
+
+def test_schedule_collected():
+    """Test the test processes get only the tests of the test files they collected."""
+    collection = [
+        "test_{0}.py::test_{1}".format(module, test)
+        for module in range(2)
+        for test in range(20)
+    ]
+    scheduler, (first, second) = make_scheduler(
+        ["1.example.com_0", "1.example.com_1"],
+        collection=collection,
+        collected={"1.example.com_0": set(["test_1.py"])},
+    )
+    scheduler.schedule()
+    assert scheduler.node2pending[first]
+    assert set(
+        collection[index].split("::")[0] for index in scheduler.node2pending[first]
+    ) == set(["test_1.py"])
+    assert scheduler.node2pending[second]
+
+
+def test_schedule_collected_last_test():
+    """Test the test process with a single pending test and no more tests it collected is shut down to run it."""
+    collection = ["test_0.py::test_0", "test_0.py::test_1"] + [
+        "test_1.py::test_{0}".format(test) for test in range(20)
+    ]
+    scheduler, (first, second) = make_scheduler(
+        ["1.example.com_0", "1.example.com_1"],
+        collection=collection,
+        collected={
+            "1.example.com_0": set(["test_0.py"]),
+            "1.example.com_1": set(["test_1.py"]),
+        },
+    )
+    scheduler.schedule()
+    assert scheduler.node2pending[first] == [0, 1]
+    assert not first.shutdown.called
+    scheduler.mark_test_complete(first, 0)
+    assert scheduler.node2pending[first] == [1]
+    assert first.shutdown.called
+    assert not second.shutdown.called
+
+
+def test_schedule_collected_host_affinity():
+    """Test the test processes get only the collected tests of the test modules assigned to their test node."""
+    collection = [
+        "test_{0}.py::test_{1}".format(module, test)
+        for module in range(4)
+        for test in range(10)
+    ]
+    worker_ids = [
+        "a.example.com_0",
+        "a.example.com_1",
+        "b.example.com_0",
+        "b.example.com_1",
+    ]
+    scheduler, nodes = make_scheduler(
+        worker_ids,
+        collection=collection,
+        affinity=True,
+        collected=dict(
+            (worker_id, set(files))
+            for worker_id, files in get_collect_files(collection, worker_ids).items()
+        ),
+    )
+    scheduler.schedule()
+    assert any(scheduler.node2pending[node] for node in nodes)
+    for node in nodes:
+        for index in scheduler.node2pending[node]:
+            module = collection[index].split("::")[0]
+            assert module in scheduler.collected[node.gateway.id]
+            assert scheduler.module2host[module] == get_host(node)
@@ -0,0 +1,31 @@
+"""Tests for shared ssh connections."""
+import os
+
+import mock
+
+from pytest_cloud.ssh import SSHMultiplexer
+
+
+def test_multiplexer():
+    """Test multiplexer options and master connections teardown."""
+    multiplexer = SSHMultiplexer()
+    control_path = os.path.join(multiplexer.control_dir, "%C")
+    assert multiplexer.get_ssh_args("user@1.example.com") == (
+        "-o ControlMaster=auto -o ControlPath={0} -o ControlPersist=60 "
+        "user@1.example.com".format(control_path)
+    )
+    with mock.patch("subprocess.call") as call:
+        multiplexer.close()
+    assert call.call_args[0][0] == [
+        "ssh",
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        "ControlPath={0}".format(control_path),
+        "-o",
+        "ControlPersist=60",
+        "-O",
+        "exit",
+        "user@1.example.com",
+    ]
+    assert not os.path.exists(multiplexer.control_dir)
@@ -0,0 +1,286 @@
+"""Tests for directory structure sync over execnet."""
+import json
+import os
+import sys
+
+import execnet
+import mock
+import pytest
+
+from pytest_cloud.plugin import BYTECODE_PATTERNS, get_nodes_specs, sync_nodes
+from pytest_cloud.sync import SYNC_MARKER, ExecnetSync, get_changes, get_manifest
+
+
+@pytest.fixture
+def gateway(tmpdir):
+    """Local gateway running in the target directory."""
+    gateway = execnet.makegateway("popen//chdir={0}".format(tmpdir.join("target")))
+    yield gateway
+    gateway.exit()
+
+
+def test_get_changes():
+    """Test changes between manifests."""
+    local = {
+        "a": ("d", 0, 0, 0o755),
+        "a/b.py": ("f", 10, 100, 0o644),
+        "c.py": ("f", 10, 100, 0o644),
+        "link": ("l", 0, 0, "c.py"),
+    }
+    remote = {
+        "a": ("f", 10, 100, 0o644),
+        "c.py": ("f", 10, 100, 0o644),
+        "d.py": ("f", 10, 100, 0o644),
+        "link": ("l", 0, 0, "d.py"),
+    }
+    assert get_changes(local, remote) == (["a", "d.py"], ["a", "a/b.py", "link"])
+
+
+def test_send(tmpdir, gateway):
+    """Test only changed files are sent and removed files are deleted."""
+    source = tmpdir.join("source")
+    source.join("package", "module.py").write("a = 1", ensure=True)
+    source.join("package", "module.pyc").write("", ensure=True)
+    source.join("removed.py").write("b = 1", ensure=True)
+    os.symlink("package", str(source.join("link")))
+    sync = ExecnetSync(
+        source, "target", gateways={"node": gateway}, ignores=[os.path.abspath("*.pyc")]
+    )
+    sync.add_target_host("node")
+
+    assert sync.send()["files"] == 4
+    target = tmpdir.join("target")
+    assert target.join("package", "module.py").read() == "a = 1"
+    assert not target.join("package", "module.pyc").exists()
+    assert os.readlink(str(target.join("link"))) == "package"
+    assert get_manifest(str(target)) == get_manifest(str(source), ["*.pyc"])
+
+    source.join("removed.py").remove()
+    source.join("package", "module.py").write("a = 22")
+    assert sync.send()["files"] == 1
+    assert not target.join("removed.py").exists()
+    assert target.join("package", "module.py").read() == "a = 22"
+    assert sync.send()["files"] == 0
+
+
+@pytest.mark.parametrize("protects, kept", [(None, False), (BYTECODE_PATTERNS, True)])
+def test_send_protects(tmpdir, gateway, protects, kept):
+    """Test the protected files on the target are not deleted, even if they don't exist locally."""
+    tmpdir.join("source", "package", "module.py").write("a = 1", ensure=True)
+    bytecode = tmpdir.join("target", "package", "__pycache__", "module.cpython.pyc")
+    bytecode.write("", ensure=True)
+    sync = ExecnetSync(
+        tmpdir.join("source"),
+        "target",
+        gateways={"node": gateway},
+        ignores=[os.path.abspath("*.pyc")],
+        protects=protects,
+    )
+    sync.add_target_host("node")
+
+    assert sync.send()["files"] == 1
+    assert tmpdir.join("target", "package", "module.py").read() == "a = 1"
+    assert bytecode.check() is kept
+
+
+def test_send_gateways_added_later(tmpdir, gateway):
+    """Test the gateways added after the sync is created are used."""
+    tmpdir.join("source", "module.py").write("a = 1", ensure=True)
+    gateways = {}
+    sync = ExecnetSync(tmpdir.join("source"), "target", gateways=gateways)
+    gateways["node"] = gateway
+    sync.add_target_host("node")
+
+    assert sync.send()["files"] == 1
+    assert tmpdir.join("target", "module.py").read() == "a = 1"
+
+
+def test_send_durations(tmpdir):
+    """Test each target measures its own sync time, not waiting for the files of the other targets."""
+    source = tmpdir.join("source")
+    for index in range(1000):
+        source.join("package", "module{0}.py".format(index)).write(
+            "a = {0}".format(index), ensure=True
+        )
+    source.join("module.py").write("a = 1")
+    # the warm target only misses one file
+    warm_manifest = get_manifest(str(source))
+    del warm_manifest["module.py"]
+    group = execnet.Group()
+    group.makegateway("popen//id=cold//chdir={0}".format(tmpdir.join("cold")))
+    group.makegateway("popen//id=warm//chdir={0}".format(tmpdir.join("warm")))
+    try:
+        sync = ExecnetSync(
+            source, "target", gateways={"cold": group["cold"], "warm": group["warm"]}
+        )
+        sync.add_target_host("cold")
+        sync.add_target_host("warm")
+        stats = sync.send(remote_manifests={"warm": warm_manifest})
+    finally:
+        group.terminate()
+    assert tmpdir.join("warm", "module.py").read() == "a = 1"
+    assert sorted(sync.durations) == ["cold", "warm"]
+    assert sync.durations["warm"] < sync.durations["cold"] / 2
+    assert sync.durations["cold"] <= stats["duration"]
+
+
+class Cache(dict):
+    """In-memory pytest cache."""
+
+    def set(self, key, value):
+        """Set the value, round-tripping it through json like pytest cache does."""
+        self[key] = json.loads(json.dumps(value))
+
+
+def test_sync_nodes_cache(tmpdir):
+    """Test the test nodes which are up to date are skipped and the others are synced without the remote walk."""
+    source = tmpdir.join("source")
+    source.join("module.py").write("a = 1", ensure=True)
+    group = execnet.Group()
+    group.makegateway("popen//id=host//chdir={0}".format(tmpdir.join("target")))
+    cache = Cache()
+    try:
+
+        def sync():
+            rsync = ExecnetSync(source, "target", gateways={"node": group["host"]})
+            rsync.add_target_host("node")
+            with mock.patch.object(rsync, "send", wraps=rsync.send) as send:
+                sync_nodes(rsync, group, [("node", "host")], source, "target", cache)
+            return send
+
+        assert sync().call_args[1]["remote_manifests"] == {}
+        assert tmpdir.join("target", SYNC_MARKER).check()
+        assert not sync().called
+        remote_manifest = get_manifest(str(tmpdir.join("target")), [".*"])
+        source.join("module.py").write("a = 22")
+        send = sync()
+        assert send.call_args[1]["remote_manifests"] == {"node": remote_manifest}
+        assert tmpdir.join("target", "module.py").read() == "a = 22"
+    finally:
+        group.terminate()
+
+
+def test_sync_nodes_cold_archive(tmpdir):
+    """Test the empty test nodes get the archive and the others are synced as usual."""
+    source = tmpdir.join("source")
+    source.join("package", "module.py").write("a = 1", ensure=True)
+    os.symlink("package", str(source.join("link")))
+    tmpdir.join("warm", "module.py").write("a = 1", ensure=True)
+    group = execnet.Group()
+    group.makegateway("popen//id=cold//chdir={0}".format(tmpdir.join("cold")))
+    group.makegateway("popen//id=warm//chdir={0}".format(tmpdir.join("warm")))
+    try:
+        rsync = ExecnetSync(
+            source, "target", gateways={"cold": group["cold"], "warm": group["warm"]}
+        )
+        rsync.add_target_host("cold")
+        rsync.add_target_host("warm")
+        with mock.patch.object(rsync, "send", wraps=rsync.send) as send:
+            sync_nodes(
+                rsync,
+                group,
+                [("cold", "cold"), ("warm", "warm")],
+                source,
+                "target",
+                cold_archive=True,
+            )
+        assert send.called
+        assert rsync.targets == set(["warm"])
+    finally:
+        group.terminate()
+    for target in ("cold", "warm"):
+        assert get_manifest(str(tmpdir.join(target))) == get_manifest(str(source))
+
+
+def test_get_nodes_specs_execnet(testdir, tmpdir_factory, monkeypatch):
+    """Test the test nodes are set up with the execnet sync backend, over the local gateways in place of ssh."""
+    testdir.makepyfile(test_module="def test_function(): pass")
+    homes = tmpdir_factory.mktemp("homes")
+    makegateway = execnet.Group.makegateway
+
+    def local_makegateway(group, spec):
+        spec = execnet.XSpec(spec)
+        home = homes.join(spec.ssh).ensure(dir=True)
+        return makegateway(
+            group,
+            "popen//id={0}//chdir={1}//python={2}".format(
+                spec.id, home.join(spec.chdir), sys.executable
+            ),
+        )
+
+    monkeypatch.setattr(execnet.Group, "makegateway", local_makegateway)
+    specs = get_nodes_specs(
+        ["1.example.com", "2.example.com"],
+        python="python",
+        chdir="target",
+        virtualenv_path="",
+        sync_backend="execnet",
+        config=testdir.parseconfigure(),
+    )
+
+    assert specs
+    for host in ("1.example.com", "2.example.com"):
+        assert "ssh={0}//id={0}_0//chdir=target//python=python".format(host) in specs
+        assert homes.join(host, "target", "test_module.py").check()
+
+
+def test_get_nodes_specs_develop_eggs(testdir, tmpdir_factory, monkeypatch):
+    """Test the develop eggs are installed on the first bring-up only, as the sync keeps their links on the test node."""
+    testdir.makeini("[pytest]\ncloud_develop_eggs = egg1")
+    testdir.tmpdir.join("egg1", "setup.py").write("version = 1", ensure=True)
+    virtualenv = testdir.tmpdir.join("env")
+    virtualenv.join("bin").ensure(dir=True)
+    virtualenv.join("bin", "python").mksymlinkto(sys.executable)
+    virtualenv.join("bin", "activate_this.py").write("")
+    # links of the master, pointing to the local paths
+    site_packages = virtualenv.join("lib", "python", "site-packages")
+    site_packages.join("easy-install.pth").write("master", ensure=True)
+    homes = tmpdir_factory.mktemp("homes")
+    log = homes.join("pip.log")
+    # fake pip records the installed eggs and links them
+    virtualenv.join("bin", "pip").write(
+        "import sys\n"
+        "open({0!r}, 'a').write(' '.join(sys.argv[4:]) + '\\n')\n"
+        "open('env/lib/python/site-packages/easy-install.pth', 'w').write('node')\n".format(
+            str(log)
+        )
+    )
+    makegateway = execnet.Group.makegateway
+
+    def local_makegateway(group, spec):
+        spec = execnet.XSpec(spec)
+        home = homes.join(spec.ssh).ensure(dir=True)
+        return makegateway(
+            group,
+            "popen//id={0}//chdir={1}//python={2}".format(
+                spec.id, home.join(spec.chdir), sys.executable
+            ),
+        )
+
+    monkeypatch.setattr(execnet.Group, "makegateway", local_makegateway)
+    monkeypatch.setattr(
+        "pytest_cloud.plugin.DEFAULT_DEVELOP_EGGS_CACHE_DIR", str(homes.join("cache"))
+    )
+    for version in (1, 22):
+        # the changed file makes the tree be synced again
+        testdir.makepyfile(
+            test_module="def test_function(): assert {0}".format(version)
+        )
+        specs = get_nodes_specs(
+            ["1.example.com"],
+            python="python",
+            chdir="target",
+            virtualenv_path="env",
+            sync_backend="execnet",
+            config=testdir.parseconfigure(),
+        )
+        assert specs
+        target = homes.join("1.example.com", "target")
+        assert target.join("test_module.py").read().endswith(str(version))
+        assert (
+            target.join(
+                "env", "lib", "python", "site-packages", "easy-install.pth"
+            ).read()
+            == "node"
+        )
+    assert log.read().splitlines() == ["-e ./egg1"]
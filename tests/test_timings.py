@@ -0,0 +1,55 @@
+"""Tests for the timings of the test run phases."""
+import json
+
+import mock
+
+from pytest_cloud.timings import Timings, write_report
+
+
+def test_timings(tmpdir):
+    """Test the phases are reported in aggregate and per node, ordered by the start time."""
+    with mock.patch("pytest_cloud.timings.time.time", return_value=100.0):
+        timings = Timings()
+    timings.add("sync", 105.0, 110.0, node="1.example.com")
+    timings.add("sync", 104.0, 107.0, node="2.example.com")
+    timings.add("sync", 103.0, 111.0)
+    timings.add("connect", 101.0, 102.0, node="1.example.com")
+    timings.add("connect", 101.0, 102.5, node="1.example.com")
+    with mock.patch("pytest_cloud.timings.time.time", side_effect=[112.0, 113.0]):
+        with timings.measure("capabilities"):
+            pass
+    with mock.patch("pytest_cloud.timings.time.time", return_value=120.0):
+        report = timings.get_report()
+    assert report == {
+        "started": 100.0,
+        "duration": 20.0,
+        "phases": [
+            {
+                "name": "connect",
+                "start": 1.0,
+                "duration": 1.5,
+                "nodes": {"1.example.com": 2.5},
+                "total": 2.5,
+                "max": 2.5,
+            },
+            {
+                "name": "sync",
+                "start": 3.0,
+                "duration": 8.0,
+                "nodes": {"1.example.com": 5.0, "2.example.com": 3.0},
+                "total": 8.0,
+                "max": 5.0,
+            },
+            {
+                "name": "capabilities",
+                "start": 12.0,
+                "duration": 1.0,
+                "nodes": {},
+                "total": 0,
+                "max": None,
+            },
+        ],
+    }
+    path = tmpdir.join("timings.json")
+    write_report(report, str(path))
+    assert json.loads(path.read()) == report
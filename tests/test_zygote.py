@@ -0,0 +1,78 @@
+"""Tests for the zygote process."""
+import os
+import signal
+import sys
+import time
+
+import execnet
+
+from pytest_cloud import patches, zygote
+
+
+def test_zygote(tmpdir):
+    """Test processes are forked by the zygote with the modules preloaded."""
+    with open(os.path.splitext(zygote.__file__)[0] + ".py") as fd:
+        source = fd.read()
+    group = execnet.Group()
+    try:
+        gateway = group.makegateway("popen//chdir={0}".format(tmpdir))
+        command = gateway.remote_exec(
+            patches.start_zygote,
+            python=sys.executable,
+            script=source,
+            modules=["xml.dom.minidom"],
+        ).receive()
+        assert command.endswith("zygote.sock")
+        worker = group.makegateway("popen//python={0}".format(command))
+        channel = worker.remote_exec(
+            """
+import os, sys
+channel.send(("xml.dom.minidom" in sys.modules, os.getcwd(), os.getppid()))
+"""
+        )
+        preloaded, cwd, pid = channel.receive()
+    finally:
+        group.terminate(timeout=10)
+    assert preloaded
+    assert cwd == str(tmpdir)
+    # the zygote cleans up after itself
+    directory = os.path.dirname(command.split()[-1])
+    os.kill(pid, signal.SIGTERM)
+    for _ in range(50):
+        if not os.path.exists(directory):
+            break
+        time.sleep(0.1)
+    assert not os.path.exists(directory)
+
+
+def start_zygote(tmpdir, python):
+    """Start the zygote with the given python executable, in the local gateway."""
+    with open(os.path.splitext(zygote.__file__)[0] + ".py") as fd:
+        source = fd.read()
+    gateway = execnet.makegateway("popen//chdir={0}".format(tmpdir))
+    try:
+        return gateway.remote_exec(
+            patches.start_zygote, python=python, script=source, modules=[]
+        ).receive()
+    finally:
+        gateway.exit()
+
+
+def test_zygote_python_name(tmpdir, monkeypatch):
+    """Test the python executable given by name is looked up in PATH."""
+    monkeypatch.setenv(
+        "PATH", os.path.dirname(sys.executable) + os.pathsep + os.environ["PATH"]
+    )
+    command = start_zygote(tmpdir, os.path.basename(sys.executable))
+    assert command.startswith(sys.executable + " ")
+    worker = execnet.makegateway("popen//python={0}".format(command))
+    try:
+        pid = worker.remote_exec("import os; channel.send(os.getppid())").receive()
+    finally:
+        worker.exit()
+    os.kill(pid, signal.SIGTERM)
+
+
+def test_zygote_bad_python(tmpdir):
+    """Test the zygote which can't be started reports the failure instead of raising."""
+    assert start_zygote(tmpdir, "missing/bin/python") is None